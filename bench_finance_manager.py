@@ -0,0 +1,666 @@
+import gc
+import os
+import sys
+import csv
+import bisect
+import contextlib
+import decimal
+import json
+import uuid
+import random
+import platform
+import subprocess
+import argparse
+import time
+import datetime
+import itertools
+import tempfile
+import tracemalloc
+
+import finance_manager
+
+
+# --- Synthetic Ledgers ---
+
+MERCHANTS = (
+    "Grocery", "Coffee", "Rent", "Salary", "Fuel", "Pharmacy", "Restaurant", "Books",
+    "Electric", "Water", "Internet", "Phone", "Insurance", "Gym", "Cinema", "Hardware",
+)
+
+# Originals per account that generated refunds are drawn from; older ones
+# drop out, so memory stays flat however many rows are generated.
+REFUND_CANDIDATES = 256
+
+
+def generate_rows(count, banks=3, accounts=7, refunds=0.05, seed=0):
+    # Yields `count` rows spread over `banks` x `accounts` accounts, the
+    # first ones busier than the rest, one every 37 seconds from 2020. About
+    # `refunds` of them refund an earlier row of the same account, never for
+    # more than is left of it. The same arguments always give the same rows.
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    names = [(f"Bank {b}", f"Account {a}") for b in range(banks) for a in range(accounts)]
+    weights = list(itertools.accumulate(1 / (k + 1) for k in range(len(names))))
+    candidates = [[] for _ in names]  # [id, type, cents left] per account
+    for i in range(count):
+        slot = bisect.bisect(weights, rng.random() * weights[-1])
+        bank, account = names[slot]
+        tx_id = uuid.UUID(int=rng.getrandbits(128), version=4).hex
+        date = (start + datetime.timedelta(seconds=i * 37)).isoformat()
+        pool = candidates[slot]
+        if pool and rng.random() < refunds:
+            pos = rng.randrange(len(pool))
+            original = pool[pos]
+            cents = rng.randint(1, original[2])
+            original[2] -= cents
+            if not original[2]:
+                pool[pos] = pool[-1]
+                pool.pop()
+            yield {
+                "id": tx_id, "bank": bank, "account": account,
+                "type": "withdrawal" if original[1] == "deposit" else "deposit",
+                "amount": cents / 100,
+                "description": f"Refund for transaction {original[0]}",
+                "date": date,
+                "refunded_transaction_id": original[0],
+            }
+            continue
+        tx_type = "deposit" if rng.random() < 0.4 else "withdrawal"
+        cents = rng.randrange(1, 100000)
+        if len(pool) < REFUND_CANDIDATES:
+            pool.append([tx_id, tx_type, cents])
+        else:
+            pool[rng.randrange(REFUND_CANDIDATES)] = [tx_id, tx_type, cents]
+        yield {
+            "id": tx_id, "bank": bank, "account": account, "type": tx_type,
+            "amount": cents / 100,
+            "description": f"{rng.choice(MERCHANTS)} {rng.randrange(1000)}",
+            "date": date,
+        }
+
+
+def sample_rows(count, seed=0, banks=3, accounts=7, refunds=0.05):
+    return list(generate_rows(count, banks, accounts, refunds, seed))
+
+
+def sample_setup(rows, banks=3, accounts=7):
+    # A setup with every generated account, opening at zero and with the
+    # balance its rows add up to.
+    sums = finance_manager.account_sums(rows)
+    return {"banks": [
+        {"name": f"Bank {b}", "accounts": [
+            {"name": f"Account {a}", "balance": sums.get((f"Bank {b}", f"Account {a}"), 0) / 100,
+             "opening_balance": 0.0}
+            for a in range(accounts)
+        ]}
+        for b in range(banks)
+    ]}
+
+
+@contextlib.contextmanager
+def data_dir(backend):
+    # Runs the block in an empty temporary data directory with `backend`.
+    cwd = os.getcwd()
+    previous_backend = finance_manager.STORAGE_BACKEND
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        finance_manager.STORAGE_BACKEND = backend
+        finance_manager._storage = None
+        try:
+            yield tmp
+        finally:
+            finance_manager._storage = None
+            finance_manager.STORAGE_BACKEND = previous_backend
+            os.chdir(cwd)
+
+
+def measure(run, prepare=None, memory=True):
+    # Wall time of run(), then its peak traced allocation in a second run,
+    # as tracing slows it down. prepare(), if given, restores the starting
+    # state before each run and is not measured.
+    if prepare is not None:
+        prepare()
+    gc.collect()
+    started = time.perf_counter()
+    run()
+    result = {"seconds": round(time.perf_counter() - started, 4)}
+    if memory:
+        if prepare is not None:
+            prepare()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _bytes_per_row(build, rows):
+    # Rows are re-parsed from JSON so no strings are shared with `rows`.
+    payload = json.dumps(rows)
+    gc.collect()
+    tracemalloc.start()
+    data = build(json.loads(payload))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return used / len(rows)
+
+
+def bench_memory(count):
+    rows = sample_rows(count)
+    results = {
+        "dict": _bytes_per_row(lambda data: data, rows),
+        "transaction": _bytes_per_row(
+            lambda data: [finance_manager.Transaction.from_dict(tx) for tx in data], rows
+        ),
+        "columnar": _bytes_per_row(finance_manager.ColumnarTransactions, rows),
+    }
+    return {
+        "rows": count,
+        "bytes_per_row": {name: round(value, 1) for name, value in results.items()},
+        "reduction": {
+            name: round(results["dict"] / value, 2) for name, value in results.items() if name != "dict"
+        },
+    }
+
+
+def bench_import(count, backend="journal"):
+    # Imports a generated CSV statement into an empty data directory, then
+    # re-imports it to time the duplicate check.
+    rows = sample_rows(count)
+    with data_dir(backend):
+        with open("statement.csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Date", "Description", "Amount"])
+            for row in rows:
+                amount = row["amount"] if row["type"] == "deposit" else -row["amount"]
+                writer.writerow([row["date"], row["description"], amount])
+        setup_data = {"banks": [{"name": "Bank", "accounts": [
+            {"name": "Account", "balance": 0.0, "opening_balance": 0.0},
+        ]}]}
+        results = {}
+        for run in ("first", "repeat"):
+            ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+            stats = finance_manager.import_statement_file(setup_data, ledger, "statement.csv", "Bank", "Account")
+            results[run] = {
+                "imported": stats["imported"],
+                "duplicates": stats["duplicates"],
+                "rows_per_second": round(stats["rows_per_second"]),
+            }
+        finance_manager.get_storage().close()
+    return {"rows": count, "backend": backend, **results}
+
+
+def bench_rename(count, backend="journal"):
+    # Renames and deletes the busiest bank of `count` stored rows.
+    rows = sample_rows(count)
+    with data_dir(backend):
+        banks = sorted({row["bank"] for row in rows})
+        setup_data = {"banks": [
+            {"name": bank, "accounts": [
+                {"name": account, "balance": 0.0}
+                for account in sorted({row["account"] for row in rows if row["bank"] == bank})
+            ]}
+            for bank in banks
+        ]}
+        finance_manager.save_setup(setup_data)
+        finance_manager.save_transactions(rows)
+        ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+        results = {"rows": count, "backend": backend}
+
+        started = time.perf_counter()
+        setup_data["banks"][0]["name"] = "Renamed"
+        with finance_manager.get_storage().atomic():
+            ledger.rename_bank(banks[0], "Renamed")
+            finance_manager.save_setup(setup_data)
+        results["rename_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        started = time.perf_counter()
+        setup_data["banks"].pop(0)
+        with finance_manager.get_storage().atomic():
+            deleted = ledger.delete("Renamed")
+            setup_data.setdefault("deleted_account_ids", []).extend(deleted)
+            finance_manager.save_setup(setup_data)
+        results["delete_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        started = time.perf_counter()
+        finance_manager.get_storage().close()  # waits for the background purge
+        results["purge_seconds"] = round(time.perf_counter() - started, 3)
+    return results
+
+
+def bench_views(count, backend="journal"):
+    # First page of a filtered, sorted listing and full exports, streamed from
+    # stored rows. Peak memory leaves out rows the backend already holds
+    # (the journal keeps its state in memory).
+    rows = sample_rows(count)
+    with data_dir(backend):
+        finance_manager.save_transactions(rows)
+        del rows
+        results = {"rows": count, "backend": backend}
+        scenarios = {
+            "first_page": lambda ledger: list(finance_manager.transaction_rows(
+                ledger, bank="Bank 1", limit=finance_manager.VIEW_PAGE_SIZE)),
+            "top_amounts": lambda ledger: list(finance_manager.transaction_rows(
+                ledger, tx_type="withdrawal", sort="amount", reverse=True,
+                limit=finance_manager.VIEW_PAGE_SIZE)),
+        }
+        for fmt, suffix in finance_manager.EXPORT_FORMATS.items():
+            scenarios[f"export_{fmt}"] = lambda ledger, fmt=fmt, suffix=suffix: (
+                finance_manager.export_transactions(ledger.select(), f"export{suffix}", fmt)
+            )
+        for name, run in scenarios.items():
+            results[name] = measure(lambda: run(finance_manager.Ledger(finance_manager.LazyTransactions())))
+        finance_manager.get_storage().close()
+    return results
+
+
+_STARTUP_SCRIPT = """
+import sys, time, json
+started = time.perf_counter()
+import finance_manager
+imported = time.perf_counter()
+finance_manager.STORAGE_BACKEND = sys.argv[1]
+ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+finance_manager.refresh_if_stale(finance_manager.load_setup(), ledger)
+ready = time.perf_counter()
+ledger.load()
+loaded = time.perf_counter()
+ledger.save_caches()
+finance_manager.get_storage().close()
+print(json.dumps({
+    "import_ms": round((imported - started) * 1000, 1),
+    "menu_ms": round((ready - started) * 1000, 1),
+    "load_seconds": round(loaded - ready, 3),
+    "prompt_stack_imported": "questionary" in sys.modules,
+}))
+"""
+
+
+def bench_startup(count, backend="journal"):
+    # Fresh processes over `count` stored rows: time to the first menu, and
+    # to the whole ledger in memory without and then with the snapshot.
+    rows = sample_rows(count)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(finance_manager.__file__)))
+    with data_dir(backend):
+        finance_manager.save_transactions(rows)
+        finance_manager.get_storage().close()
+        del rows
+        results = {"rows": count, "backend": backend}
+        for run in ("cold", "snapshot"):
+            output = subprocess.run(
+                [sys.executable, "-c", _STARTUP_SCRIPT, backend], env=env, check=True,
+                capture_output=True, text=True,
+            ).stdout
+            results[run] = json.loads(output)
+    return results
+
+
+class _Terminal:
+    # Discards output while claiming to be a terminal, so redraws are timed
+    # without the cost of a real one.
+    def isatty(self):
+        return True
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def bench_redraw(count=10000):
+    # One menu redraw (clear the screen, print the header), against the
+    # `clear` subprocess it replaced.
+    stdout = sys.stdout
+    sys.stdout = _Terminal()
+    try:
+        started = time.perf_counter()
+        for _ in range(count):
+            finance_manager.clear_screen()
+            finance_manager.print_header()
+        redraw = time.perf_counter() - started
+    finally:
+        sys.stdout = stdout
+    runs = 20
+    started = time.perf_counter()
+    for _ in range(runs):
+        os.system("clear > /dev/null 2>&1" if os.name != "nt" else "cls")
+    spawn = time.perf_counter() - started
+    return {
+        "redraw_us": round(redraw / count * 1e6, 2),
+        "clear_subprocess_ms": round(spawn / runs * 1000, 2),
+    }
+
+
+def bench_instrumentation(count):
+    # What an instrumented call costs with instrumentation off and on: a
+    # function that does nothing, and indexing `count` new rows.
+    def noop():
+        pass
+
+    wrapped = finance_manager.instrumented("bench.noop")(noop)
+    rows = [finance_manager.Transaction.from_dict(row) for row in sample_rows(count)]
+
+    def run_calls(fn):
+        started = time.perf_counter()
+        for _ in range(count):
+            fn()
+        return (time.perf_counter() - started) / count * 1e9
+
+    def run_index():
+        ledger = finance_manager.Ledger([])
+        ledger.load()
+        started = time.perf_counter()
+        for tx in rows:
+            ledger.add(tx)
+        return time.perf_counter() - started
+
+    results = {"plain_call_ns": round(run_calls(noop), 1)}
+    results["disabled_call_ns"] = round(run_calls(wrapped), 1)
+    results["disabled_index_seconds"] = round(run_index(), 4)
+    instrumentation = finance_manager.enable_instrumentation()
+    try:
+        results["enabled_call_ns"] = round(run_calls(wrapped), 1)
+        results["enabled_index_seconds"] = round(run_index(), 4)
+    finally:
+        instrumentation.samples.clear()  # not worth adding to metrics.json
+        finance_manager.disable_instrumentation()
+    return results
+
+
+def bench_money(count):
+    # Reconciling every account: per-account sums in integer cents against
+    # the same sums in Decimal, plus the error a running float sum picks up.
+    rows = [finance_manager.Transaction.from_dict(row) for row in sample_rows(count)]
+    started = time.perf_counter()
+    cents = finance_manager.account_sums(rows)
+    cents_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    decimals = {}
+    for tx in rows:
+        key = (tx["bank"], tx["account"])
+        amount = decimal.Decimal(str(tx["amount"]))
+        decimals[key] = decimals.get(key, 0) + (amount if tx["type"] == "deposit" else -amount)
+    decimal_seconds = time.perf_counter() - started
+    floats = {}
+    for tx in rows:
+        key = (tx["bank"], tx["account"])
+        floats[key] = floats.get(key, 0.0) + (tx["amount"] if tx["type"] == "deposit" else -tx["amount"])
+    return {
+        "rows": count,
+        "cents_ms": round(cents_seconds * 1000, 2),
+        "decimal_ms": round(decimal_seconds * 1000, 2),
+        "matches_decimal": all(decimals[key] * 100 == value for key, value in cents.items()),
+        "float_max_error": max(abs(floats[key] - value / 100) for key, value in cents.items()),
+    }
+
+
+def bench_refunds(count, lookups=1000):
+    # Amount left to refund of random transactions, from the refund index
+    # against scanning the ledger for refund rows, over a ledger where a
+    # tenth of the rows are partial refunds.
+    rows = sample_rows(count, refunds=0.1)
+    rng = random.Random(1)
+    ledger = finance_manager.Ledger([finance_manager.as_transaction(row) for row in rows])
+    started = time.perf_counter()
+    ledger.load()
+    index_seconds = time.perf_counter() - started
+    ids = [rng.choice(rows)["id"] for _ in range(lookups)]
+    started = time.perf_counter()
+    indexed = [ledger.refundable_cents(tx_id) for tx_id in ids]
+    lookup_seconds = time.perf_counter() - started
+    scans = ids[:10]
+    started = time.perf_counter()
+    scanned = [
+        finance_manager.amount_cents(ledger.get(tx_id))
+        - sum(finance_manager.amount_cents(tx) for tx in ledger if tx.get("refunded_transaction_id") == tx_id)
+        for tx_id in scans
+    ]
+    scan_seconds = time.perf_counter() - started
+    assert scanned == indexed[:10]
+    return {
+        "rows": count,
+        "index_build_seconds": round(index_seconds, 3),
+        "indexed_lookup_us": round(lookup_seconds / lookups * 1e6, 2),
+        "scan_lookup_ms": round(scan_seconds / len(scans) * 1000, 2),
+    }
+
+
+def bench_audit(count, backend="journal", workers=(1, 2, 4, 8)):
+    # Full-ledger audit at each worker count. Reading the rows is the same
+    # serial pass whatever the count, so it is timed on its own and the
+    # audits are given the rows already read.
+    rows = sample_rows(count)
+    setup_data = sample_setup(rows)
+    with data_dir(backend):
+        finance_manager.save_transactions(rows)
+        del rows
+        started = time.perf_counter()
+        stored = list(finance_manager.iter_transactions())
+        results = {
+            "rows": count, "backend": backend, "cores": os.cpu_count(),
+            "read_seconds": round(time.perf_counter() - started, 3),
+        }
+        for count_ in workers:
+            started = time.perf_counter()
+            audit = finance_manager.audit_ledger(setup_data, count_, stored)
+            seconds = time.perf_counter() - started
+            assert not audit["drift"] and not audit["anomalies"]
+            results[f"workers_{count_}"] = {
+                "seconds": round(seconds, 3),
+                "speedup": round(results[f"workers_{workers[0]}"]["seconds"] / seconds, 2)
+                if count_ != workers[0] else 1.0,
+            }
+        finance_manager.get_storage().close()
+    return results
+
+
+def bench_operations(count, backend="journal", banks=3, accounts=7, refunds=0.05, memory=True):
+    # Time and peak memory of each data operation over a generated ledger of
+    # `count` rows. Operations that change the data start from a freshly
+    # written copy each time.
+    rows = sample_rows(count, banks=banks, accounts=accounts, refunds=refunds)
+    setup_data = sample_setup(rows, banks, accounts)
+    month = rows[len(rows) // 2]["date"][:7]
+
+    def clear():
+        finance_manager.get_storage().close()
+        for name in os.listdir("."):
+            os.remove(name)
+        finance_manager._storage = None
+        finance_manager.save_setup(setup_data)
+
+    def save():
+        finance_manager.save_transactions(rows)
+        finance_manager.get_storage().close()  # flushes the write to disk
+
+    def write():
+        clear()
+        save()
+
+    def lazy():
+        return finance_manager.Ledger(finance_manager.LazyTransactions())
+
+    def view(**selection):
+        return lambda: list(finance_manager.transaction_rows(lazy(), **selection))
+
+    def rename():
+        setup = finance_manager.load_setup()
+        setup["banks"][0]["name"] = "Renamed"
+        with finance_manager.get_storage().atomic():
+            lazy().rename_bank("Bank 0", "Renamed")
+            finance_manager.save_setup(setup)
+        finance_manager.get_storage().close()
+
+    def delete():
+        setup = finance_manager.load_setup()
+        setup["banks"].pop(0)
+        with finance_manager.get_storage().atomic():
+            setup.setdefault("deleted_account_ids", []).extend(lazy().delete("Bank 0"))
+            finance_manager.save_setup(setup)
+        finance_manager.get_storage().close()  # waits for the background purge
+
+    def post():
+        setup = finance_manager.load_setup()
+        ledger = lazy()
+        tx = finance_manager.post_transaction(setup, ledger, "Bank 0", "Account 0", "deposit", 1, "Benchmark")
+        finance_manager.commit_changes(setup, ledger, changed=[tx])
+
+    loaded = {}
+
+    def load_ledger():
+        loaded["ledger"] = lazy().load()
+
+    scenarios = {
+        "save_transactions": (save, clear),
+        "load_transactions": (finance_manager.load_transactions, None),
+        "ledger_load": (load_ledger, None),
+        "post_transaction": (post, None),
+        "view_bank_page": (view(bank="Bank 1", limit=finance_manager.VIEW_PAGE_SIZE), None),
+        "view_account": (view(bank="Bank 0", account="Account 0"), None),
+        "view_month": (view(since=month, until=month + "\uffff"), None),
+        "view_amount_range": (view(min_amount=100, max_amount=200), None),
+        "view_search": (view(query="coffee"), None),
+        "view_top_amounts": (view(sort="amount", reverse=True, limit=finance_manager.VIEW_PAGE_SIZE), None),
+        "balance_integrity": (lambda: finance_manager.check_balance_integrity(finance_manager.load_setup()), None),
+        "balance_at": (lambda: finance_manager.balance_at(
+            setup_data, loaded["ledger"], "Bank 0", "Account 0", month + "-15"), None),
+        "rename_bank": (rename, write),
+        "delete_bank": (delete, write),
+    }
+    results = {"rows": count, "backend": backend, "banks": banks, "accounts": accounts, "refunds": refunds}
+    with data_dir(backend):
+        write()
+        for name, (run, prepare) in scenarios.items():
+            results[name] = measure(run, prepare, memory=memory)
+        finance_manager.get_storage().close()
+    return results
+
+
+def bench_reports(count):
+    # Aggregation time over a prebuilt frame, separate from loading the rows into it.
+    rows = sample_rows(count)
+    started = time.perf_counter()
+    frame = finance_manager.report_frame(rows)
+    results = {"rows": count, "build_seconds": round(time.perf_counter() - started, 3)}
+    for name, report in finance_manager.REPORTS.items():
+        started = time.perf_counter()
+        report(frame)
+        results[f"{name}_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return results
+
+
+# Benchmarks by name, each run as fn(count, args).
+BENCHMARKS = {
+    "operations": lambda count, args: bench_operations(
+        count, args.backend, args.banks, args.accounts, args.refunds, not args.no_memory),
+    "memory": lambda count, args: bench_memory(count),
+    "import": lambda count, args: bench_import(count, args.backend),
+    "reports": lambda count, args: bench_reports(count),
+    "money": lambda count, args: bench_money(count),
+    "refunds": lambda count, args: bench_refunds(count),
+    "audit": lambda count, args: bench_audit(count, args.backend),
+    "rename": lambda count, args: bench_rename(count, args.backend),
+    "views": lambda count, args: bench_views(count, args.backend),
+    "startup": lambda count, args: bench_startup(count, args.backend),
+    "redraw": lambda count, args: bench_redraw(),
+    "instrumentation": lambda count, args: bench_instrumentation(count),
+}
+
+# Result fields that measure a cost, so a larger value is a regression.
+COST_SUFFIXES = ("seconds", "_ms", "_us", "peak_mb", "bytes_per_row")
+
+
+def _revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _costs(results, path=()):
+    # (path, value) for every cost in a results tree.
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _costs(value, path + (key,))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key.endswith(COST_SUFFIXES):
+            yield path + (key,), value
+
+
+def compare_results(before, after, threshold=0.2):
+    # Costs present in both result files that changed by more than
+    # `threshold` (as a fraction of the old value), worst first, as
+    # ("<rows>/<benchmark>/...", old, new, ratio).
+    old = dict(_costs(before["runs"]))
+    changes = []
+    for path, value in _costs(after["runs"]):
+        previous = old.get(path)
+        if not previous:
+            continue
+        ratio = value / previous
+        if abs(ratio - 1) > threshold:
+            changes.append(("/".join(path), previous, value, round(ratio, 2)))
+    return sorted(changes, key=lambda change: change[3], reverse=True)
+
+
+def _count(text):
+    # Row counts may be written as 100000, 100_000 or 1e5.
+    return int(float(text.replace("_", "")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Finance Manager benchmarks")
+    parser.add_argument("--rows", type=_count, nargs="+", default=[100000],
+                        help="ledger sizes to run at, e.g. 1e3 1e5 1e7")
+    parser.add_argument("--backend", default="journal", choices=("json", "journal", "sqlite"))
+    parser.add_argument("--banks", type=int, default=3)
+    parser.add_argument("--accounts", type=int, default=7, help="accounts per bank")
+    parser.add_argument("--refunds", type=float, default=0.05, help="share of rows that are refunds")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="default: all")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced runs of each operation")
+    parser.add_argument("--output", help="write the JSON results here as well as to stdout")
+    parser.add_argument("--compare", help="results file of an earlier run to report changes against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="smallest relative change --compare reports (default: 0.2)")
+    args = parser.parse_args(argv)
+    results = {
+        "meta": {
+            "revision": _revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cores": os.cpu_count(),
+            "started": datetime.datetime.now().isoformat(timespec="seconds"),
+            "backend": args.backend, "banks": args.banks, "accounts": args.accounts, "refunds": args.refunds,
+        },
+        "runs": {},
+    }
+    for count in args.rows:
+        results["runs"][str(count)] = {name: BENCHMARKS[name](count, args) for name in args.only or BENCHMARKS}
+    json.dump(results, sys.stdout, indent=4)
+    print()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+        changes = compare_results(before, results, args.threshold)
+        print(f"Compared with {before['meta'].get('revision')}: {len(changes)} changes over "
+              f"{args.threshold:.0%}", file=sys.stderr)
+        for path, old, new, ratio in changes:
+            print(f"  {'slower' if ratio > 1 else 'faster'} x{ratio}: {path} {old} -> {new}", file=sys.stderr)
+        if any(ratio > 1 for *_, ratio in changes):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,83 +1,4673 @@
 import os
+import re
+import sys
+import zlib
+import math
+import time
+import marshal
+import array
 import json
+import bisect
+import heapq
+import functools
+import itertools
 import uuid
 import datetime
-import questionary
+import threading
+import importlib
+import contextlib
+import atexit
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class _LazyModule:
+    # Stands in for a module that is slow to import, so headless commands
+    # never load the prompt stack or NumPy. The module is imported on first
+    # attribute access and looked up each time, so patches to it are seen.
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+def _importable(module):
+    try:
+        importlib.import_module(module._name)
+    except ImportError:
+        return False
+    return True
+
+
+questionary = _LazyModule("questionary")
+asyncio = _LazyModule("asyncio")  # only needed by the API server
+np = _LazyModule("numpy")  # only needed for reports
+multiprocessing = _LazyModule("multiprocessing")  # only needed by the audit
+futures = _LazyModule("concurrent.futures")
+cProfile = _LazyModule("cProfile")  # only needed when profiling
+tracemalloc = _LazyModule("tracemalloc")
+# Only needed by the backends, commands or file formats that use them, so
+# the interactive menu never pays for them.
+sqlite3 = _LazyModule("sqlite3")
+csv = _LazyModule("csv")
+mmap = _LazyModule("mmap")
+hashlib = _LazyModule("hashlib")
+decimal = _LazyModule("decimal")
+argparse = _LazyModule("argparse")
+urllib_parse = _LazyModule("urllib.parse")
 
 # File paths for persistent data
 SETUP_FILE = "setup.json"
 TRANSACTION_FILE = "transactions.json"
+JOURNAL_FILE = "transactions.jsonl"
+DATABASE_FILE = "finance.db"
+WAL_FILE = "commit.wal"
+LOCK_FILE = "finance.lock"
+
+# Storage backend: "json" (single file), "journal" (append-only) or "sqlite"
+STORAGE_BACKEND = os.environ.get("FINANCE_MANAGER_STORAGE", "json")
+
+
+# Cursor home, clear the screen, clear the scrollback: what `clear` sends.
+_CLEAR_SCREEN = "\033[H\033[2J\033[3J"
+_HEADER = "=" * 60 + "\n" + "      $$$  Money Maestro - Finance Manager CLI  $$$\n" + "=" * 60 + "\n\n"
+_ansi_enabled = None
+
+
+def _enable_ansi():
+    # Windows consoles interpret escape sequences only once asked to.
+    global _ansi_enabled
+    if _ansi_enabled is None:
+        _ansi_enabled = True
+        if os.name == "nt":
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+            mode = ctypes.c_uint32()
+            _ansi_enabled = bool(
+                kernel32.GetConsoleMode(handle, ctypes.byref(mode))
+                and kernel32.SetConsoleMode(handle, mode.value | 0x0004)  # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+            )
+    return _ansi_enabled
+
+
+def clear_screen():
+    # Written straight to the terminal rather than spawning `clear` on every
+    # redraw; output that is not a terminal is left alone.
+    if not sys.stdout.isatty():
+        return
+    if _enable_ansi():
+        sys.stdout.write(_CLEAR_SCREEN)
+        sys.stdout.flush()
+    else:
+        os.system("cls")
+
+
+def print_header():
+    sys.stdout.write(_HEADER)
+
+
+# --- Instrumentation ---
+# Opt-in measurements of the operations that make the app feel slow:
+# loading and saving, filtering, index maintenance and menu redraws.
+# FINANCE_MANAGER_METRICS=1 (or --metrics) records the time of each call,
+# and the net allocated memory blocks of every BLOCKS_EVERY-th call (the
+# count walks the whole heap). Lazily iterated results are timed across
+# their iteration, without a block count. FINANCE_MANAGER_PROFILE (or
+# --profile) set to "cprofile" and/or "tracemalloc" also writes a profile
+# of every outermost eager operation to PROFILE_DIR. At exit the samples
+# are added to METRICS_FILE, which keeps the latest METRICS_WINDOW of each
+# operation with their p50 and p99. While disabled, an instrumented call
+# costs one extra function call and a global lookup.
+
+METRICS_FILE = "metrics.json"
+PROFILE_DIR = "profiles"
+METRICS_WINDOW = 1000
+BLOCKS_EVERY = 16
+PROFILERS = ("cprofile", "tracemalloc")
+
+_instrumentation = None
+_NOT_MEASURED = contextlib.nullcontext()
+_CO_GENERATOR = 0x20  # inspect.CO_GENERATOR, without importing inspect
+
+
+def _percentile(ordered, fraction):
+    # Nearest-rank percentile of a sorted, non-empty list.
+    return ordered[max(0, math.ceil(len(ordered) * fraction) - 1)]
+
+
+def metrics_summary(samples):
+    # {"count", "p50_ms", "p99_ms", "max_ms", "mean_blocks"} of [ms, blocks]
+    # samples; blocks are None where they were not counted.
+    ordered = sorted(ms for ms, _ in samples)
+    blocks = [blocks for _, blocks in samples if blocks is not None]
+    return {
+        "count": len(samples),
+        "p50_ms": round(_percentile(ordered, 0.5), 3),
+        "p99_ms": round(_percentile(ordered, 0.99), 3),
+        "max_ms": round(ordered[-1], 3),
+        "mean_blocks": round(sum(blocks) / len(blocks)) if blocks else None,
+    }
+
+
+class Instrumentation:
+    def __init__(self, profilers=()):
+        unknown = set(profilers) - set(PROFILERS)
+        if unknown:
+            raise ValueError(f"Unknown profiler(s): {', '.join(sorted(unknown))}")
+        self.profilers = tuple(profilers)
+        self.samples = {}  # operation -> [[ms, blocks], ...]
+        self.calls = {}  # operation -> calls so far
+        self._local = threading.local()  # nesting depth per thread
+
+    def count_blocks(self, name):
+        calls = self.calls.get(name, 0)
+        self.calls[name] = calls + 1
+        return calls % BLOCKS_EVERY == 0
+
+    def record(self, name, seconds, blocks):
+        self.samples.setdefault(name, []).append([round(seconds * 1000, 3), blocks])
+
+    def flush(self):
+        # Adds this process's samples to the rolling metrics file.
+        samples, self.samples = self.samples, {}
+        if not samples:
+            return
+        try:
+            with open(METRICS_FILE, "r") as f:
+                operations = json.load(f).get("operations", {})
+        except (FileNotFoundError, ValueError):
+            operations = {}
+        for name, new in samples.items():
+            window = (operations.get(name, {}).get("samples", []) + new)[-METRICS_WINDOW:]
+            operations[name] = {**metrics_summary(window), "samples": window}
+        tmp_file = METRICS_FILE + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"updated": datetime.datetime.now().isoformat(), "operations": operations}, f)
+        os.replace(tmp_file, METRICS_FILE)
+
+
+class _Operation:
+    # One measured call. Only the outermost operation of a thread is profiled.
+    __slots__ = ("name", "outermost", "profile", "tracing", "blocks", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        local = _instrumentation._local
+        depth = getattr(local, "depth", 0)
+        local.depth = depth + 1
+        self.outermost = depth == 0 and threading.current_thread() is threading.main_thread()
+        self.profile = None
+        self.tracing = False
+        if self.outermost and _instrumentation.profilers:
+            # Tracing someone else started (a benchmark, say) is left running.
+            if "tracemalloc" in _instrumentation.profilers and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            if "cprofile" in _instrumentation.profilers:
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+        self.blocks = sys.getallocatedblocks() if _instrumentation.count_blocks(self.name) else None
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        blocks = None if self.blocks is None else sys.getallocatedblocks() - self.blocks
+        _instrumentation._local.depth -= 1
+        if self.outermost and _instrumentation.profilers:
+            self._save_profiles()
+        _instrumentation.record(self.name, seconds, blocks)
+        return False
+
+    def _save_profiles(self):
+        # Both profilers are stopped before anything is written, so the
+        # files describe the operation rather than the saving.
+        if self.profile is not None:
+            self.profile.disable()
+        if self.tracing:
+            ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            if self.profile is not None:
+                ignored.append(tracemalloc.Filter(False, cProfile.__file__))
+            snapshot = tracemalloc.take_snapshot().filter_traces(ignored)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stem = os.path.join(
+            PROFILE_DIR, f"{self.name}-{datetime.datetime.now():%Y%m%dT%H%M%S%f}-{os.getpid()}"
+        )
+        if self.profile is not None:
+            self.profile.dump_stats(stem + ".prof")
+        if self.tracing:
+            with open(stem + ".alloc.txt", "w") as f:
+                f.write(f"{self.name}: peak {peak} bytes, {current} bytes still allocated\n")
+                for stat in snapshot.statistics("lineno")[:25]:
+                    f.write(f"{stat}\n")
+
+def measure(name):
+    # Context manager that records the block as operation `name`.
+    return _NOT_MEASURED if _instrumentation is None else _Operation(name)
+
+
+_END = object()
+
+
+def _measured_iter(name, iterator, seconds=0.0):
+    # Times an iterator across the next() calls that drive it (plus the
+    # `seconds` it took to create), recorded once it is exhausted or closed.
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator, _END)
+            finally:
+                seconds += time.perf_counter() - started
+            if item is _END:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+        if _instrumentation is not None:
+            _instrumentation.record(name, seconds, None)
+
+
+def instrumented(name, lazy=False):
+    # Decorator recording each call as operation `name`. Generators, and
+    # with lazy=True functions returning an iterable, are timed while their
+    # result is iterated.
+    def decorate(fn):
+        generator = bool(fn.__code__.co_flags & _CO_GENERATOR)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _instrumentation is None:
+                return fn(*args, **kwargs)
+            if generator:
+                return _measured_iter(name, fn(*args, **kwargs))
+            if lazy:
+                started = time.perf_counter()
+                rows = iter(fn(*args, **kwargs))
+                return _measured_iter(name, rows, time.perf_counter() - started)
+            with _Operation(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def load_metrics():
+    # {operation: summary} from METRICS_FILE, without the raw samples.
+    try:
+        with open(METRICS_FILE, "r") as f:
+            operations = json.load(f).get("operations", {})
+    except FileNotFoundError:
+        return {}
+    return {
+        name: {key: value for key, value in summary.items() if key != "samples"}
+        for name, summary in sorted(operations.items())
+    }
+
+
+def format_metrics(operations):
+    if not operations:
+        return ["No metrics recorded yet; run with --metrics or FINANCE_MANAGER_METRICS=1."]
+    width = max(len(name) for name in operations)
+    lines = [f"{'Operation':<{width}}  {'Calls':>7}  {'p50 ms':>9}  {'p99 ms':>9}  {'Max ms':>9}  {'Blocks':>8}"]
+    for name, summary in operations.items():
+        lines.append(
+            f"{name:<{width}}  {summary['count']:>7}  {summary['p50_ms']:>9.3f}  {summary['p99_ms']:>9.3f}  "
+            f"{summary['max_ms']:>9.3f}  {'-' if summary['mean_blocks'] is None else summary['mean_blocks']:>8}"
+        )
+    return lines
+
+
+def enable_instrumentation(profilers=()):
+    global _instrumentation
+    if _instrumentation is not None:
+        _instrumentation.flush()
+    atexit.unregister(disable_instrumentation)
+    atexit.register(disable_instrumentation)
+    _instrumentation = Instrumentation(profilers)
+    return _instrumentation
+
+
+def disable_instrumentation():
+    # Stops measuring and writes what was recorded.
+    global _instrumentation
+    instrumentation, _instrumentation = _instrumentation, None
+    if instrumentation is not None:
+        instrumentation.flush()
+
+
+if os.environ.get("FINANCE_MANAGER_METRICS") or os.environ.get("FINANCE_MANAGER_PROFILE"):
+    enable_instrumentation([
+        name.strip() for name in os.environ.get("FINANCE_MANAGER_PROFILE", "").split(",") if name.strip()
+    ])
+
+
+# --- Storage Backends ---
+
+_JSON_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def _iter_json_array(path, chunk_size=64 * 1024):
+    # Decodes a JSON array one element at a time, holding at most a chunk or
+    # one element of the file in memory.
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer:
+            return
+        if buffer[0] != "[":
+            raise ValueError(f"{path} does not contain a JSON array")
+        pos = 1
+        while True:
+            pos = _JSON_SEPARATORS.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+
+
+def _matches(tx, bank=None, account=None):
+    return (bank is None or tx["bank"] == bank) and (account is None or tx["account"] == account)
+
+
+def is_loaded(transactions):
+    return getattr(transactions, "loaded", True)
+
+
+class LazyTransactions(list):
+    # Transaction list that is only read from storage the first time an
+    # operation needs the whole ledger. Until then views stream from storage.
+    # The rows come from the ledger snapshot when it is current.
+    def __init__(self):
+        super().__init__()
+        self.loaded = False
+        self.stamp = None  # generation the rows were loaded at
+        self.snapshot = None  # generation of the snapshot file, if current
+
+    @instrumented("ledger.read")
+    def load(self):
+        if not self.loaded:
+            self.snapshot = snapshot_generation()
+            rows = load_snapshot() if self.snapshot is not None else None
+            if rows is None:
+                self.snapshot = None
+                # Read before loading: a commit made meanwhile makes the stamp invalid, not wrong.
+                generation = get_storage().generation()
+                rows = [as_transaction(tx) for tx in load_transactions()]
+            else:
+                generation = self.snapshot
+            self[:] = rows
+            self.stamp = StorageStamp(generation)
+            self.loaded = True
+        return self
+
+    def save_snapshot(self):
+        # Skipped when nothing changed since the snapshot, or when another
+        # process has committed since the rows were loaded.
+        if not self.loaded or not self.stamp.sync() or self.stamp.generation == self.snapshot:
+            return
+        save_snapshot(self, self.stamp.generation)
+        self.snapshot = self.stamp.generation
+
+
+def ensure_loaded(transactions):
+    if not is_loaded(transactions):
+        transactions.load()
+    return transactions
+
+
+def _fsync_directory(path):
+    # Makes a rename durable; directories cannot be opened for this on Windows.
+    if os.name == "nt":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_atomic(path, write):
+    # Readers see either the old file or the complete new one, never a torn write.
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+    _fsync_directory(path)
+
+
+def _acquire_file_lock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    # msvcrt locks are mandatory, so lock a byte past the generation counter.
+    os.lseek(fd, 64, os.SEEK_SET)
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _release_file_lock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return
+    os.lseek(fd, 64, os.SEEK_SET)
+    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def _setup_layout(setup_data):
+    return [(bank["name"], [account["name"] for account in bank["accounts"]]) for bank in setup_data["banks"]]
+
+
+def _account_key(bank, account):
+    # Accounts are matched by id, so a rename on one side still merges.
+    return account.get("id") or (bank["name"], account["name"])
+
+
+def merge_setup(base, ours, theirs):
+    # Three-way merge of a stale in-memory setup (`ours`, loaded as `base`)
+    # with the one another process committed since (`theirs`), applied to
+    # `ours` in place. Balances keep both sides' changes; bank/account
+    # changes are taken from whichever side made them. Returns True if the
+    # bank/account lists were replaced.
+    accounts = [
+        {_account_key(bank, account): account for bank in setup["banks"] for account in bank["accounts"]}
+        for setup in (base, ours, theirs)
+    ]
+    base_accounts, our_accounts, their_accounts = accounts
+    layout = _setup_layout(ours)
+    if layout == _setup_layout(base):
+        merged = json.loads(json.dumps(theirs["banks"]))
+    elif _setup_layout(theirs) == _setup_layout(base):
+        merged = ours["banks"]
+    else:
+        raise ValueError("Banks or accounts were changed by another session; reload and try again")
+    balances = {}
+    for bank in merged:
+        for account in bank["accounts"]:
+            key = _account_key(bank, account)
+            if key in base_accounts and key in our_accounts and key in their_accounts:
+                balances[key] = (
+                    to_cents(their_accounts[key]["balance"]) + to_cents(our_accounts[key]["balance"])
+                    - to_cents(base_accounts[key]["balance"])
+                ) / 100
+            else:
+                balances[key] = account["balance"]
+    for key in theirs.keys() - {"banks"}:
+        if ours.get(key) == base.get(key):
+            ours[key] = theirs[key]
+    if _setup_layout({"banks": merged}) == layout:
+        # Same accounts: update the balances in place so references stay valid.
+        for key, account in our_accounts.items():
+            account["balance"] = balances[key]
+        return False
+    for bank in merged:
+        for account in bank["accounts"]:
+            account["balance"] = balances[_account_key(bank, account)]
+    ours["banks"] = merged
+    return True
+
+
+# Transaction rows reference accounts by the stable id each bank and account
+# gets in the setup, so names live only there: renaming rewrites one setup
+# record, and deleting drops the accounts and lists their ids under
+# "deleted_account_ids", which hides their rows until a background purge
+# removes them. Rows of accounts without an id (data written before ids, or
+# accounts missing from the setup) keep their bank and account names.
+
+
+def _new_id(name, used):
+    # Derived from the name, so processes assigning ids to the same setup
+    # agree; ids in use or deleted are skipped, so a re-created account
+    # never picks up an old one's rows.
+    for n in itertools.count():
+        new_id = uuid.uuid5(uuid.NAMESPACE_URL, f"finance-manager:{name}#{n}").hex
+        if new_id not in used:
+            used.add(new_id)
+            return new_id
+
+
+def assign_account_ids(setup_data):
+    # Gives every bank and account without one an id. Returns True if any was assigned.
+    used = set(setup_data.get("deleted_account_ids", ()))
+    for bank in setup_data["banks"]:
+        used.update(item["id"] for item in [bank] + bank["accounts"] if "id" in item)
+    assigned = False
+    for bank in setup_data["banks"]:
+        if "id" not in bank:
+            bank["id"] = _new_id(bank["name"], used)
+            assigned = True
+        for account in bank["accounts"]:
+            if "id" not in account:
+                account["id"] = _new_id(f"{bank['name']}/{account['name']}", used)
+                assigned = True
+    return assigned
+
+
+class AccountDirectory:
+    # Account id <-> (bank, account) names, as of the last setup loaded or
+    # saved. Ledger renames and deletes update it straight away, so rows read
+    # before the setup is saved already carry the new names.
+    def __init__(self, setup_data=None):
+        self._names = {}  # account id -> (bank, account)
+        self._ids = {}  # (bank, account) -> account id
+        for bank in (setup_data or {}).get("banks", ()):
+            for account in bank["accounts"]:
+                if "id" in account:
+                    self._names[account["id"]] = (bank["name"], account["name"])
+                    self._ids[(bank["name"], account["name"])] = account["id"]
+
+    def account_id(self, bank, account):
+        return self._ids.get((bank, account))
+
+    def names(self, account_id):
+        return self._names.get(account_id)
+
+    def account_ids(self, bank, account=None):
+        return [
+            account_id for (bank_name, account_name), account_id in self._ids.items()
+            if bank_name == bank and (account is None or account_name == account)
+        ]
+
+    def rename(self, bank, new_bank, account=None, new_account=None):
+        # Returns the ids of the renamed accounts.
+        renamed = self.account_ids(bank, account)
+        for account_id in renamed:
+            del self._ids[self._names[account_id]]
+        for account_id in renamed:
+            account_name = self._names[account_id][1] if account is None else new_account
+            self._names[account_id] = (new_bank, account_name)
+            self._ids[(new_bank, account_name)] = account_id
+        return renamed
+
+    def delete(self, bank, account=None):
+        # Returns the ids of the deleted accounts; their rows are hidden from now on.
+        deleted = self.account_ids(bank, account)
+        for account_id in deleted:
+            del self._ids[self._names.pop(account_id)]
+        return deleted
+
+
+def _storage_row(tx, directory):
+    # The row as written: bank and account names replaced by the account id when it has one.
+    if "account_id" in tx:
+        return tx
+    account_id = directory.account_id(tx["bank"], tx["account"])
+    if account_id is None:
+        return tx
+    row = {"id": tx["id"], "account_id": account_id}
+    row.update((key, value) for key, value in tx.items() if key not in ("id", "bank", "account"))
+    return row
+
+
+def _resolve_row(row, directory):
+    # The row with its account id replaced by names, or None if the account is gone.
+    account_id = row.get("account_id")
+    if account_id is None:
+        return row
+    names = directory.names(account_id)
+    if names is None:
+        return None
+    tx = {"id": row["id"], "bank": names[0], "account": names[1]}
+    tx.update((key, value) for key, value in row.items() if key not in ("id", "account_id"))
+    return tx
+
+
+def _resolve_rows(rows, directory):
+    for row in rows:
+        tx = _resolve_row(row, directory)
+        if tx is not None:
+            yield tx
+
+
+def _dump_rows(f, rows):
+    # Same layout as json.dump(..., indent=4), one row at a time.
+    f.write("[")
+    first = True
+    for tx in rows:
+        f.write("\n    " if first else ",\n    ")
+        f.write(json.dumps(tx, indent=4, default=_to_json).replace("\n", "\n    "))
+        first = False
+    f.write("]" if first else "\n]")
+
+
+class JsonStorage:
+    # Keeps every transaction in one JSON array and the setup in setup.json.
+    # Commits are appended to a write-ahead log (commit.wal), one checksummed
+    # line holding the setup and the changed rows of both files, and fsynced.
+    # The data files are only rewritten (temp file + fsync + rename) when the
+    # log is checkpointed: once it passes CHECKPOINT_BYTES, before reading,
+    # and on close. A save of the whole ledger is the exception: its rows are
+    # written once to a side file and the log record only names it, so the
+    # checkpoint renames it into place instead of copying every row twice.
+    # Opening the storage replays complete commits left in the log; a torn or
+    # corrupt last line is an unfinished commit and is dropped.
+    #
+    # Several processes may share the files. Writers take an advisory lock on
+    # finance.lock, which also holds a generation counter bumped by every
+    # commit. A commit made from a setup loaded at an older generation is
+    # merged with the newer one on disk (see merge_setup) rather than
+    # overwriting it. Readers take no lock: data files are only ever
+    # replaced whole, and a checkpoint only locks while it has log to apply.
+    # Rows of deleted accounts are dropped whenever the file is rewritten.
+    name = "json"
+    rewrites_ledger = True
+
+    CHECKPOINT_BYTES = 4 * 1024 * 1024
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._wal = None
+        self._wal_bytes = 0
+        self._appended = 0  # log records written / known to be on disk
+        self._synced = 0
+        self._staged = None  # changes collected by the open atomic() block
+        self._lock_fd = None
+        self._lock_depth = 0
+        self._generation = None  # generation the in-memory setup was loaded at
+        self._setup_base = None  # that setup as loaded, for three-way merges
+        self.merged = False  # whether the last commit merged another process's changes
+        self.commits = 0  # commits made by this process
+        self.directory = None  # AccountDirectory, read from the setup on first use
+        self._purger = None
+        self.checkpoint()
+
+    def _open_lock_file(self):
+        if self._lock_fd is None:
+            self._lock_fd = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT)
+        return self._lock_fd
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Exclusive across threads and processes; re-entrant within a thread.
+        with self._lock:
+            if not self._lock_depth:
+                _acquire_file_lock(self._open_lock_file())
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if not self._lock_depth:
+                    _release_file_lock(self._lock_fd)
+
+    def _read_generation(self):
+        with self._lock:
+            fd = self._open_lock_file()
+            os.lseek(fd, 0, os.SEEK_SET)
+            data = os.read(fd, 20)
+        return int(data) if data.strip() else 0
+
+    def _write_generation(self, generation):
+        os.lseek(self._lock_fd, 0, os.SEEK_SET)
+        os.write(self._lock_fd, b"%020d" % generation)
+
+    def is_stale(self):
+        # True once another process has committed since the setup was loaded.
+        return self._generation is not None and self._read_generation() != self._generation
+
+    def generation(self):
+        # Persistent count of commits by every process; each commit adds exactly one.
+        return self._read_generation()
+
+    def data_files(self):
+        # Files the loaded rows are read from (see load_snapshot).
+        return (SETUP_FILE, TRANSACTION_FILE)
+
+    @contextlib.contextmanager
+    def atomic(self):
+        # Every save made inside the block is committed as one log record.
+        with self._lock:
+            outer = self._staged is None
+            if outer:
+                self._staged = {}
+                self.merged = False
+            try:
+                yield
+            except BaseException:
+                if outer:
+                    self._staged = None
+                    self._rollback()
+                raise
+            if not outer:
+                return
+            staged, self._staged = self._staged, None
+            seq = None
+            if staged:
+                with self._locked():
+                    try:
+                        seq = self._commit(staged)
+                    except BaseException:
+                        self._rollback()
+                        raise
+        if seq is not None:
+            self._sync(seq)
+            if self._wal_bytes > self.CHECKPOINT_BYTES:
+                self.checkpoint()
+
+    def _commit(self, staged):
+        generation = self._read_generation()
+        stale = self._generation is not None and generation != self._generation
+        self.merged = stale
+        if stale:
+            self._merge(staged)
+        seq = self._log(self._commit_record(staged))
+        self._write_generation(generation + 1)
+        self.commits += 1
+        if "setup" in staged:
+            self._generation = generation + 1
+            self._setup_base = json.loads(json.dumps(staged["setup"]))
+        elif not stale:
+            self._generation = generation + 1
+        return seq
+
+    def _merge(self, staged):
+        if "full" in staged:
+            raise ValueError("Transactions were changed by another session; reload before saving them all")
+        if "setup" in staged and self._setup_base is not None:
+            self.checkpoint()
+            merge_setup(self._setup_base, staged["setup"], self._read_setup())
+
+    def _commit_record(self, staged):
+        directory = self.account_directory()
+        record = {}
+        if "setup" in staged:
+            record["setup"] = staged["setup"]
+        if "full" in staged:
+            # Durable before the record that commits it is logged.
+            record["full_file"] = f"{TRANSACTION_FILE}.{uuid.uuid4().hex}.full"
+            rows = (_storage_row(tx, directory) for tx in staged["full"])
+            _write_atomic(record["full_file"], lambda f: _dump_rows(f, rows))
+        if staged.get("put"):
+            record["put"] = [_storage_row(tx, directory) for tx in staged["put"].values()]
+        if staged.get("del"):
+            record["del"] = sorted(staged["del"])
+        return record
+
+    def _rollback(self):
+        pass
+
+    def _log(self, record):
+        data = json.dumps(record, separators=(",", ":"), default=_to_json).encode("utf-8")
+        line = b"%08x %s\n" % (zlib.crc32(data), data)
+        if self._wal is None:
+            self._wal = open(WAL_FILE, "ab")
+        self._wal.write(line)
+        self._wal.flush()
+        self._wal_bytes += len(line)
+        self._appended += 1
+        return self._appended
+
+    def _sync(self, seq):
+        # Group commit: one fsync covers every record written before it, so
+        # threads committing together mostly wait on a single fsync.
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            target = self._appended
+            wal = self._wal
+            if wal is not None:
+                os.fsync(wal.fileno())
+            self._synced = max(self._synced, target)
+
+    def _read_log(self):
+        # Complete commits in the log, plus the marker of a checkpoint that
+        # was interrupted while applying them (if any).
+        commits = []
+        applying = None
+        if not os.path.exists(WAL_FILE):
+            return commits, applying
+        with open(WAL_FILE, "rb") as f:
+            for line in f:
+                checksum, _, data = line.rstrip(b"\n").partition(b" ")
+                if not line.endswith(b"\n") or checksum != b"%08x" % zlib.crc32(data):
+                    break
+                record = json.loads(data)
+                if "applying" in record:
+                    applying = record["applying"]
+                else:
+                    commits.append(record)
+        return commits, applying
+
+    def checkpoint(self):
+        # Applies the logged commits to the data files and empties the log.
+        if not os.path.exists(WAL_FILE) or not os.path.getsize(WAL_FILE):
+            return
+        with self._locked():
+            commits, applying = self._read_log()
+            if commits:
+                self._apply(commits, applying)
+                setups = [commit["setup"] for commit in commits if "setup" in commit]
+                if setups:
+                    _write_atomic(SETUP_FILE, lambda f: json.dump(setups[-1], f, indent=4))
+            # Truncated rather than removed: other processes may hold it open.
+            with open(WAL_FILE, "r+b") as f:
+                f.truncate(0)
+                os.fsync(f.fileno())
+            self._wal_bytes = 0
+            self._synced = self._appended
+
+    def _apply(self, commits, applying):
+        full = None
+        full_file = None
+        puts = {}
+        deleted = set()
+        for commit in commits:
+            if "full" in commit or "full_file" in commit:
+                # Logs written before side files hold the rows inline.
+                full = commit.get("full")
+                full_file = commit.get("full_file")
+                puts.clear()
+                deleted.clear()
+            for tx in commit.get("put", ()):
+                puts[tx["id"]] = tx
+                deleted.discard(tx["id"])
+            for tx_id in commit.get("del", ()):
+                puts.pop(tx_id, None)
+                deleted.add(tx_id)
+        side_files = [commit["full_file"] for commit in commits if "full_file" in commit]
+        if full_file is not None and not os.path.exists(full_file):
+            full_file = None  # already renamed by a checkpoint that was cut short
+        if full_file is not None and not puts and not deleted:
+            os.replace(full_file, TRANSACTION_FILE)
+            _fsync_directory(TRANSACTION_FILE)
+        elif full is not None or full_file is not None or puts or deleted:
+            self._rewrite(full if full_file is None else _iter_json_array(full_file), puts, deleted, commits)
+        for path in side_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _rewrite(self, full, puts, deleted, commits):
+        if full is None:
+            full = _iter_json_array(TRANSACTION_FILE) if os.path.exists(TRANSACTION_FILE) else []
+        purged = set(self._latest_setup(commits).get("deleted_account_ids", ()))
+
+        def rows():
+            for tx in full:
+                if tx["id"] not in deleted:
+                    tx = puts.pop(tx["id"], tx)
+                    if tx.get("account_id") not in purged:
+                        yield tx
+            for tx in puts.values():
+                if tx.get("account_id") not in purged:
+                    yield tx
+
+        _write_atomic(TRANSACTION_FILE, lambda f: _dump_rows(f, rows()))
+
+    def journal_position(self):
+        return None
+
+    def iter_records(self, position):
+        return None
+
+    def _read_setup(self):
+        if os.path.exists(SETUP_FILE):
+            with open(SETUP_FILE, "r") as f:
+                return json.load(f)
+        else:
+            return {"banks": []}
+
+    def _latest_setup(self, commits):
+        setups = [commit["setup"] for commit in commits if "setup" in commit]
+        return setups[-1] if setups else self._read_setup()
+
+    def current_setup(self):
+        # The last committed setup, without checkpointing or marking it loaded.
+        return self._latest_setup(self._read_log()[0])
+
+    def account_directory(self):
+        if self.directory is None:
+            self.directory = AccountDirectory(self.current_setup())
+        return self.directory
+
+    def load_setup(self):
+        # The generation is read first, so a commit racing this load shows up as stale.
+        generation = self._read_generation()
+        self.checkpoint()
+        data = self._read_setup()
+        self._generation = generation
+        self._setup_base = json.loads(json.dumps(data))
+        return data
+
+    def save_setup(self, data):
+        with self.atomic():
+            self._staged["setup"] = data
+
+    def _rows(self):
+        # Rows as stored, with account ids unresolved.
+        self.checkpoint()
+        if os.path.exists(TRANSACTION_FILE):
+            with open(TRANSACTION_FILE, "r") as f:
+                return json.load(f)
+        else:
+            return []
+
+    def load_transactions(self):
+        return list(_resolve_rows(self._rows(), self.account_directory()))
+
+    def save_transactions(self, transactions, changed=None, deleted=None):
+        with self.atomic():
+            staged = self._staged
+            puts = staged.setdefault("put", {})
+            removed = staged.setdefault("del", set())
+            if changed is None and deleted is None:
+                staged["full"] = transactions
+                puts.clear()
+                removed.clear()
+            for tx in changed or []:
+                puts[tx["id"]] = tx
+                removed.discard(tx["id"])
+            for tx_id in deleted or []:
+                puts.pop(tx_id, None)
+                removed.add(tx_id)
+
+    def iter_transactions(self, bank=None, account=None):
+        self.checkpoint()
+        if not os.path.exists(TRANSACTION_FILE):
+            return
+        for tx in _resolve_rows(_iter_json_array(TRANSACTION_FILE), self.account_directory()):
+            if _matches(tx, bank, account):
+                yield tx
+
+    # Queries against storage, used while the ledger is not loaded. Backends
+    # with their own indexes override these.
+
+    def transaction_banks(self):
+        return sorted(set(tx["bank"] for tx in self.iter_transactions()))
+
+    def transaction_accounts(self, bank):
+        return sorted(set(tx["account"] for tx in self.iter_transactions(bank)))
+
+    # Persist bulk renames and deletes the Ledger has already applied in
+    # memory. Backends with supports_bulk_updates run them as queries and do
+    # not need the ledger loaded; the others save the affected rows.
+    supports_bulk_updates = False
+
+    def rename_bank(self, transactions, old_name, new_name, renamed):
+        self.save_transactions(transactions, changed=renamed)
+
+    def rename_account(self, transactions, bank, old_name, new_name, renamed):
+        self.save_transactions(transactions, changed=renamed)
+
+    def delete_transactions(self, transactions, bank, account, deleted):
+        self.save_transactions(transactions, deleted=deleted)
+
+    def compact(self, background=False):
+        return None
+
+    def purge(self, background=False):
+        # Removes the rows of deleted accounts, which reads already skip.
+        if self._purger is not None and self._purger.is_alive():
+            return self._purger
+        if background:
+            self._purger = threading.Thread(target=self._purge, daemon=True)
+            self._purger.start()
+            return self._purger
+        self._purge()
+        return None
+
+    def _purge(self):
+        # Waits for an open atomic() block, so it sees the setup that deleted them.
+        with self._locked():
+            self.checkpoint()
+            purged = set(self._read_setup().get("deleted_account_ids", ()))
+            if not purged or not os.path.exists(TRANSACTION_FILE):
+                return
+            if not any(tx.get("account_id") in purged for tx in _iter_json_array(TRANSACTION_FILE)):
+                return
+            rows = (tx for tx in _iter_json_array(TRANSACTION_FILE) if tx.get("account_id") not in purged)
+            _write_atomic(TRANSACTION_FILE, lambda f: _dump_rows(f, rows))
+
+    def close(self):
+        if self._purger is not None:
+            self._purger.join()
+        self.checkpoint()
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+_JOURNAL_PUT_PREFIX = '{"op":"put",'
+
+# Transaction fields that affect account balances
+BALANCE_FIELDS = ("bank", "account", "account_id", "type", "amount")
+
+
+def _apply_patch(tx, record):
+    tx.update(record["set"])
+    for key in record.get("unset", ()):
+        tx.pop(key, None)
+
+
+class JournalStorage(JsonStorage):
+    # Appends one JSON line per change instead of rewriting the whole ledger:
+    #   {"op": "put", "tx": {...}}                                new transaction
+    #   {"op": "patch", "id": ..., "set": {...}, "unset": [...]}  changed/removed fields
+    #   {"op": "del", "id": ...}                                  tombstone
+    # Patches that move money and tombstones carry the row's previous
+    # bank/account/type/amount under "was", so balances can be replayed
+    # from any point in the journal.
+    # Compaction rewrites the journal as one "put" per live transaction,
+    # leaving out the rows of deleted accounts.
+    # Commits go through the write-ahead log first (see JsonStorage); a
+    # checkpoint appends their records here.
+    name = "journal"
+    rewrites_ledger = False
+
+    CHECKPOINT_BYTES = 1024 * 1024
+
+    # Compact once the journal holds this many records per live transaction
+    COMPACT_RATIO = 2
+    COMPACT_MIN_RECORDS = 1000
+
+    def __init__(self):
+        self._state = None  # id -> tuple(tx.items()) as last committed
+        self._state_generation = None
+        self._records = 0
+        self._compactor = None
+        super().__init__()
+
+    def _commit_record(self, staged):
+        record = {"records": staged["records"]} if staged.get("records") else {}
+        if "setup" in staged:
+            record["setup"] = staged["setup"]
+        return record
+
+    def _rollback(self):
+        # _state already holds the abandoned changes; rebuild it from disk.
+        self._state = None
+
+    def _commit(self, staged):
+        generation = self._read_generation()
+        seq = super()._commit(staged)
+        if self._state_generation == generation:
+            self._state_generation = generation + 1
+        return seq
+
+    def _journal_position(self):
+        if not os.path.exists(JOURNAL_FILE):
+            return {"inode": None, "offset": 0}
+        stat = os.stat(JOURNAL_FILE)
+        return {"inode": stat.st_ino, "offset": stat.st_size}
+
+    def _apply(self, commits, applying):
+        if applying is not None and os.path.exists(JOURNAL_FILE):
+            # An earlier checkpoint stopped partway: drop what it appended and redo it.
+            stat = os.stat(JOURNAL_FILE)
+            if applying["inode"] in (None, stat.st_ino) and stat.st_size > applying["offset"]:
+                os.truncate(JOURNAL_FILE, applying["offset"])
+        records = [record for commit in commits for record in commit.get("records", ())]
+        if not records:
+            return
+        if applying is None:
+            self._sync(self._log({"applying": self._journal_position()}))
+        self._append(records, sync=True)
+
+    def _replay(self):
+        rows = {}
+        records = 0
+        with open(JOURNAL_FILE, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # still being appended by another process
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                records += 1
+                if record["op"] == "put":
+                    rows[record["tx"]["id"]] = record["tx"]
+                elif record["op"] == "patch":
+                    if record["id"] in rows:
+                        _apply_patch(rows[record["id"]], record)
+                elif record["op"] == "del":
+                    rows.pop(record["id"], None)
+        return rows, records
+
+    def _ensure_state(self):
+        # Rebuilt whenever another process has committed since it was read.
+        generation = self._read_generation()
+        if self._state is not None and self._state_generation == generation:
+            return
+        self._state_generation = generation
+        self.checkpoint()
+        if os.path.exists(JOURNAL_FILE):
+            rows, self._records = self._replay()
+            self._state = {tx_id: tuple(tx.items()) for tx_id, tx in rows.items()}
+        else:
+            # First use: import the existing single-file ledger, if any.
+            self._state = {}
+            self._records = 0
+            legacy = JsonStorage._rows(self)
+            if legacy:
+                self._append([{"op": "put", "tx": tx} for tx in legacy])
+                self._state = {tx["id"]: tuple(tx.items()) for tx in legacy}
+
+    def _append(self, records, sync=False):
+        lines = [json.dumps(record, separators=(",", ":"), default=_to_json) + "\n" for record in records]
+        with open(JOURNAL_FILE, "a") as f:
+            f.writelines(lines)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._records += len(lines)
+
+    def _diff(self, tx):
+        fields = tuple(_storage_row(tx, self.account_directory()).items())
+        old = self._state.get(tx["id"])
+        self._state[tx["id"]] = fields
+        if old == fields:
+            return None
+        new = dict(fields)
+        if old is None:
+            return {"op": "put", "tx": new}
+        old = dict(old)
+        record = {"op": "patch", "id": tx["id"], "set": {k: v for k, v in new.items() if k not in old or old[k] != v}}
+        if old.keys() - new.keys():
+            record["unset"] = list(old.keys() - new.keys())
+        if any(key in record["set"] for key in BALANCE_FIELDS):
+            record["was"] = {key: old.get(key) for key in BALANCE_FIELDS}
+        return record
+
+    def _rows(self):
+        with self._locked():
+            self._state = None
+            self._ensure_state()
+            return [dict(fields) for fields in self._state.values()]
+
+    def load_transactions(self):
+        return list(_resolve_rows(self._rows(), self.account_directory()))
+
+    def save_transactions(self, transactions, changed=None, deleted=None):
+        with self._locked():
+            self._ensure_state()
+            records = []
+            if changed is None and deleted is None:
+                # No hint from the caller: diff the whole list against what was last written.
+                seen = set()
+                for tx in transactions:
+                    seen.add(tx["id"])
+                    record = self._diff(tx)
+                    if record:
+                        records.append(record)
+                deleted = [tx_id for tx_id in self._state if tx_id not in seen]
+            else:
+                for tx in changed or []:
+                    record = self._diff(tx)
+                    if record:
+                        records.append(record)
+            for tx_id in deleted or []:
+                old = self._state.pop(tx_id, None)
+                if old is not None:
+                    old = dict(old)
+                    records.append({"op": "del", "id": tx_id, "was": {key: old.get(key) for key in BALANCE_FIELDS}})
+            if records:
+                with self.atomic():
+                    self._staged.setdefault("records", []).extend(records)
+            needs_compaction = self._records > max(
+                self.COMPACT_MIN_RECORDS, self.COMPACT_RATIO * len(self._state)
+            )
+        if needs_compaction:
+            self.compact(background=True)
+
+    def iter_transactions(self, bank=None, account=None):
+        self.checkpoint()
+        if not os.path.exists(JOURNAL_FILE):
+            yield from JsonStorage.iter_transactions(self, bank, account)
+            return
+        # First pass keeps only patches and tombstones (compaction keeps them
+        # few); the second streams the puts with their later changes applied.
+        directory = self.account_directory()
+        changes = {}
+        with open(JOURNAL_FILE, "r") as f:
+            for line_no, line in enumerate(f):
+                if not line.endswith("\n"):
+                    break
+                if line.strip() and not line.startswith(_JOURNAL_PUT_PREFIX):
+                    record = json.loads(line)
+                    if record["op"] != "put":
+                        changes.setdefault(record["id"], []).append((line_no, record))
+        with open(JOURNAL_FILE, "r") as f:
+            for line_no, line in enumerate(f):
+                if not line.endswith("\n"):
+                    break
+                if not line.startswith(_JOURNAL_PUT_PREFIX):
+                    continue
+                tx = json.loads(line)["tx"]
+                for change_line, record in changes.get(tx["id"], ()):
+                    if change_line < line_no:
+                        continue
+                    if record["op"] == "del":
+                        tx = None
+                        break
+                    _apply_patch(tx, record)
+                if tx is not None:
+                    tx = _resolve_row(tx, directory)
+                if tx is not None and _matches(tx, bank, account):
+                    yield tx
+
+    def data_files(self):
+        return (SETUP_FILE, JOURNAL_FILE)
+
+    def journal_position(self):
+        # Identifies a point in the journal; compaction replaces the file, which
+        # invalidates earlier positions.
+        with self._locked():
+            self._ensure_state()
+            self.checkpoint()
+            if not os.path.exists(JOURNAL_FILE):
+                return None
+            return self._journal_position()
+
+    def iter_records(self, position):
+        # Records written after `position`, or None if the journal was compacted since.
+        self.checkpoint()
+        stat = os.stat(JOURNAL_FILE) if os.path.exists(JOURNAL_FILE) else None
+        if stat is None or stat.st_ino != position["inode"] or stat.st_size < position["offset"]:
+            return None
+        return self._read_records(position["offset"])
+
+    def _read_records(self, offset):
+        with open(JOURNAL_FILE, "r") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                if line.strip():
+                    yield json.loads(line)
+
+    def purge(self, background=False):
+        return self.compact(background)
+
+    def compact(self, background=False):
+        if self._compactor is not None and self._compactor.is_alive():
+            return self._compactor
+        if background:
+            self._compactor = threading.Thread(target=self._compact, daemon=True)
+            self._compactor.start()
+            return self._compactor
+        self._compact()
+        return None
+
+    def _compact(self):
+        with self._locked():
+            self._ensure_state()
+            self.checkpoint()
+            purged = set(self._read_setup().get("deleted_account_ids", ()))
+            if purged:
+                for tx_id, fields in list(self._state.items()):
+                    if dict(fields).get("account_id") in purged:
+                        del self._state[tx_id]
+            rows = list(self._state.values())
+            position = self._journal_position()
+        # Written without the lock so commits carry on meanwhile.
+        tmp_file = f"{JOURNAL_FILE}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            for fields in rows:
+                f.write(json.dumps({"op": "put", "tx": dict(fields)}, separators=(",", ":")) + "\n")
+        with self._locked():
+            if self._journal_position()["inode"] != position["inode"]:
+                os.remove(tmp_file)  # another process compacted it first
+                return
+            # Carry over whatever any process appended since the snapshot.
+            with open(JOURNAL_FILE, "r") as f:
+                f.seek(position["offset"])
+                tail = f.read()
+            with open(tmp_file, "a") as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, JOURNAL_FILE)
+            _fsync_directory(JOURNAL_FILE)
+            self._records = len(rows) + tail.count("\n")
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+        super().close()
+
+
+class SqliteStorage(JsonStorage):
+    # Keeps banks, accounts and transactions in finance.db. Filters, renames and
+    # deletes run as indexed queries instead of scanning every transaction.
+    # Rows of accounts with an id leave bank and account empty and set
+    # account_id instead. Amounts and balances are read from integer cents
+    # columns; the REAL ones are still written for databases shared with
+    # older versions.
+    name = "sqlite"
+    rewrites_ledger = False
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS banks (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            extra TEXT
+        );
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY,
+            bank_id INTEGER NOT NULL REFERENCES banks (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            balance REAL NOT NULL,
+            extra TEXT,
+            balance_cents INTEGER,
+            UNIQUE (bank_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS transactions (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            bank TEXT NOT NULL,
+            account TEXT NOT NULL,
+            type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            description TEXT,
+            date TEXT NOT NULL,
+            refunded_transaction_id TEXT,
+            extra TEXT,
+            account_id TEXT,
+            cents INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS transactions_bank_account ON transactions (bank, account);
+        CREATE INDEX IF NOT EXISTS transactions_date ON transactions (date);
+        CREATE INDEX IF NOT EXISTS transactions_refunded_id ON transactions (refunded_transaction_id);
+    """
+
+    COLUMNS = (
+        "id", "bank", "account", "type", "amount", "description", "date", "refunded_transaction_id", "account_id",
+        "cents",
+    )
+
+    def __init__(self):
+        self._conn = None
+        self._path = None
+        self._depth = 0
+        self._changes = 0
+        super().__init__()  # the log state it sets up goes unused; checkpoint() is a no-op
+
+    def _connect(self):
+        if self._conn is None:
+            is_new = not os.path.exists(DATABASE_FILE)
+            self._path = os.path.abspath(DATABASE_FILE)
+            self._conn = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA foreign_keys = ON")
+            # SQLite keeps its own write-ahead log: commits append to it and
+            # interrupted ones are rolled back when the database is opened.
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = FULL")
+            self._conn.executescript(self.SCHEMA)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info (transactions)")]
+            if "account_id" not in columns:  # created before account ids
+                self._conn.execute("ALTER TABLE transactions ADD COLUMN account_id TEXT")
+            if "cents" not in columns:  # created before amounts were kept in cents
+                with self._conn:
+                    self._conn.execute("ALTER TABLE transactions ADD COLUMN cents INTEGER")
+                    self._conn.execute("UPDATE transactions SET cents = CAST(ROUND(amount * 100) AS INTEGER)")
+                    self._conn.execute("ALTER TABLE accounts ADD COLUMN balance_cents INTEGER")
+                    self._conn.execute("UPDATE accounts SET balance_cents = CAST(ROUND(balance * 100) AS INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS transactions_account_id ON transactions (account_id)")
+            if is_new:
+                migrate_json_to_sqlite(self)
+        return self._conn
+
+    @contextlib.contextmanager
+    def atomic(self):
+        # Saves made inside the block share one database transaction. It takes
+        # the write lock up front so a stale setup is merged against the
+        # latest committed one; readers are never blocked (WAL mode).
+        conn = self._connect()
+        if not self._depth:
+            conn.execute("BEGIN IMMEDIATE")
+            self.merged = False
+            self._changes = conn.total_changes
+        self._depth += 1
+        try:
+            yield
+        except BaseException:
+            self._depth -= 1
+            if not self._depth:
+                conn.rollback()
+            raise
+        self._depth -= 1
+        if not self._depth:
+            if conn.total_changes != self._changes:
+                # user_version counts commits, like the generation in finance.lock.
+                conn.execute(f"PRAGMA user_version = {self.generation() + 1}")
+                self.commits += 1
+            conn.commit()
+
+    @contextlib.contextmanager
+    def _write(self):
+        with self.atomic():
+            yield self._connect()
+
+    def checkpoint(self):
+        pass
+
+    def _data_version(self):
+        # Changes whenever another connection commits.
+        return self._connect().execute("PRAGMA data_version").fetchone()[0]
+
+    def is_stale(self):
+        return self._generation is not None and self._data_version() != self._generation
+
+    def generation(self):
+        return self._connect().execute("PRAGMA user_version").fetchone()[0]
+
+    def data_files(self):
+        # SQLite rewrites the database whenever it checkpoints its own log,
+        # so file times say nothing here; the generation is checked alone.
+        return ()
+
+    def _to_row(self, tx):
+        tx = _storage_row(tx, self.account_directory())
+        extra = {k: v for k, v in tx.items() if k not in self.COLUMNS}
+        cents = to_cents(tx["amount"])
+        tx = {**tx, "amount": cents / 100, "cents": cents}
+        row = tuple(tx.get(column, "" if column in ("bank", "account") else None) for column in self.COLUMNS)
+        return row + (json.dumps(extra) if extra else None,)
+
+    def _from_row(self, row):
+        tx = dict(zip(self.COLUMNS, row))
+        cents = tx.pop("cents")
+        if cents is not None:
+            tx["amount"] = cents / 100
+        if tx["refunded_transaction_id"] is None:
+            del tx["refunded_transaction_id"]
+        if tx["account_id"] is None:
+            del tx["account_id"]
+        else:
+            del tx["bank"], tx["account"]
+        if row[-1]:
+            tx.update(json.loads(row[-1]))
+        return tx
+
+    def _query(self, where="", params=(), resolve=True):
+        columns = ", ".join(self.COLUMNS + ("extra",))
+        cursor = self._connect().execute(f"SELECT {columns} FROM transactions {where} ORDER BY seq", params)
+        rows = (self._from_row(row) for row in cursor)
+        return _resolve_rows(rows, self.account_directory()) if resolve else rows
+
+    def current_setup(self):
+        return self._read_setup()
+
+    def load_setup(self):
+        self._generation = self._data_version()
+        data = self._read_setup()
+        self._setup_base = json.loads(json.dumps(data))
+        return data
+
+    def _read_setup(self):
+        conn = self._connect()
+        data = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")}
+        data["banks"] = []
+        for bank_id, name, extra in conn.execute("SELECT id, name, extra FROM banks ORDER BY id"):
+            bank = {"name": name, "accounts": []}
+            bank.update(json.loads(extra) if extra else {})
+            accounts = conn.execute(
+                "SELECT name, balance, balance_cents, extra FROM accounts WHERE bank_id = ? ORDER BY id", (bank_id,)
+            )
+            for account_name, balance, cents, account_extra in accounts:
+                account = {"name": account_name, "balance": balance if cents is None else cents / 100}
+                account.update(json.loads(account_extra) if account_extra else {})
+                bank["accounts"].append(account)
+            data["banks"].append(bank)
+        return data
+
+    def save_setup(self, data):
+        # The setup is small, so it is replaced as a whole inside one transaction.
+        with self._write() as conn:
+            if self.is_stale() and self._setup_base is not None:
+                merge_setup(self._setup_base, data, self._read_setup())
+                self.merged = True
+            self._generation = self._data_version()
+            self._setup_base = json.loads(json.dumps(data))
+            conn.execute("DELETE FROM accounts")
+            conn.execute("DELETE FROM banks")
+            conn.execute("DELETE FROM meta")
+            conn.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in data.items() if key != "banks"],
+            )
+            for bank in data["banks"]:
+                extra = {k: v for k, v in bank.items() if k not in ("name", "accounts")}
+                bank_id = conn.execute(
+                    "INSERT INTO banks (name, extra) VALUES (?, ?)",
+                    (bank["name"], json.dumps(extra) if extra else None),
+                ).lastrowid
+                for account in bank["accounts"]:
+                    account_extra = {k: v for k, v in account.items() if k not in ("name", "balance")}
+                    conn.execute(
+                        "INSERT INTO accounts (bank_id, name, balance, balance_cents, extra) VALUES (?, ?, ?, ?, ?)",
+                        (bank_id, account["name"], account["balance"], to_cents(account["balance"]),
+                         json.dumps(account_extra) if account_extra else None),
+                    )
+
+    def _rows(self):
+        return list(self._query(resolve=False))
+
+    def load_transactions(self):
+        return list(self._query())
+
+    def save_transactions(self, transactions, changed=None, deleted=None):
+        conn = self._connect()
+        placeholders = ", ".join("?" for _ in self.COLUMNS + ("extra",))
+        updates = ", ".join(f"{column} = excluded.{column}" for column in self.COLUMNS[1:] + ("extra",))
+        upsert = (
+            f"INSERT INTO transactions ({', '.join(self.COLUMNS)}, extra) VALUES ({placeholders}) "
+            f"ON CONFLICT (id) DO UPDATE SET {updates}"
+        )
+        with self._write():
+            if changed is None and deleted is None:
+                conn.execute("DELETE FROM transactions")
+                changed = transactions
+            conn.executemany(upsert, [self._to_row(tx) for tx in changed or []])
+            conn.executemany("DELETE FROM transactions WHERE id = ?", [(tx_id,) for tx_id in deleted or []])
+
+    def _account_ids_in_use(self, account_ids=None):
+        # Ids (of `account_ids`, if given) that rows refer to.
+        if account_ids is None:
+            cursor = self._connect().execute(
+                "SELECT DISTINCT account_id FROM transactions WHERE account_id IS NOT NULL"
+            )
+        else:
+            placeholders = ", ".join("?" for _ in account_ids)
+            cursor = self._connect().execute(
+                f"SELECT DISTINCT account_id FROM transactions WHERE account_id IN ({placeholders})", account_ids
+            )
+        return [row[0] for row in cursor]
+
+    def transaction_banks(self):
+        directory = self.account_directory()
+        banks = {row[0] for row in self._connect().execute(
+            "SELECT DISTINCT bank FROM transactions WHERE account_id IS NULL"
+        )}
+        for account_id in self._account_ids_in_use():
+            names = directory.names(account_id)
+            if names is not None:
+                banks.add(names[0])
+        return sorted(banks)
+
+    def transaction_accounts(self, bank):
+        directory = self.account_directory()
+        accounts = {row[0] for row in self._connect().execute(
+            "SELECT DISTINCT account FROM transactions WHERE bank = ?", (bank,)
+        )}
+        accounts.update(directory.names(account_id)[1] for account_id in
+                        self._account_ids_in_use(directory.account_ids(bank)))
+        return sorted(accounts)
+
+    def iter_transactions(self, bank=None, account=None):
+        if bank is None:
+            return self._query()
+        account_ids = self.account_directory().account_ids(bank, account)
+        if account is None:
+            where, params = "bank = ?", [bank]
+        else:
+            where, params = "bank = ? AND account = ?", [bank, account]
+        if account_ids:
+            where += f" OR account_id IN ({', '.join('?' for _ in account_ids)})"
+            params += account_ids
+        return self._query(f"WHERE {where}", params)
+
+    supports_bulk_updates = True
+
+    def rename_bank(self, transactions, old_name, new_name, renamed):
+        with self._write() as conn:
+            conn.execute("UPDATE transactions SET bank = ? WHERE bank = ?", (new_name, old_name))
+
+    def rename_account(self, transactions, bank, old_name, new_name, renamed):
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE transactions SET account = ? WHERE bank = ? AND account = ?", (new_name, bank, old_name)
+            )
+
+    def delete_transactions(self, transactions, bank, account, deleted):
+        with self._write() as conn:
+            if account is None:
+                conn.execute("DELETE FROM transactions WHERE bank = ?", (bank,))
+            else:
+                conn.execute("DELETE FROM transactions WHERE bank = ? AND account = ?", (bank, account))
+
+    def _purge(self):
+        # Runs on its own connection; the write lock waits for an open
+        # atomic() block to commit the setup that deleted the accounts.
+        # Only hidden rows go, so the generation is left alone.
+        if self._path is None:
+            return
+        conn = sqlite3.connect(self._path, timeout=60)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM meta WHERE key = 'deleted_account_ids'").fetchone()
+            purged = json.loads(row[0]) if row else []
+            conn.executemany("DELETE FROM transactions WHERE account_id = ?", [(account_id,) for account_id in purged])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def close(self):
+        if self._purger is not None:
+            self._purger.join()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def migrate_json_to_sqlite(storage):
+    # One-shot import of setup.json and the transaction ledger into a new database.
+    json_storage = JournalStorage() if os.path.exists(JOURNAL_FILE) else JsonStorage()
+    try:
+        if os.path.exists(SETUP_FILE):
+            storage.save_setup(json_storage.load_setup())
+        transactions = json_storage._rows()
+        if transactions:
+            storage.save_transactions(transactions, changed=transactions)
+    finally:
+        json_storage.close()  # releases its descriptor on finance.lock
+
+
+STORAGE_BACKENDS = {
+    "json": JsonStorage,
+    "journal": JournalStorage,
+    "sqlite": SqliteStorage,
+}
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+        _storage = STORAGE_BACKENDS[STORAGE_BACKEND]()
+    return _storage
+
+
+# --- Data Persistence Functions ---
+
+def get_directory():
+    return get_storage().account_directory()
+
+
+def set_directory(setup_data):
+    get_storage().directory = AccountDirectory(setup_data)
+
+
+@instrumented("storage.load_setup")
+def load_setup():
+    data = get_storage().load_setup()
+    set_directory(data)
+    if assign_account_ids(data):
+        migrate_to_account_ids(data)
+    return data
+
+
+@instrumented("storage.save_setup")
+def save_setup(data):
+    # Accounts added since the last save get their ids here.
+    assign_account_ids(data)
+    get_storage().save_setup(data)
+    set_directory(data)
+
+
+def migrate_to_account_ids(setup_data):
+    # One-shot conversion of rows still keyed by bank/account names to the
+    # account ids just assigned, committed together with the setup.
+    storage = get_storage()
+    set_directory(setup_data)
+    directory = storage.account_directory()
+    with storage.atomic():
+        rows = [
+            _storage_row(tx, directory) for tx in storage._rows()
+            if "account_id" not in tx and directory.account_id(tx["bank"], tx["account"]) is not None
+        ]
+        if rows:
+            storage.save_transactions(None, changed=rows)
+        storage.save_setup(setup_data)
+
+
+@instrumented("storage.load_transactions")
+def load_transactions():
+    return get_storage().load_transactions()
+
+
+@instrumented("storage.save_transactions")
+def save_transactions(transactions, changed=None, deleted=None):
+    # `changed`/`deleted` let backends that support it write only what an operation touched.
+    ledger = transactions if isinstance(transactions, Ledger) else None
+    if ledger is not None:
+        transactions = ledger.transactions
+    get_storage().save_transactions(transactions, changed=changed, deleted=deleted)
+    if ledger is not None:
+        ledger.uncommitted = False
+
+
+@instrumented("storage.iter_transactions", lazy=True)
+def iter_transactions(bank=None, account=None):
+    return get_storage().iter_transactions(bank=bank, account=account)
+
+
+class StorageStamp:
+    # The storage generation a derived file (cache, index) matches. It stays
+    # valid while every later commit came from this process, whose Ledger
+    # reports its changes to the in-memory copy; a commit by any other
+    # process means the file has to be rebuilt.
+    def __init__(self, generation=None):
+        self.generation = generation
+        self._commits = get_storage().commits
+
+    def sync(self):
+        storage = get_storage()
+        generation = storage.generation()
+        valid = self.generation is not None and generation - self.generation == storage.commits - self._commits
+        self.generation = generation
+        self._commits = storage.commits
+        return valid
+
+
+# --- Money ---
+# Amounts and balances are added up as integer cents (hundredths of the
+# currency unit, whatever the currency shows), so no rounding error builds
+# up over a long history. Floats only appear at the edges: the "amount" and
+# "balance" fields keep their float values for existing files and callers,
+# always written from a whole number of cents, which reads back exactly.
+
+CURRENCY = os.environ.get("FINANCE_MANAGER_CURRENCY", "USD")
+
+# Symbol, decimal places and decimal mark of each currency code
+CURRENCIES = {
+    "USD": ("$", 2, "."),
+    "CAD": ("CA$", 2, "."),
+    "AUD": ("A$", 2, "."),
+    "EUR": ("€", 2, ","),
+    "GBP": ("£", 2, "."),
+    "CHF": ("CHF ", 2, "."),
+    "INR": ("₹", 2, "."),
+    "JPY": ("¥", 0, "."),
+}
+
+_MONEY_NUMBER = re.compile(r"[0-9]+(?:[.,][0-9]+)*(?:[.,][0-9]*)?|[.,][0-9]+")
+_MONEY_GROUPS = {mark: re.compile(rf"[0-9]{{1,3}}(?:\{mark}[0-9]{{3}})+") for mark in ".,"}
+
+
+def _currency(currency):
+    currency = currency or CURRENCY
+    return (currency, *CURRENCIES.get(currency, (currency + " ", 2, ".")))
+
+
+def parse_money(text, currency=None):
+    # Cents in `text`, such as "12.5", "$1,234.56", "-€5", "1.234,56 EUR"
+    # or "(20.00)". The currency's own decimal mark, or the last of two
+    # different marks, is the decimal point; any other mark separates
+    # thousands if it is followed by groups of three digits. More decimals
+    # than the currency has is an error.
+    currency, symbol, places, mark = _currency(currency)
+    value = str(text).strip()
+    negative = value.startswith("(") and value.endswith(")")
+    if negative:
+        value = value[1:-1]
+    for sign in (currency, symbol.strip(), "$"):
+        value = value.replace(sign, "")
+    value = value.replace(" ", "").replace("\u00a0", "")
+    if value[:1] in ("-", "+"):
+        negative ^= value[0] == "-"
+        value = value[1:]
+    if not _MONEY_NUMBER.fullmatch(value or "x"):
+        raise ValueError(f"Invalid amount '{text}'")
+    marks = [c for c in value if c in ".,"]
+    if len(set(marks)) == 2:
+        decimal_mark = marks[-1]
+    elif not marks or len(marks) > 1 or (marks[0] != mark and _MONEY_GROUPS[marks[0]].fullmatch(value)):
+        decimal_mark = None
+    else:
+        decimal_mark = marks[0]
+    if decimal_mark:
+        whole, _, fraction = value.rpartition(decimal_mark)
+    else:
+        whole, fraction = value, ""
+    separators = set(whole) & {".", ","}
+    if separators and (len(separators) > 1 or not _MONEY_GROUPS[separators.pop()].fullmatch(whole)):
+        raise ValueError(f"Invalid amount '{text}': thousands must be grouped by three")
+    whole = whole.replace(",", "").replace(".", "") or "0"
+    if len(fraction) > places:
+        raise ValueError(f"Invalid amount '{text}': {currency} has {places} decimal places")
+    cents = int(whole) * 100 + int((fraction + "00")[:2])
+    return -cents if negative else cents
+
+
+def format_money(cents, currency=None):
+    currency, symbol, places, mark = _currency(currency)
+    units, rest = divmod(abs(cents), 100)
+    if places:
+        text = f"{units:,}.{rest:02d}"
+    else:
+        text = f"{(abs(cents) + 50) // 100:,}"
+    if mark == ",":
+        text = text.translate(str.maketrans(",.", ".,"))
+    return f"{'-' if cents < 0 else ''}{symbol}{text}"
+
+
+def to_cents(value):
+    # Exact for Money, ints, Decimals and strings; floats are taken to the
+    # nearest cent.
+    if isinstance(value, float):
+        return round(value * 100)
+    if isinstance(value, Money):
+        return value.cents
+    if isinstance(value, int):
+        return value * 100
+    if isinstance(value, str):
+        return parse_money(value)
+    if isinstance(value, decimal.Decimal):
+        cents = value * 100
+        if cents != cents.to_integral_value():
+            raise ValueError(f"Invalid amount '{value}': less than a cent")
+        return int(cents)
+    return parse_money(value)
+
+
+def positive_cents(value):
+    # to_cents() of an amount that has to be more than zero, as every
+    # posted amount does: the transaction type carries the sign.
+    cents = to_cents(value)
+    if cents <= 0:
+        raise ValueError(f"Amount must be more than zero, not {format_money(cents)}")
+    return cents
+
+
+@functools.total_ordering
+class Money:
+    # An amount as integer cents: adds, subtracts and compares exactly, and
+    # prints in the configured currency. float() gives the value in units.
+    __slots__ = ("cents",)
+
+    def __init__(self, cents=0):
+        self.cents = int(cents)
+
+    @classmethod
+    def of(cls, value):
+        return cls(to_cents(value))
+
+    @classmethod
+    def parse(cls, text, currency=None):
+        return cls(parse_money(text, currency))
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        if other == 0:  # so sum() works
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents)
+        return NotImplemented
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __abs__(self):
+        return Money(abs(self.cents))
+
+    def __eq__(self, other):
+        if isinstance(other, Money):
+            return self.cents == other.cents
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, Money):
+            return self.cents < other.cents
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __repr__(self):
+        return f"Money({self.cents})"
+
+    def __str__(self):
+        return format_money(self.cents)
+
+
+def sum_cents(cents, keys, size):
+    # Sums int64 `cents` into `size` buckets by their `keys` (array.array or
+    # NumPy columns), without converting to floats on the way. Returns a list
+    # of ints.
+    if len(cents) and _importable(np):
+        cents = np.asarray(cents, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.intp)
+        order = np.argsort(keys, kind="stable")
+        bounds = np.searchsorted(keys[order], np.arange(size + 1))
+        running = np.concatenate(([0], np.cumsum(cents[order])))
+        return [int(value) for value in running[bounds[1:]] - running[bounds[:-1]]]
+    totals = [0] * size
+    for key, value in zip(keys, cents):
+        totals[key] += value
+    return totals
+
+
+# --- Transaction Records ---
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _encode_date(value):
+    # Naive ISO timestamps are kept as microseconds since the epoch; anything
+    # that would not round-trip exactly stays a string.
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return value
+    if moment.tzinfo is not None or moment.isoformat() != value:
+        return value
+    return (moment - _EPOCH) // _MICROSECOND
+
+
+def _decode_date(value):
+    if isinstance(value, int):
+        return (_EPOCH + value * _MICROSECOND).isoformat()
+    return value
+
+
+def _encode_id(value):
+    # uuid4().hex ids are kept as their 16 raw bytes, other ids as given.
+    if isinstance(value, str) and len(value) == 32:
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            return value
+        if raw.hex() == value:
+            return raw
+    return value
+
+
+def _decode_id(value):
+    return value.hex() if isinstance(value, bytes) else value
+
+
+class Transaction:
+    # Compact transaction record: interned bank/account/type names,
+    # integer-cent amounts, epoch-microsecond dates and byte ids. Reads and
+    # writes through tx["field"] behave like the dicts it replaces.
+    __slots__ = ("_id", "bank", "account", "type", "cents", "description", "_date", "_refunded_id", "_extra")
+
+    KEYS = ("id", "bank", "account", "type", "amount", "description", "date")
+
+    def __init__(self, id, bank, account, type, cents, description, date, refunded_transaction_id=None, extra=None):
+        self._id = _encode_id(id)
+        self.bank = sys.intern(bank)
+        self.account = sys.intern(account)
+        self.type = sys.intern(type)
+        self.cents = cents
+        self.description = description
+        self._date = _encode_date(date)
+        self._refunded_id = None if refunded_transaction_id is None else _encode_id(refunded_transaction_id)
+        self._extra = extra or None
+
+    @classmethod
+    def from_dict(cls, data):
+        extra = {k: v for k, v in data.items() if k not in cls.KEYS and k != "refunded_transaction_id"}
+        return cls(
+            data["id"], data["bank"], data["account"], data["type"], to_cents(data["amount"]),
+            data["description"], data["date"], data.get("refunded_transaction_id"), extra,
+        )
+
+    def keys(self):
+        keys = list(self.KEYS)
+        if self._refunded_id is not None:
+            keys.append("refunded_transaction_id")
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def __getitem__(self, key):
+        if key in _TRANSACTION_FIELDS:
+            return _TRANSACTION_FIELDS[key][0](self)
+        if key == "refunded_transaction_id" and self._refunded_id is not None:
+            return _decode_id(self._refunded_id)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _TRANSACTION_FIELDS:
+            _TRANSACTION_FIELDS[key][1](self, value)
+        elif key == "refunded_transaction_id":
+            self._refunded_id = _encode_id(value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        return key in _TRANSACTION_FIELDS or (
+            key == "refunded_transaction_id" and self._refunded_id is not None
+        ) or bool(self._extra and key in self._extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def update(self, other=(), **changes):
+        for key, value in dict(other, **changes).items():
+            self[key] = value
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (Transaction, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Transaction({self.to_dict()!r})"
+
+
+def _set_name(slot):
+    def setter(tx, value):
+        setattr(tx, slot, sys.intern(value))
+    return setter
+
+
+_TRANSACTION_FIELDS = {
+    "id": (lambda tx: _decode_id(tx._id), lambda tx, value: setattr(tx, "_id", _encode_id(value))),
+    "bank": (lambda tx: tx.bank, _set_name("bank")),
+    "account": (lambda tx: tx.account, _set_name("account")),
+    "type": (lambda tx: tx.type, _set_name("type")),
+    "amount": (lambda tx: tx.cents / 100, lambda tx, value: setattr(tx, "cents", to_cents(value))),
+    "description": (lambda tx: tx.description, lambda tx, value: setattr(tx, "description", value)),
+    "date": (lambda tx: _decode_date(tx._date), lambda tx, value: setattr(tx, "_date", _encode_date(value))),
+}
+
+
+def as_transaction(tx):
+    return tx if isinstance(tx, Transaction) else Transaction.from_dict(tx)
+
+
+def refund_of(tx):
+    # Id of the transaction `tx` refunds, or None.
+    if isinstance(tx, Transaction):
+        return None if tx._refunded_id is None else _decode_id(tx._refunded_id)
+    return tx.get("refunded_transaction_id")
+
+
+def _to_json(obj):
+    if isinstance(obj, Transaction):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class ColumnarTransactions:
+    # Optional column-per-field store for bulk scans and analytics. Amounts
+    # (cents) and dates (epoch microseconds) live in array("q") columns,
+    # deposit/withdrawal as an array("b") sign, and bank/account as
+    # array("I") codes into one shared name table; descriptions are codes into
+    # a table of distinct texts. Rows are rebuilt as Transaction records on
+    # access.
+    def __init__(self, transactions=()):
+        self.names = []
+        self._codes = {}
+        self.ids = []
+        self.banks = array.array("I")
+        self.accounts = array.array("I")
+        self.signs = array.array("b")
+        self.amounts = array.array("q")
+        self.dates = array.array("q")
+        self.texts = []
+        self._text_codes = {}
+        self.descriptions = array.array("I")
+        self.refunded_ids = {}  # row -> original transaction id
+        self.odd_dates = {}  # row -> date string that is not a plain ISO timestamp
+        self.extras = {}  # row -> fields beyond the standard ones
+        for tx in transactions:
+            self.append(tx)
+
+    def _code(self, name):
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return code
+
+    def append(self, tx):
+        tx = as_transaction(tx)
+        row = len(self.ids)
+        self.ids.append(tx._id)
+        self.banks.append(self._code(tx.bank))
+        self.accounts.append(self._code(tx.account))
+        self.signs.append(1 if tx.type == "deposit" else -1)
+        self.amounts.append(tx.cents)
+        if isinstance(tx._date, int):
+            self.dates.append(tx._date)
+        else:
+            self.dates.append(0)
+            self.odd_dates[row] = tx._date
+        code = self._text_codes.get(tx.description)
+        if code is None:
+            code = self._text_codes[tx.description] = len(self.texts)
+            self.texts.append(tx.description)
+        self.descriptions.append(code)
+        if tx._refunded_id is not None:
+            self.refunded_ids[row] = tx._refunded_id
+        if tx._extra:
+            self.extras[row] = dict(tx._extra)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self.ids)
+        tx = Transaction.__new__(Transaction)
+        tx._id = self.ids[row]
+        tx.bank = self.names[self.banks[row]]
+        tx.account = self.names[self.accounts[row]]
+        tx.type = "deposit" if self.signs[row] > 0 else "withdrawal"
+        tx.cents = self.amounts[row]
+        tx.description = self.texts[self.descriptions[row]]
+        tx._date = self.odd_dates.get(row, self.dates[row])
+        tx._refunded_id = self.refunded_ids.get(row)
+        tx._extra = dict(self.extras[row]) if row in self.extras else None
+        return tx
+
+    def __iter__(self):
+        for row in range(len(self.ids)):
+            yield self[row]
+
+    def write_group(self, f):
+        # Writes the rows as one self-describing block to binary file `f`: a
+        # JSON header line listing each column's kind and size, then the
+        # columns, each compressed on its own.
+        tables = {
+            "names": self.names,
+            "texts": self.texts,
+            "ids": [_decode_id(tx_id) for tx_id in self.ids],
+            "refunded_ids": {row: _decode_id(tx_id) for row, tx_id in self.refunded_ids.items()},
+            "odd_dates": self.odd_dates,
+            "extras": self.extras,
+        }
+        arrays = {
+            "banks": self.banks,
+            "accounts": self.accounts,
+            "signs": self.signs,
+            "amounts": self.amounts,
+            "dates": self.dates,
+            "descriptions": self.descriptions,
+        }
+        columns = []
+        blobs = []
+        for name, value in tables.items():
+            blobs.append(zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8")))
+            columns.append([name, "json", len(blobs[-1])])
+        for name, column in arrays.items():
+            blobs.append(zlib.compress(column.tobytes()))
+            columns.append([name, column.typecode, len(blobs[-1])])
+        header = {"rows": len(self), "byteorder": sys.byteorder, "columns": columns}
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        for blob in blobs:
+            f.write(blob)
+
+    @classmethod
+    def read_group(cls, f):
+        # Reads the next block written by write_group, or returns None at the end of `f`.
+        line = f.readline()
+        if not line.strip():
+            return None
+        header = json.loads(line)
+        columns = cls()
+        for name, kind, size in header["columns"]:
+            data = zlib.decompress(f.read(size))
+            if kind == "json":
+                value = json.loads(data)
+                if name == "ids":
+                    value = [_encode_id(tx_id) for tx_id in value]
+                elif name == "refunded_ids":
+                    value = {int(row): _encode_id(tx_id) for row, tx_id in value.items()}
+                elif name in ("odd_dates", "extras"):
+                    value = {int(row): field for row, field in value.items()}
+            else:
+                value = array.array(kind)
+                value.frombytes(data)
+                if header["byteorder"] != sys.byteorder:
+                    value.byteswap()
+            setattr(columns, name, value)
+        columns._codes = {name: code for code, name in enumerate(columns.names)}
+        columns._text_codes = {text: code for code, text in enumerate(columns.texts)}
+        return columns
+
+
+# --- Ledger Snapshot ---
+# A loaded ledger is saved to ledger.snapshot, so the next process can skip
+# parsing and converting the storage files. The file is a magic line, a
+# JSON header line, then one marshal blob per Transaction slot; the header
+# records where each blob starts, so they are read straight out of a memory
+# map. A snapshot is used only if it was written by the same backend at the
+# current storage generation, the data files still have the modification
+# time and size it recorded (edits made outside the app), and the blobs
+# hash to the recorded digest (torn or corrupt writes).
+
+SNAPSHOT_FILE = "ledger.snapshot"
+SNAPSHOT_MAGIC = b"FMSNAPSHOT1\n"
+SNAPSHOT_VERSION = 1
+
+
+def _file_stamps(paths):
+    stamps = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stamps[path] = None
+        else:
+            stamps[path] = [stat.st_mtime_ns, stat.st_size]
+    return stamps
+
+
+def _snapshot_header(f):
+    if f.readline() != SNAPSHOT_MAGIC:
+        return None
+    try:
+        header = json.loads(f.readline())
+    except ValueError:
+        return None
+    return header if header.get("version") == SNAPSHOT_VERSION else None
+
+
+def snapshot_generation():
+    # Generation of a snapshot that matches the current storage, or None.
+    storage = get_storage()
+    try:
+        with open(SNAPSHOT_FILE, "rb") as f:
+            header = _snapshot_header(f)
+    except FileNotFoundError:
+        return None
+    if (
+        header is None
+        or header["backend"] != storage.name
+        or header["generation"] != storage.generation()
+        or header["sources"] != _file_stamps(storage.data_files())
+    ):
+        return None
+    return header["generation"]
+
+
+@instrumented("snapshot.load")
+def load_snapshot():
+    # The snapshot's rows, or None if there is no usable snapshot.
+    generation = snapshot_generation()
+    if generation is None:
+        return None
+    with open(SNAPSHOT_FILE, "rb") as f:
+        header = _snapshot_header(f)
+        start = f.tell()
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return None
+    with data:
+        payload = memoryview(data)[start:]
+        try:
+            if hashlib.blake2b(payload, digest_size=16).hexdigest() != header["digest"]:
+                return None
+            columns = [marshal.loads(payload[offset:offset + size]) for offset, size in header["columns"]]
+        except (ValueError, EOFError, TypeError):
+            return None
+        finally:
+            payload.release()
+    rows = []
+    new = Transaction.__new__
+    for values in zip(*columns):
+        tx = new(Transaction)
+        (tx._id, tx.bank, tx.account, tx.type, tx.cents, tx.description, tx._date,
+         tx._refunded_id, tx._extra) = values
+        rows.append(tx)
+    return rows if len(rows) == header["rows"] else None
+
+
+@instrumented("snapshot.save")
+def save_snapshot(rows, generation):
+    # `rows` must be the ledger as committed at `generation`. Pending log
+    # records are applied first, so closing the storage leaves the data
+    # files as the snapshot recorded them.
+    storage = get_storage()
+    storage.checkpoint()
+    blobs = [marshal.dumps([getattr(tx, slot) for tx in rows]) for slot in Transaction.__slots__]
+    columns = []
+    offset = 0
+    digest = hashlib.blake2b(digest_size=16)
+    for blob in blobs:
+        columns.append([offset, len(blob)])
+        offset += len(blob)
+        digest.update(blob)
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "backend": storage.name,
+        "generation": generation,
+        "sources": _file_stamps(storage.data_files()),
+        "rows": len(rows),
+        "digest": digest.hexdigest(),
+        "columns": columns,
+    }
+    tmp_file = SNAPSHOT_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_file, SNAPSHOT_FILE)
+
+
+# --- Transaction Ledger ---
+
+class Ledger:
+    # Wraps the transaction list with hash indexes by id, bank and
+    # (bank, account) plus a date-sorted index. Indexes are built the first
+    # time they are needed and kept in step by the methods below, so changes
+    # to indexed fields must go through them rather than the rows directly.
+    # Per-account BalanceHistory trees are built on first query, and the
+    # AggregateCache of a storage-backed ledger is told about every change.
+    # Refunds are indexed by the id of the transaction they refund, next to
+    # the cents refunded so far, so the amount left to refund is a lookup.
+    def __init__(self, transactions=None):
+        self.transactions = transactions if transactions is not None else []
+        self._by_id = None
+        self._by_bank = None
+        self._by_account = None
+        self._by_date = None
+        self._refunds = None  # original id -> {refund id: refund}
+        self._refunded = None  # original id -> cents refunded
+        self._history = {}
+        self._search = None  # SearchIndex, loaded or built on first search
+        self._aggregates = None
+        self.uncommitted = False  # rows added or changed since the last commit
+
+    @property
+    def loaded(self):
+        return is_loaded(self.transactions)
+
+    def reload(self):
+        # Drops rows and indexes; they are read from storage again when next needed.
+        if isinstance(self.transactions, LazyTransactions):
+            self.transactions.clear()
+            self.transactions.loaded = False
+        else:
+            self.transactions[:] = [as_transaction(tx) for tx in load_transactions()]
+        self._by_id = None
+        self._by_bank = None
+        self._by_account = None
+        self._by_date = None
+        self._refunds = None
+        self._refunded = None
+        self._history = {}
+        self._search = None
+        self.uncommitted = False
+        if self._aggregates is not None:
+            self._aggregates.invalidate()
+
+    def load(self):
+        ensure_loaded(self.transactions)
+        if self._by_id is None:
+            self._build_indexes()
+        return self
+
+    @instrumented("index.build")
+    def _build_indexes(self):
+        self._by_id = {}
+        self._by_bank = {}
+        self._by_account = {}
+        self._by_date = []
+        self._refunds = {}
+        self._refunded = {}
+        # _index() inlined, reading each field once: ids and dates are
+        # decoded on every access.
+        for tx in self.transactions:
+            tx_id, bank = tx["id"], tx["bank"]
+            self._by_id[tx_id] = tx
+            self._by_bank.setdefault(bank, {})[tx_id] = tx
+            self._by_account.setdefault((bank, tx["account"]), {})[tx_id] = tx
+            self._by_date.append((tx["date"], tx_id))
+            original_id = refund_of(tx)
+            if original_id is not None:
+                self._refunds.setdefault(original_id, {})[tx_id] = tx
+                self._refunded[original_id] = self._refunded.get(original_id, 0) + amount_cents(tx)
+        self._by_date.sort()
+
+    def __len__(self):
+        return len(self.load().transactions)
+
+    def __iter__(self):
+        return iter(self.load().transactions)
+
+    def __getitem__(self, index):
+        return self.load().transactions[index]
+
+    @instrumented("index.add")
+    def _index(self, tx, sort=True):
+        self._by_id[tx["id"]] = tx
+        self._by_bank.setdefault(tx["bank"], {})[tx["id"]] = tx
+        self._by_account.setdefault((tx["bank"], tx["account"]), {})[tx["id"]] = tx
+        if sort:
+            bisect.insort(self._by_date, (tx["date"], tx["id"]))
+        else:
+            self._by_date.append((tx["date"], tx["id"]))
+        original_id = refund_of(tx)
+        if original_id is not None:
+            self._refunds.setdefault(original_id, {})[tx["id"]] = tx
+            self._refunded[original_id] = self._refunded.get(original_id, 0) + amount_cents(tx)
+        key = (tx["bank"], tx["account"])
+        if key in self._history and not self._history[key].append(tx):
+            del self._history[key]
+
+    @instrumented("index.remove")
+    def _unindex(self, tx):
+        del self._by_id[tx["id"]]
+        for index, key in ((self._by_bank, tx["bank"]), (self._by_account, (tx["bank"], tx["account"]))):
+            del index[key][tx["id"]]
+            if not index[key]:
+                del index[key]
+        pos = bisect.bisect_left(self._by_date, (tx["date"], tx["id"]))
+        del self._by_date[pos]
+        original_id = refund_of(tx)
+        if original_id is not None:
+            refunds = self._refunds[original_id]
+            del refunds[tx["id"]]
+            if refunds:
+                self._refunded[original_id] -= amount_cents(tx)
+            else:
+                del self._refunds[original_id]
+                del self._refunded[original_id]
+        history = self._history.get((tx["bank"], tx["account"]))
+        if history is not None:
+            history.remove(tx["id"])
+
+    @property
+    def storage_backed(self):
+        # Only a ledger read from storage shares cache and index files with it.
+        return isinstance(self.transactions, LazyTransactions)
+
+    def search_index(self):
+        if self._search is not None and self._search.stamp is not None and not self._search.stamp.sync():
+            self._search = None  # another process committed since it was built
+        if self._search is None:
+            if not self.storage_backed:
+                self._search = SearchIndex(self.select())
+            else:
+                generation = get_storage().generation()
+                self._search = SearchIndex.load() or SearchIndex(self.select())
+                if self._search.stamp is None:
+                    self._search.stamp = StorageStamp(generation)
+        return self._search
+
+    def complete(self, prefix, limit=20):
+        # Indexed words starting with `prefix`, in alphabetical order.
+        return self.search_index().complete(prefix, limit)
+
+    @instrumented("view.search")
+    def search(self, query, fuzzy=False, since=None, until=None, min_amount=None, max_amount=None):
+        # Rows with a description, bank or account word starting with each
+        # word of `query` (or, with `fuzzy`, one typo away from it), dated in
+        # [since, until) and with an amount in [min_amount, max_amount], by date.
+        ids = self.search_index().match(query, fuzzy)
+        if ids is None:
+            if since is None and until is None:
+                rows = list(self)
+            else:
+                rows = self.between(since or "", until or "\uffff")
+        else:
+            self.load()
+            rows = [self._by_id[tx_id] for tx_id in ids if tx_id in self._by_id]
+            if since is not None:
+                rows = [tx for tx in rows if tx["date"] >= since]
+            if until is not None:
+                rows = [tx for tx in rows if tx["date"] < until]
+            rows.sort(key=lambda tx: (tx["date"], tx["id"]))
+        if min_amount is not None or max_amount is not None:
+            low = float("-inf") if min_amount is None else min_amount
+            high = float("inf") if max_amount is None else max_amount
+            rows = [tx for tx in rows if low <= tx["amount"] <= high]
+        return rows
+
+    def get(self, tx_id):
+        return self.load()._by_id.get(tx_id)
+
+    def add(self, tx):
+        # Adding does not need the whole ledger unless it is already indexed.
+        tx = as_transaction(tx)
+        self.transactions.append(tx)
+        self.uncommitted = True
+        if self._by_id is not None:
+            self._index(tx)
+        self.added(tx)
+        return tx
+
+    def added(self, tx):
+        # Also called for rows committed to storage without going through add().
+        if self._search is not None:
+            self._search.add(tx)
+        if self._aggregates is not None:
+            self._aggregates.add(tx)
+
+    def aggregates(self):
+        if not self.storage_backed:
+            return None
+        if self._aggregates is None:
+            self._aggregates = AggregateCache.load()
+        return self._aggregates
+
+    @instrumented("ledger.save_caches")
+    def save_caches(self):
+        # Writes the search index, aggregate cache and ledger snapshot if they
+        # changed. Nothing is written while the rows hold uncommitted changes,
+        # which the files would otherwise report as stored.
+        if self.uncommitted:
+            return
+        if self.storage_backed and self._search is not None and self._search.changed:
+            self._search.save()
+        if self._aggregates is not None and self._aggregates.changed:
+            self._aggregates.save()
+        if self.storage_backed:
+            self.transactions.save_snapshot()
+
+    @instrumented("index.update")
+    def update(self, tx, **changes):
+        self.load()
+        self.uncommitted = True
+        if self._aggregates is not None:
+            self._aggregates.mark(tx)
+        reindex = self._search is not None and changes.keys() & {"id", "bank", "account", "description"}
+        if reindex:
+            self._search.remove(tx)
+        if not changes.keys() & {"id", "bank", "account", "date", "refunded_transaction_id"}:
+            # Only the amount, type or text changed: adjust the affected indexes in place.
+            original_id = refund_of(tx)
+            if original_id is not None and "amount" in changes:
+                self._refunded[original_id] -= amount_cents(tx)
+            tx.update(changes)
+            if original_id is not None and "amount" in changes:
+                self._refunded[original_id] += amount_cents(tx)
+            if reindex:
+                self._search.add(tx)
+            history = self._history.get((tx["bank"], tx["account"]))
+            if history is not None:
+                history.update(tx)
+            return
+        self._unindex(tx)
+        tx.update(changes)
+        self._index(tx)
+        if reindex:
+            self._search.add(tx)
+        if self._aggregates is not None:
+            self._aggregates.mark(tx)
+
+    def refunds(self, tx_id):
+        # Refunds of `tx_id`, in the order they were recorded or last edited.
+        return list(self.load()._refunds.get(tx_id, {}).values())
+
+    def refunded_cents(self, tx_id):
+        return self.load()._refunded.get(tx_id, 0)
+
+    def refundable_cents(self, tx_id):
+        # What is left to refund of `tx_id`: its amount less earlier refunds.
+        tx = self.get(tx_id)
+        if tx is None:
+            raise ValueError(f"Unknown transaction '{tx_id}'")
+        return amount_cents(tx) - self._refunded.get(tx_id, 0)
+
+    def refund_chain(self, tx_id):
+        # The transaction at the root of `tx_id`'s refunds (following refunds
+        # of refunds up) and everything refunding it, depth first, as
+        # (depth, row) pairs.
+        if self.get(tx_id) is None:
+            raise ValueError(f"Unknown transaction '{tx_id}'")
+        seen = {tx_id}
+        while True:
+            original_id = refund_of(self._by_id[tx_id])
+            if original_id is None or original_id not in self._by_id or original_id in seen:
+                break
+            tx_id = original_id
+            seen.add(tx_id)
+        chain = []
+        seen = set()
+        stack = [(0, self._by_id[tx_id])]
+        while stack:
+            depth, tx = stack.pop()
+            if tx["id"] in seen:
+                continue
+            seen.add(tx["id"])
+            chain.append((depth, tx))
+            refunds = self._refunds.get(tx["id"], {})
+            stack.extend((depth + 1, refund) for refund in reversed(list(refunds.values())))
+        return chain
+
+    def balance_history(self, bank, account):
+        self.load()
+        key = (bank, account)
+        if key not in self._history:
+            self._history[key] = BalanceHistory(self._by_account.get(key, {}).values())
+        return self._history[key]
+
+    def banks(self):
+        if not self.loaded:
+            return get_storage().transaction_banks()
+        return sorted(self.load()._by_bank)
+
+    def accounts(self, bank):
+        if not self.loaded:
+            return get_storage().transaction_accounts(bank)
+        return sorted(account for bank_name, account in self.load()._by_account if bank_name == bank)
+
+    def select(self, bank=None, account=None):
+        # Streams from storage while the ledger is not loaded.
+        if not self.loaded:
+            return get_storage().iter_transactions(bank=bank, account=account)
+        self.load()
+        if bank is None:
+            return iter(self.transactions)
+        if account is None:
+            return iter(self._by_bank.get(bank, {}).values())
+        return iter(self._by_account.get((bank, account), {}).values())
+
+    def between(self, start, end):
+        # Transactions dated in [start, end), in date order.
+        self.load()
+        lo = bisect.bisect_left(self._by_date, (start,))
+        hi = bisect.bisect_left(self._by_date, (end,))
+        return [self._by_id[tx_id] for _, tx_id in self._by_date[lo:hi]]
+
+    def ordered(self, since=None, until=None, reverse=False):
+        # Like between(), but yields rows from the date index one at a time,
+        # newest first with `reverse`.
+        self.load()
+        lo = 0 if since is None else bisect.bisect_left(self._by_date, (since,))
+        hi = len(self._by_date) if until is None else bisect.bisect_left(self._by_date, (until,))
+        positions = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+        for pos in positions:
+            yield self._by_id[self._by_date[pos][1]]
+
+    def _needs_rows(self, by_id):
+        # Rows keyed by account id are renamed and deleted through the setup
+        # alone; the others need the ledger unless storage updates them in bulk.
+        return self.loaded or not (by_id or get_storage().supports_bulk_updates)
+
+    def _rename(self, rows, bank, account=None):
+        # Ids and dates stay the same, so the date index is left alone.
+        for tx in rows:
+            if self._search is not None:
+                self._search.remove(tx)
+            for index, key in ((self._by_bank, tx["bank"]), (self._by_account, (tx["bank"], tx["account"]))):
+                del index[key][tx["id"]]
+                if not index[key]:
+                    del index[key]
+            self._history.pop((tx["bank"], tx["account"]), None)
+            tx["bank"] = bank
+            if account is not None:
+                tx["account"] = account
+            self._by_bank.setdefault(bank, {})[tx["id"]] = tx
+            self._by_account.setdefault((bank, tx["account"]), {})[tx["id"]] = tx
+            self._history.pop((bank, tx["account"]), None)
+            if self._search is not None:
+                self._search.add(tx)
+
+    def rename_bank(self, old_name, new_name):
+        directory = get_directory()
+        by_id = directory.rename(old_name, new_name)
+        renamed = []
+        if self._needs_rows(by_id):
+            self.load()
+            renamed = list(self._by_bank.get(old_name, {}).values())
+            self._rename(renamed, new_name)
+        else:
+            self._search = None  # renamed without the rows; the index is stale
+        if self._aggregates is not None:
+            self._aggregates.rename(old_name, new_name)
+        # Only rows still keyed by name have anything to write.
+        legacy = [tx for tx in renamed if directory.account_id(tx["bank"], tx["account"]) is None]
+        storage = get_storage()
+        if legacy or not by_id or storage.supports_bulk_updates:
+            storage.rename_bank(self.transactions, old_name, new_name, legacy)
+
+    def rename_account(self, bank, old_name, new_name):
+        directory = get_directory()
+        by_id = directory.rename(bank, bank, old_name, new_name)
+        renamed = []
+        if self._needs_rows(by_id):
+            self.load()
+            renamed = list(self._by_account.get((bank, old_name), {}).values())
+            self._rename(renamed, bank, new_name)
+        else:
+            self._search = None
+        if self._aggregates is not None:
+            self._aggregates.rename(bank, bank, old_name, new_name)
+        legacy = [tx for tx in renamed if directory.account_id(tx["bank"], tx["account"]) is None]
+        storage = get_storage()
+        if legacy or not by_id or storage.supports_bulk_updates:
+            storage.rename_account(self.transactions, bank, old_name, new_name, legacy)
+
+    def delete(self, bank, account=None):
+        # Rows of accounts with ids are only hidden here and purged from
+        # storage in the background. Returns those account ids, which the
+        # caller lists under the setup's "deleted_account_ids".
+        directory = get_directory()
+        by_id = directory.account_ids(bank, account)
+        deleted = []
+        if self._needs_rows(by_id):
+            self.load()
+            if account is None:
+                rows = self._by_bank.get(bank, {})
+            else:
+                rows = self._by_account.get((bank, account), {})
+            gone = set(rows)
+            for tx in list(rows.values()):
+                if directory.account_id(tx["bank"], tx["account"]) is None:
+                    deleted.append(tx["id"])
+                self._unindex(tx)
+                if self._search is not None:
+                    self._search.remove(tx)
+            self.transactions[:] = [tx for tx in self.transactions if tx["id"] not in gone]
+        else:
+            self._search = None
+        directory.delete(bank, account)
+        if self._aggregates is not None:
+            self._aggregates.drop(bank, account)
+        storage = get_storage()
+        if deleted or not by_id or storage.supports_bulk_updates:
+            storage.delete_transactions(self.transactions, bank, account, deleted)
+        if by_id:
+            storage.purge(background=True)
+        return by_id
+
+
+def _words(text):
+    return set(re.findall(r"\w+", (text or "").lower()))
+
+
+def as_ledger(transactions):
+    return transactions if isinstance(transactions, Ledger) else Ledger(transactions)
+
+
+# --- Search Index ---
+
+SEARCH_INDEX_FILE = "search.index.json"
+
+# Query words shorter than this are only matched as prefixes, never fuzzily
+FUZZY_MIN_LENGTH = 4
+
+
+def _tokens(tx):
+    return _words(tx["description"]) | _words(tx["bank"]) | _words(tx["account"])
+
+
+def _deletions(word):
+    # The word itself and every way of dropping one character from it.
+    return {word} | {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+class SearchIndex:
+    # Inverted index from description, bank and account words to transaction
+    # ids, with the words also kept sorted for prefix lookups. Fuzzy lookups
+    # go through a one-deletion index (each word and its variants with one
+    # character dropped map to the word), so words one edit or adjacent
+    # swap away are found without comparing against the whole vocabulary.
+    # A storage-backed Ledger keeps it in search.index.json, stamped with
+    # the storage generation, and reports every change to it.
+    VERSION = 1
+
+    @instrumented("index.search_build")
+    def __init__(self, rows=()):
+        self.words = {}  # word -> ids
+        for tx in rows:
+            for word in _tokens(tx):
+                self.words.setdefault(word, set()).add(tx["id"])
+        self.word_list = sorted(self.words)
+        self._deletions = None  # built on the first fuzzy query
+        self.stamp = None
+        self.changed = True
+
+    @classmethod
+    def load(cls):
+        # The saved index, or None if it is missing or another process has committed since.
+        if not os.path.exists(SEARCH_INDEX_FILE):
+            return None
+        try:
+            with open(SEARCH_INDEX_FILE, "r") as f:
+                data = json.load(f)
+        except ValueError:
+            return None
+        if data.get("version") != cls.VERSION or data.get("generation") != get_storage().generation():
+            return None
+        index = cls()
+        index.words = {word: set(ids) for word, ids in data["words"].items()}
+        index.word_list = sorted(index.words)
+        index.stamp = StorageStamp(data["generation"])
+        index.changed = False
+        return index
+
+    def save(self):
+        if not self.stamp.sync():
+            return  # stale: rebuilt on next use instead
+        data = {
+            "version": self.VERSION,
+            "generation": self.stamp.generation,
+            "words": {word: sorted(ids) for word, ids in self.words.items()},
+        }
+        _write_atomic(SEARCH_INDEX_FILE, lambda f: json.dump(data, f, separators=(",", ":")))
+        self.changed = False
+
+    def add(self, tx):
+        for word in _tokens(tx):
+            if word not in self.words:
+                self.words[word] = set()
+                bisect.insort(self.word_list, word)
+                if self._deletions is not None:
+                    for variant in _deletions(word):
+                        self._deletions.setdefault(variant, set()).add(word)
+            self.words[word].add(tx["id"])
+        self.changed = True
+
+    def remove(self, tx):
+        for word in _tokens(tx):
+            ids = self.words.get(word)
+            if ids is None:
+                continue
+            ids.discard(tx["id"])
+            if not ids:
+                del self.words[word]
+                del self.word_list[bisect.bisect_left(self.word_list, word)]
+                if self._deletions is not None:
+                    for variant in _deletions(word):
+                        self._deletions[variant].discard(word)
+        self.changed = True
+
+    def _prefixed(self, prefix, limit=None):
+        start = bisect.bisect_left(self.word_list, prefix)
+        for word in itertools.islice(self.word_list, start, None if limit is None else start + limit):
+            if not word.startswith(prefix):
+                break
+            yield word
+
+    def _similar(self, word):
+        if self._deletions is None:
+            self._deletions = {}
+            for known in self.words:
+                for variant in _deletions(known):
+                    self._deletions.setdefault(variant, set()).add(known)
+        similar = set()
+        for variant in _deletions(word):
+            similar |= self._deletions.get(variant, set())
+        return similar
+
+    def complete(self, prefix, limit=20):
+        return list(self._prefixed(prefix.lower(), limit))
+
+    def match(self, query, fuzzy=False):
+        # Ids matching every word of `query`, or None if it has no words.
+        # Only the most selective word's postings are copied; the others are
+        # probed, so a common word costs nothing beyond its lookups.
+        postings = []
+        for token in _words(query):
+            words = set(self._prefixed(token))
+            if fuzzy and len(token) >= FUZZY_MIN_LENGTH:
+                words |= self._similar(token)
+            sets = [self.words[word] for word in words]
+            postings.append((sum(len(ids) for ids in sets), sets))
+        if not postings:
+            return None
+        postings.sort(key=lambda posting: posting[0])
+        ids = set().union(*postings[0][1])
+        for _, sets in postings[1:]:
+            if len(sets) == 1:
+                ids &= sets[0]
+            else:
+                ids = {tx_id for tx_id in ids if any(tx_id in other for other in sets)}
+        return ids
+
+
+# --- Balance Engine ---
+
+BALANCE_CHECKPOINT_FILE = "balances.checkpoint.json"
+
+
+def transaction_effect(tx):
+    return tx["amount"] if tx["type"] == "deposit" else -tx["amount"]
+
+
+def amount_cents(tx):
+    return tx.cents if isinstance(tx, Transaction) else to_cents(tx["amount"])
+
+
+def transaction_cents(tx):
+    # transaction_effect() in exact cents.
+    cents = amount_cents(tx)
+    return cents if tx["type"] == "deposit" else -cents
+
+
+class BalanceEngine:
+    # Keeps account balances and per-bank totals of a setup up to date as
+    # transactions are posted, edited or refunded, instead of re-summing
+    # every account on each render. Every CHECKPOINT_EVERY postings the
+    # balances are written next to the journal position they correspond to,
+    # so recovery only has to replay the journal tail. Balances are kept in
+    # cents; each account's "balance" is rewritten from them on every post.
+    CHECKPOINT_EVERY = 1000
+
+    def __init__(self, setup_data):
+        self.setup_data = setup_data
+        self._since_checkpoint = 0
+        self.rebuild()
+
+    def reset(self):
+        # Called after banks or accounts are added, renamed or removed; the
+        # last checkpoint no longer matches the accounts, so it is dropped.
+        self.rebuild()
+        if os.path.exists(BALANCE_CHECKPOINT_FILE):
+            os.remove(BALANCE_CHECKPOINT_FILE)
+
+    def rebuild(self):
+        self._accounts = {}
+        self._cents = {}
+        self._bank_cents = {}
+        for bank in self.setup_data["banks"]:
+            self._bank_cents[bank["name"]] = 0
+            for account in bank["accounts"]:
+                key = (bank["name"], account["name"])
+                self._accounts[key] = account
+                self._cents[key] = to_cents(account["balance"])
+                self._bank_cents[bank["name"]] += self._cents[key]
+
+    def account(self, bank, account):
+        return self._accounts.get((bank, account))
+
+    def account_cents(self, bank, account):
+        return self._cents.get((bank, account))
+
+    def bank_cents(self, bank):
+        return self._bank_cents.get(bank, 0)
+
+    def bank_total(self, bank):
+        return self.bank_cents(bank) / 100
+
+    def post(self, bank, account, cents):
+        key = (bank, account)
+        record = self._accounts.get(key)
+        if record is None:
+            return False
+        self._cents[key] += cents
+        record["balance"] = self._cents[key] / 100
+        self._bank_cents[bank] += cents
+        self._since_checkpoint += 1
+        return True
+
+    def apply(self, tx, sign=1):
+        return self.post(tx["bank"], tx["account"], sign * transaction_cents(tx))
+
+    def commit(self):
+        # Call once the setup has been saved after postings.
+        if self._since_checkpoint >= self.CHECKPOINT_EVERY:
+            self.checkpoint()
+
+    def checkpoint(self):
+        position = get_storage().journal_position()
+        self._since_checkpoint = 0
+        if position is None:
+            return False
+        cents = {}
+        for (bank, account), value in self._cents.items():
+            cents.setdefault(bank, {})[account] = value
+        tmp_file = f"{BALANCE_CHECKPOINT_FILE}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"position": position, "cents": cents}, f)
+        os.replace(tmp_file, BALANCE_CHECKPOINT_FILE)
+        return True
+
+
+_balances = None
+
+
+def get_balances(setup_data):
+    global _balances
+    if _balances is None or _balances.setup_data is not setup_data:
+        _balances = BalanceEngine(setup_data)
+    return _balances
+
+
+def _opening_balances(setup_data):
+    # Opening balances in cents, None where none was recorded.
+    return {
+        (bank["name"], account["name"]): (
+            None if account.get("opening_balance") is None else to_cents(account["opening_balance"])
+        )
+        for bank in setup_data["banks"]
+        for account in bank["accounts"]
+    }
+
+
+def _row_names(row, directory):
+    if row.get("account_id") is not None:
+        return directory.names(row["account_id"]) or (None, None)
+    return row["bank"], row["account"]
+
+
+def _record_deltas(record, directory):
+    if record["op"] == "put":
+        tx = record["tx"]
+        yield (*_row_names(tx, directory), transaction_cents(tx))
+    elif "was" in record:
+        was = record["was"]
+        yield (*_row_names(was, directory), -transaction_cents(was))
+        if record["op"] == "patch":
+            now = dict(was, **{key: record["set"][key] for key in BALANCE_FIELDS if key in record["set"]})
+            yield (*_row_names(now, directory), transaction_cents(now))
+
+
+SUM_BATCH_ROWS = 65536
+
+
+def account_sums(rows):
+    # Signed cents per (bank, account) over `rows`, summed a batch at a time
+    # over integer arrays.
+    keys = {}
+    totals = {}
+    rows = iter(rows)
+    while True:
+        codes = array.array("I")
+        cents = array.array("q")
+        for tx in itertools.islice(rows, SUM_BATCH_ROWS):
+            key = (tx["bank"], tx["account"])
+            code = keys.get(key)
+            if code is None:
+                code = keys[key] = len(keys)
+            codes.append(code)
+            cents.append(transaction_cents(tx))
+        if not cents:
+            return totals
+        for key, value in zip(keys, sum_cents(cents, codes, len(keys))):
+            totals[key] = totals.get(key, 0) + value
+
+
+def history_cents(setup_data, use_checkpoint=True):
+    # Balances implied by the transaction history, in cents: the last
+    # checkpoint plus the journal written after it, or else the opening
+    # balances plus every transaction. Accounts without a recorded opening
+    # balance map to None.
+    storage = get_storage()
+    checkpoint = None
+    if use_checkpoint and os.path.exists(BALANCE_CHECKPOINT_FILE):
+        with open(BALANCE_CHECKPOINT_FILE, "r") as f:
+            checkpoint = json.load(f)
+        if "cents" not in checkpoint:  # written before balances were kept in cents
+            checkpoint["cents"] = {
+                bank: {account: to_cents(balance) for account, balance in accounts.items()}
+                for bank, accounts in checkpoint["balances"].items()
+            }
+    tail = storage.iter_records(checkpoint["position"]) if checkpoint else None
+    if tail is not None:
+        totals = {
+            (bank, account): cents
+            for bank, accounts in checkpoint["cents"].items()
+            for account, cents in accounts.items()
+        }
+        directory = get_directory()
+        for bank, account, delta in (delta for record in tail for delta in _record_deltas(record, directory)):
+            if (bank, account) in totals:
+                totals[(bank, account)] += delta
+        return {key: totals.get(key) for key in _opening_balances(setup_data)}
+
+    totals = _opening_balances(setup_data)
+    for key, cents in account_sums(storage.iter_transactions()).items():
+        if totals.get(key) is not None:
+            totals[key] += cents
+    return totals
+
+
+def history_balances(setup_data, use_checkpoint=True):
+    return {
+        key: None if cents is None else cents / 100
+        for key, cents in history_cents(setup_data, use_checkpoint).items()
+    }
+
+
+def check_balance_integrity(setup_data, use_checkpoint=False):
+    # Returns (bank, account, stored, expected) for every account whose stored
+    # balance differs from its history by as much as a cent. Accounts created
+    # before opening balances were tracked get one recorded from their
+    # current state.
+    expected = history_cents(setup_data, use_checkpoint=use_checkpoint)
+    history = None
+    drift = []
+    for bank in setup_data["banks"]:
+        for account in bank["accounts"]:
+            cents = expected.get((bank["name"], account["name"]))
+            stored = to_cents(account["balance"])
+            if cents is None:
+                if history is None:
+                    history = account_sums(get_storage().iter_transactions())
+                opening = stored - history.get((bank["name"], account["name"]), 0)
+                account["opening_balance"] = opening / 100
+            elif cents != stored:
+                drift.append((bank["name"], account["name"], account["balance"], cents / 100))
+    return drift
+
+
+def repair_balances(setup_data, drift):
+    for bank, account, stored, expected in drift:
+        get_balances(setup_data).account(bank, account)["balance"] = expected
+    get_balances(setup_data).rebuild()
+
+
+# --- Ledger Audit ---
+# A full recompute of every account from its transactions, for ledgers too
+# big to check in one process. Rows are read once and split by (bank,
+# account); each shard's balance, refund totals and anomalies are worked
+# out in a pool of worker processes and the results merged and compared
+# with the setup. Where processes fork, workers inherit the shards instead
+# of receiving them pickled.
+
+_audit_shards = {}
+
+
+def _audit_shard(key, opening, rows=None):
+    # Totals and anomalies of one (bank, account) shard. Refunds of rows in
+    # other shards are returned under "external_refunds" for the merge.
+    if rows is None:
+        rows = _audit_shards[key]
+    ids = {}
+    anomalies = []
+    deposits = withdrawals = refunded = refund_count = 0
+    refunds = {}  # original id -> refund rows
+    dated = []
+    for tx in rows:
+        tx_id = tx["id"]
+        if tx_id in ids:
+            anomalies.append((tx_id, "duplicate id"))
+        ids[tx_id] = tx
+        try:
+            cents = to_cents(tx["amount"])
+        except (TypeError, ValueError):
+            anomalies.append((tx_id, f"invalid amount {tx['amount']!r}"))
+            continue
+        if cents <= 0:
+            anomalies.append((tx_id, f"non-positive amount {format_money(cents)}"))
+        if tx["type"] == "deposit":
+            deposits += cents
+        elif tx["type"] == "withdrawal":
+            withdrawals += cents
+            cents = -cents
+        else:
+            anomalies.append((tx_id, f"unknown type {tx['type']!r}"))
+            continue
+        try:
+            datetime.datetime.fromisoformat(tx["date"])
+        except (TypeError, ValueError):
+            anomalies.append((tx_id, f"invalid date {tx['date']!r}"))
+        else:
+            dated.append((tx["date"], cents))
+        original_id = tx.get("refunded_transaction_id")
+        if original_id is not None:
+            refund_count += 1
+            refunded += abs(cents)
+            refunds.setdefault(original_id, []).append(tx)
+    external = {}
+    for original_id, refund_rows in refunds.items():
+        cents = sum(to_cents(tx["amount"]) for tx in refund_rows)
+        original = ids.get(original_id)
+        if original is None:
+            external[original_id] = cents
+            continue
+        for tx in refund_rows:
+            if tx["id"] == original_id:
+                anomalies.append((tx["id"], "refunds itself"))
+            elif tx["type"] == original["type"]:
+                anomalies.append((tx["id"], f"refund has the same type as {original_id}"))
+        if cents > to_cents(original["amount"]):
+            anomalies.append((original_id, f"refunded {format_money(cents)}, more than its amount"))
+    lowest = None
+    if opening is not None:
+        dated.sort()
+        running = opening
+        lowest = (opening, None)
+        for date, cents in dated:
+            running += cents
+            if running < lowest[0]:
+                lowest = (running, date)
+    return {
+        "bank": key[0], "account": key[1], "rows": len(ids),
+        "deposits": deposits, "withdrawals": withdrawals, "net": deposits - withdrawals,
+        "refunds": refund_count, "refunded": refunded, "lowest": lowest,
+        "anomalies": anomalies, "external_refunds": external,
+    }
+
+
+def _audit_pool(workers):
+    # Forked workers see the shards as they were when the pool started.
+    if "fork" in multiprocessing.get_all_start_methods():
+        return futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")), True
+    return futures.ProcessPoolExecutor(workers), False
+
+
+def audit_ledger(setup_data, workers=None, rows=None):
+    # Recomputes every account from `rows` (default: all of storage) with
+    # `workers` processes (default: one per core; 1 works in-process).
+    # Returns {"accounts": per-account results in cents, "drift": (bank,
+    # account, stored, expected) like check_balance_integrity(), "anomalies":
+    # (transaction id, problem) pairs, "inferred": (bank, account, opening)
+    # for accounts without an opening balance, "workers", "shards", "rows"}.
+    global _audit_shards
+    workers = workers or os.cpu_count() or 1
+    openings = _opening_balances(setup_data)
+    shards = {}
+    owners = {}
+    anomalies = []
+    for tx in get_storage().iter_transactions() if rows is None else rows:
+        key = (tx["bank"], tx["account"])
+        other = owners.get(tx["id"])
+        if other is not None and (other["bank"], other["account"]) != key:
+            anomalies.append((tx["id"], "duplicate id in another account"))
+        owners[tx["id"]] = tx
+        shards.setdefault(key, []).append(tx)
+    # Largest shards first, so a big account does not start last.
+    keys = sorted(shards, key=lambda key: len(shards[key]), reverse=True)
+    workers = max(1, min(workers, len(keys)))
+    if workers == 1:
+        results = [_audit_shard(key, openings.get(key), shards[key]) for key in keys]
+    else:
+        _audit_shards = shards
+        try:
+            pool, forked = _audit_pool(workers)
+            with pool:
+                results = list(pool.map(
+                    _audit_shard, keys, [openings.get(key) for key in keys],
+                    *([] if forked else [[shards[key] for key in keys]]),
+                ))
+        finally:
+            _audit_shards = {}
+
+    accounts = {}
+    drift = []
+    inferred = []
+    for result in results:
+        key = (result["bank"], result["account"])
+        accounts[key] = result
+        anomalies.extend(result["anomalies"])
+        for original_id, cents in result["external_refunds"].items():
+            original = owners.get(original_id)
+            if original is None:
+                anomalies.append((original_id, f"refunded {format_money(cents)} but does not exist"))
+            else:
+                anomalies.append((original_id, f"refunded from another account {key[0]} / {key[1]}"))
+        if key not in openings:
+            anomalies.append((None, f"transactions for unknown account {key[0]} / {key[1]}"))
+    balances = get_balances(setup_data)
+    for (bank, account), opening in openings.items():
+        result = accounts.get((bank, account))
+        stored = balances.account(bank, account)["balance"]
+        if opening is None:
+            # Nothing to check the history against: the opening balance is
+            # inferred from the stored one, as check_balance_integrity() does.
+            inferred.append((bank, account, (to_cents(stored) - (result["net"] if result else 0)) / 100))
+            continue
+        expected = opening + (result["net"] if result else 0)
+        if expected != to_cents(stored):
+            drift.append((bank, account, stored, expected / 100))
+    return {
+        "accounts": accounts, "drift": drift, "anomalies": anomalies, "inferred": inferred,
+        "workers": workers, "shards": len(keys), "rows": sum(result["rows"] for result in results),
+    }
+
+
+def format_audit(audit):
+    lines = [f"Audited {audit['rows']} transactions in {audit['shards']} accounts "
+             f"with {audit['workers']} worker{'s' if audit['workers'] != 1 else ''}."]
+    for (bank, account), result in sorted(audit["accounts"].items()):
+        line = (f"  - {bank} / {account}: {result['rows']} rows, net {format_money(result['net'])}, "
+                f"{result['refunds']} refunds ({format_money(result['refunded'])})")
+        if result["lowest"] is not None and result["lowest"][1] is not None:
+            line += f", lowest {format_money(result['lowest'][0])} on {result['lowest'][1][:10]}"
+        lines.append(line)
+    for bank, account, stored, expected in audit["drift"]:
+        lines.append(f"Balance drift: {bank} / {account}: stored {Money.of(stored)}, history {Money.of(expected)}")
+    for tx_id, problem in audit["anomalies"]:
+        lines.append(f"Anomaly: {tx_id}: {problem}" if tx_id else f"Anomaly: {problem}")
+    for bank, account, opening in audit["inferred"]:
+        lines.append(f"Unverified: {bank} / {account}: no opening balance recorded, "
+                     f"inferred {Money.of(opening)} from the stored balance")
+    if not audit["drift"] and not audit["anomalies"]:
+        lines.append("No drift or anomalies found.")
+    return lines
+
+
+# --- Point-in-time Balances ---
+
+class BalanceHistory:
+    # Running balance of one account over time: a Fenwick tree over the
+    # signed amounts of its transactions in date order, so the balance as of
+    # any date is a bisect plus a prefix sum, both O(log n). Changing or
+    # removing a row and appending one dated after all others are O(log n);
+    # anything else asks the owner to rebuild. Sums are kept in cents.
+    @instrumented("index.balance_history")
+    def __init__(self, rows=()):
+        entries = sorted((tx["date"], tx["id"], transaction_cents(tx)) for tx in rows)
+        self.dates = [date for date, _, _ in entries]
+        self.positions = {tx_id: pos for pos, (_, tx_id, _) in enumerate(entries)}
+        self.values = [value for _, _, value in entries]
+        self.tree = [0] + self.values
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def _prefix(self, count):
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def _add(self, pos, delta):
+        i = pos + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def total_cents(self):
+        return self._prefix(len(self.values))
+
+    def cents_before(self, moment):
+        return self._prefix(bisect.bisect_left(self.dates, moment))
+
+    def total(self):
+        return self.total_cents() / 100
+
+    def total_before(self, moment):
+        return self.cents_before(moment) / 100
+
+    def append(self, tx):
+        if self.dates and tx["date"] < self.dates[-1]:
+            return False
+        value = transaction_cents(tx)
+        i = len(self.tree)
+        # The new node covers (i - lowbit(i), i]; all but the last slot already exist.
+        self.tree.append(value + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+        self.dates.append(tx["date"])
+        self.positions[tx["id"]] = len(self.values)
+        self.values.append(value)
+        return True
+
+    def update(self, tx):
+        pos = self.positions.get(tx["id"])
+        if pos is None or self.dates[pos] != tx["date"]:
+            return False
+        value = transaction_cents(tx)
+        self._add(pos, value - self.values[pos])
+        self.values[pos] = value
+        return True
+
+    def remove(self, tx_id):
+        pos = self.positions.pop(tx_id)
+        self._add(pos, -self.values[pos])
+        self.values[pos] = 0
+
+
+def balance_at(setup_data, transactions, bank, account, moment):
+    # Balance of an account as of `moment`, i.e. including transactions dated before it.
+    if isinstance(moment, (datetime.date, datetime.datetime)):
+        moment = moment.isoformat()
+    record = get_balances(setup_data).account(bank, account)
+    if record is None:
+        raise KeyError(f"Unknown account {bank} / {account}")
+    history = as_ledger(transactions).balance_history(bank, account)
+    opening = record.get("opening_balance")
+    if opening is None:
+        opening = to_cents(record["balance"]) - history.total_cents()
+    else:
+        opening = to_cents(opening)
+    return (opening + history.cents_before(moment)) / 100
+
+
+# --- Reports ---
+
+def _numpy_column(values, dtype):
+    # Zero-copy view of an array.array column (frombuffer rejects empty buffers on older NumPy).
+    return np.frombuffer(values, dtype=dtype) if len(values) else np.zeros(0, dtype=dtype)
+
+
+class ReportFrame:
+    # NumPy columns of a set of transactions: bank/account/description codes
+    # into name tables, amounts as int64 cents with a +1/-1 sign, dates as
+    # datetime64[us] and a refund mask. Reports group with bincount over
+    # these codes instead of looping over rows.
+    def __init__(self, names, texts, banks, accounts, signs, cents, dates, descriptions, refunds):
+        self.names = names
+        self.texts = texts
+        self.banks = banks
+        self.accounts = accounts
+        self.signs = signs
+        self.cents = cents
+        self.dates = dates
+        self.descriptions = descriptions
+        self.refunds = refunds
+
+    @classmethod
+    def from_columns(cls, columns):
+        if not _importable(np):
+            raise ValueError("Reports need NumPy: pip install numpy")
+        dates = _numpy_column(columns.dates, np.int64).copy()
+        valid = np.ones(len(columns), dtype=bool)
+        for row, value in columns.odd_dates.items():
+            try:
+                moment = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                valid[row] = False
+                continue
+            if moment.tzinfo is not None:
+                moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            dates[row] = _encode_date(moment.isoformat())
+        refunds = np.zeros(len(columns), dtype=bool)
+        refunds[list(columns.refunded_ids)] = True
+        frame = cls(
+            columns.names,
+            columns.texts,
+            _numpy_column(columns.banks, np.uint32),
+            _numpy_column(columns.accounts, np.uint32),
+            _numpy_column(columns.signs, np.int8),
+            _numpy_column(columns.amounts, np.int64),
+            dates.view("datetime64[us]"),
+            _numpy_column(columns.descriptions, np.uint32),
+            refunds,
+        )
+        # Rows whose date cannot be placed on the calendar are left out.
+        return frame if valid.all() else frame.select(valid)
+
+    def __len__(self):
+        return len(self.cents)
+
+    def select(self, mask):
+        return ReportFrame(
+            self.names, self.texts, self.banks[mask], self.accounts[mask], self.signs[mask],
+            self.cents[mask], self.dates[mask], self.descriptions[mask], self.refunds[mask],
+        )
+
+    def between(self, since=None, until=None):
+        mask = np.ones(len(self), dtype=bool)
+        if since is not None:
+            mask &= self.dates >= np.datetime64(since, "us")
+        if until is not None:
+            mask &= self.dates < np.datetime64(until, "us")
+        return self.select(mask)
+
+    def flows(self):
+        # Income and expense in cents per row. Refunds reduce expense rather
+        # than count as income.
+        income = np.where((self.signs > 0) & ~self.refunds, self.cents, 0)
+        expense = np.where(self.signs < 0, self.cents, 0) - np.where(self.refunds, self.cents, 0)
+        return income, expense
+
+    def months(self):
+        # Months since 1970-01, and the first of them.
+        months = self.dates.astype("datetime64[M]").astype(np.int64)
+        return months, (int(months.min()) if len(months) else 0)
+
+
+def report_frame(ledger, bank=None, account=None, since=None, until=None):
+    frame = ReportFrame.from_columns(ColumnarTransactions(as_ledger(ledger).select(bank=bank, account=account)))
+    return frame.between(since, until) if since or until else frame
+
+
+def _sums(keys, weights, size):
+    # Per-key totals; float64 holds cent sums exactly up to 2**53.
+    return np.rint(np.bincount(keys, weights=weights, minlength=size)).astype(np.int64)
+
+
+def _dollars(cents):
+    return int(cents) / 100
+
+
+def _month_name(month):
+    return f"{1970 + month // 12:04d}-{month % 12 + 1:02d}"
+
+
+def monthly_report(frame):
+    if not len(frame):
+        return []
+    months, first = frame.months()
+    keys = months - first
+    size = int(keys.max()) + 1
+    income, expense = frame.flows()
+    income, expense = _sums(keys, income, size), _sums(keys, expense, size)
+    counts = np.bincount(keys, minlength=size)
+    return [
+        {"month": _month_name(first + i), "income": _dollars(income[i]), "expense": _dollars(expense[i]),
+         "net": _dollars(income[i] - expense[i]), "count": int(counts[i])}
+        for i in np.flatnonzero(counts)
+    ]
+
+
+def account_report(frame):
+    if not len(frame):
+        return []
+    width = len(frame.names)
+    keys = frame.banks.astype(np.int64) * width + frame.accounts
+    size = int(keys.max()) + 1
+    income, expense = frame.flows()
+    income, expense = _sums(keys, income, size), _sums(keys, expense, size)
+    counts = np.bincount(keys, minlength=size)
+    rows = [
+        {"bank": frame.names[key // width], "account": frame.names[key % width],
+         "income": _dollars(income[key]), "expense": _dollars(expense[key]),
+         "net": _dollars(income[key] - expense[key]), "count": int(counts[key])}
+        for key in np.flatnonzero(counts)
+    ]
+    return sorted(rows, key=lambda row: (row["bank"], row["account"]))
+
+
+def description_report(frame, limit=10):
+    # Descriptions with the most spending.
+    if not len(frame):
+        return []
+    size = len(frame.texts)
+    expense = _sums(frame.descriptions, frame.flows()[1], size)
+    counts = np.bincount(frame.descriptions, minlength=size)
+    limit = min(limit, size)
+    top = np.argpartition(-expense, limit - 1)[:limit]
+    top = top[np.lexsort((top, -expense[top]))]
+    return [
+        {"description": frame.texts[code], "expense": _dollars(expense[code]), "count": int(counts[code])}
+        for code in top
+        if counts[code]
+    ]
+
+
+def rolling_report(frame, window=3):
+    # Monthly income, expense and net with their trailing `window`-month
+    # averages; months without transactions count as zero.
+    if not len(frame):
+        return []
+    months, first = frame.months()
+    keys = months - first
+    size = int(keys.max()) + 1
+    income, expense = frame.flows()
+    income, expense = _sums(keys, income, size), _sums(keys, expense, size)
+    kernel = np.ones(window)
+    # Trailing sums over at most `window` months, divided by how many there were.
+    divisor = np.minimum(np.arange(1, size + 1), window)
+    averages = {
+        name: np.convolve(values, kernel)[:size] / divisor / 100
+        for name, values in (("income", income), ("expense", expense), ("net", income - expense))
+    }
+    return [
+        {"month": _month_name(first + i), "income": _dollars(income[i]), "expense": _dollars(expense[i]),
+         "net": _dollars(income[i] - expense[i]),
+         **{f"{name}_avg": round(float(values[i]), 2) for name, values in averages.items()}}
+        for i in range(size)
+    ]
+
+
+REPORTS = {
+    "monthly": monthly_report,
+    "accounts": account_report,
+    "descriptions": description_report,
+    "rolling": rolling_report,
+}
+
+
+def run_report(ledger, name, bank=None, account=None, since=None, until=None, **options):
+    ledger = as_ledger(ledger)
+    rows = cached_report(ledger, name, bank, account, since, until, **options)
+    if rows is not None:
+        return rows
+    frame = report_frame(ledger, bank=bank, account=account, since=since, until=until)
+    return REPORTS[name](frame, **options)
+
+
+def format_report(rows):
+    # Plain-text table: one header line, then one line per row.
+    if not rows:
+        return ["No transactions in range."]
+    columns = list(rows[0])
+    cells = [[f"{row[c]:.2f}" if isinstance(row[c], float) else str(row[c]) for c in columns] for row in rows]
+    widths = [max(len(c), *(len(line[i]) for line in cells)) for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths)).rstrip()]
+    for line in cells:
+        lines.append("  ".join(
+            value.rjust(w) if isinstance(rows[0][c], (int, float)) else value.ljust(w)
+            for value, c, w in zip(line, columns, widths)
+        ).rstrip())
+    return lines
+
+
+# --- Aggregate Cache ---
+
+AGGREGATE_CACHE_FILE = "aggregates.cache.json"
+
+
+def _periods(tx):
+    # (month, day) of a transaction as "YYYY-MM"/"YYYY-MM-DD" in UTC, or None
+    # for dates reports cannot place.
+    try:
+        moment = datetime.datetime.fromisoformat(tx["date"])
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc)
+    day = moment.date().isoformat()
+    return day[:7], day
+
+
+def _bucket_values(tx):
+    # [income, expense, net, count] in cents, with the same refund rule as ReportFrame.flows.
+    cents = amount_cents(tx)
+    refund = "refunded_transaction_id" in tx
+    deposit = tx["type"] == "deposit"
+    income = cents if deposit and not refund else 0
+    expense = (0 if deposit else cents) - (cents if refund else 0)
+    return [income, expense, cents if deposit else -cents, 1]
+
+
+def _add_values(bucket, values, sign=1):
+    for i, value in enumerate(values):
+        bucket[i] += sign * value
+
+
+def _next_month(month):
+    year, number = int(month[:4]), int(month[5:7])
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}"
+
+
+class AggregateCache:
+    # Income, expense, net and count per (bank, account, month) and per
+    # (bank, account, day), kept in aggregates.cache.json so reports do not
+    # re-scan the ledger. Month buckets cover the whole ledger once built;
+    # day buckets are filled on demand and the least recently used are
+    # evicted past MAX_DAY_BUCKETS. The Ledger reports every change: new
+    # rows are added to their buckets, edits mark the old and new buckets
+    # dirty for lazy recomputation, renames re-key buckets and deletes drop
+    # them. The file is stamped with the storage generation; if other
+    # processes committed since, the whole cache is discarded.
+    VERSION = 1
+    MAX_DAY_BUCKETS = 50000
+
+    def __init__(self):
+        self.months = {}  # (bank, account, "YYYY-MM") -> [income, expense, net, count]
+        self.days = {}  # (bank, account, "YYYY-MM-DD") -> same, least recently used first
+        self.dirty = set()
+        self.complete = False  # month buckets cover every transaction
+        self.stamp = StorageStamp()
+        self.changed = False
+
+    @classmethod
+    def load(cls):
+        cache = cls()
+        if os.path.exists(AGGREGATE_CACHE_FILE):
+            try:
+                with open(AGGREGATE_CACHE_FILE, "r") as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+            if data.get("version") == cls.VERSION and data.get("generation") == get_storage().generation():
+                cache.months = {tuple(row[:3]): row[3:] for row in data["months"]}
+                cache.days = {tuple(row[:3]): row[3:] for row in data["days"]}
+                cache.dirty = {tuple(key) for key in data["dirty"]}
+                cache.complete = data["complete"]
+                cache.stamp = StorageStamp(data["generation"])
+        return cache
+
+    def save(self):
+        if not self.sync():
+            return
+        data = {
+            "version": self.VERSION,
+            "generation": self.stamp.generation,
+            "complete": self.complete,
+            "months": [list(key) + values for key, values in self.months.items()],
+            "days": [list(key) + values for key, values in self.days.items()],
+            "dirty": sorted(self.dirty),
+        }
+        _write_atomic(AGGREGATE_CACHE_FILE, lambda f: json.dump(data, f, separators=(",", ":")))
+        self.changed = False
+
+    def sync(self):
+        # Starts over if another process committed since the cache was stamped.
+        valid = self.stamp.sync()
+        if not valid:
+            self.invalidate()
+        return valid
+
+    def invalidate(self):
+        self.months.clear()
+        self.days.clear()
+        self.dirty.clear()
+        self.complete = False
+        self.changed = True
+
+    # Ledger notifications
+
+    def add(self, tx):
+        periods = _periods(tx)
+        if periods is None:
+            return
+        values = _bucket_values(tx)
+        month = (tx["bank"], tx["account"], periods[0])
+        if month not in self.dirty:
+            if month in self.months:
+                _add_values(self.months[month], values)
+            elif self.complete:
+                self.months[month] = values
+        day = (tx["bank"], tx["account"], periods[1])
+        if day in self.days and day not in self.dirty:
+            _add_values(self.days[day], values)
+        self.changed = True
+
+    def mark(self, tx):
+        periods = _periods(tx)
+        if periods is None:
+            return
+        self.dirty.add((tx["bank"], tx["account"], periods[0]))
+        day = (tx["bank"], tx["account"], periods[1])
+        if day in self.days:
+            self.dirty.add(day)
+        self.changed = True
+
+    def rename(self, bank, new_bank, account=None, new_account=None):
+        for buckets in (self.months, self.days):
+            for key in [key for key in buckets if key[0] == bank and (account is None or key[1] == account)]:
+                new_key = (new_bank, key[1] if account is None else new_account, key[2])
+                buckets[new_key] = buckets.pop(key)
+                if key in self.dirty:
+                    self.dirty.discard(key)
+                    self.dirty.add(new_key)
+        self.changed = True
+
+    def drop(self, bank, account=None):
+        for buckets in (self.months, self.days):
+            for key in [key for key in buckets if key[0] == bank and (account is None or key[1] == account)]:
+                del buckets[key]
+        self.dirty = {key for key in self.dirty if key[0] != bank or (account is not None and key[1] != account)}
+        self.changed = True
+
+    # Queries
+
+    def _recompute(self, ledger, keys):
+        # One pass over each affected account's rows fills every bucket in `keys`.
+        by_account = {}
+        for key in keys:
+            by_account.setdefault(key[:2], set()).add(key[2])
+        for (bank, account), periods in by_account.items():
+            totals = {period: [0, 0, 0, 0] for period in periods}
+            for tx in ledger.select(bank=bank, account=account):
+                tx_periods = _periods(tx)
+                if tx_periods is None:
+                    continue
+                for period in tx_periods:
+                    if period in totals:
+                        _add_values(totals[period], _bucket_values(tx))
+            for period, values in totals.items():
+                key = (bank, account, period)
+                buckets = self.months if len(period) == 7 else self.days
+                buckets.pop(key, None)
+                if values[3] or buckets is self.days:
+                    buckets[key] = values
+                self.dirty.discard(key)
+        self.changed = True
+
+    def month_buckets(self, ledger):
+        self.sync()
+        if not self.complete:
+            self.months.clear()
+            self.dirty = {key for key in self.dirty if len(key[2]) != 7}
+            for tx in ledger.select():
+                periods = _periods(tx)
+                if periods is not None:
+                    key = (tx["bank"], tx["account"], periods[0])
+                    _add_values(self.months.setdefault(key, [0, 0, 0, 0]), _bucket_values(tx))
+            self.complete = True
+            self.changed = True
+        dirty = [key for key in self.dirty if len(key[2]) == 7]
+        if dirty:
+            self._recompute(ledger, dirty)
+        return self.months
+
+    def day_buckets(self, ledger, bank, account, days):
+        self.sync()
+        keys = [(bank, account, day) for day in days]
+        missing = [key for key in keys if key not in self.days or key in self.dirty]
+        if missing:
+            self._recompute(ledger, missing)
+        buckets = []
+        for key in keys:
+            # Most recently used last.
+            self.days[key] = values = self.days.pop(key)
+            buckets.append(values)
+        while len(self.days) > max(self.MAX_DAY_BUCKETS, len(keys)):
+            evicted = next(iter(self.days))
+            del self.days[evicted]
+            self.dirty.discard(evicted)
+        return buckets
+
+    def totals(self, ledger, bank=None, account=None, since=None, until=None):
+        # Bucket totals per (bank, account, month) for dates in [since, until).
+        # Whole months come from month buckets, partly covered ones from day buckets.
+        totals = {}
+        for key, values in list(self.month_buckets(ledger).items()):
+            if (bank is not None and key[0] != bank) or (account is not None and key[1] != account):
+                continue
+            month_start, month_end = key[2] + "-01", _next_month(key[2]) + "-01"
+            start = max(since, month_start) if since else month_start
+            end = min(until, month_end) if until else month_end
+            if start >= end:
+                continue
+            if (start, end) == (month_start, month_end):
+                totals[key] = list(values)
+                continue
+            totals[key] = [0, 0, 0, 0]
+            for bucket in self.day_buckets(ledger, key[0], key[1], _date_range(start, end)):
+                _add_values(totals[key], bucket)
+        return {key: values for key, values in totals.items() if values[3]}
+
+
+def _date_range(start, end):
+    first = datetime.date.fromisoformat(start)
+    count = (datetime.date.fromisoformat(end) - first).days
+    return [(first + datetime.timedelta(days=i)).isoformat() for i in range(count)]
+
+
+def _is_plain_date(value):
+    try:
+        return value is None or datetime.date.fromisoformat(value).isoformat() == value
+    except (TypeError, ValueError):
+        return False
+
+
+def cached_report(ledger, name, bank=None, account=None, since=None, until=None, window=3, **options):
+    # Monthly, per-account and rolling reports from the aggregate cache.
+    # Returns None when the cache cannot answer, e.g. for timestamp bounds.
+    cache = ledger.aggregates()
+    if cache is None or name not in ("monthly", "accounts", "rolling"):
+        return None
+    if not (_is_plain_date(since) and _is_plain_date(until)) or (since and until and since >= until):
+        return None
+    totals = cache.totals(ledger, bank, account, since, until)
+    if cache.changed:
+        cache.save()
+    if name == "accounts":
+        rows = {}
+        for (bank_name, account_name, _), values in totals.items():
+            _add_values(rows.setdefault((bank_name, account_name), [0, 0, 0, 0]), values)
+        return [
+            {"bank": key[0], "account": key[1], "income": _dollars(v[0]), "expense": _dollars(v[1]),
+             "net": _dollars(v[0] - v[1]), "count": v[3]}
+            for key, v in sorted(rows.items())
+        ]
+    months = {}
+    for (_, _, month), values in totals.items():
+        _add_values(months.setdefault(month, [0, 0, 0, 0]), values)
+    if name == "monthly":
+        return [
+            {"month": month, "income": _dollars(v[0]), "expense": _dollars(v[1]),
+             "net": _dollars(v[0] - v[1]), "count": v[3]}
+            for month, v in sorted(months.items())
+        ]
+    rows = []
+    if months:
+        month, last = min(months), max(months)
+        history = []
+        while month <= last:
+            income, expense = months.get(month, [0, 0])[:2]
+            history.append((income, expense, income - expense))
+            recent = history[-window:]
+            rows.append({
+                "month": month, "income": _dollars(income), "expense": _dollars(expense),
+                "net": _dollars(income - expense),
+                **{f"{field}_avg": round(sum(h[i] for h in recent) / len(recent) / 100, 2)
+                   for i, field in enumerate(("income", "expense", "net"))},
+            })
+            month = _next_month(month)
+    return rows
+
+
+# --- Initial Setup Process ---
+
+def setup_initial():
+    clear_screen()
+    print_header()
+    print("Welcome to Finance Manager CLI Setup!")
+    setup_data = {"banks": []}
+    while True:
+        bank_name = questionary.text("Enter bank name (or leave blank to finish):").ask()
+        if not bank_name:
+            break
+        bank = {"name": bank_name, "accounts": []}
+        while True:
+            account_name = questionary.text(
+                f"Enter account name for '{bank_name}' (or leave blank to finish):"
+            ).ask()
+            if not account_name:
+                break
+            initial_balance_str = questionary.text(
+                f"Enter initial balance for account '{account_name}' (default 0):"
+            ).ask()
+            try:
+                initial_balance = parse_money(initial_balance_str) / 100 if initial_balance_str else 0.0
+            except ValueError:
+                initial_balance = 0.0
+            bank["accounts"].append(
+                {"name": account_name, "balance": initial_balance, "opening_balance": initial_balance}
+            )
+        setup_data["banks"].append(bank)
+    save_setup(setup_data)
+    print("Setup complete! Restarting application...")
+    input("Press Enter to continue...")
+
+
+# --- Headless Transaction Operations ---
+# Prompt-free versions of the financial operations, shared by the menus and
+# the command line. They update memory only; commit_changes() persists.
+
+TRANSACTION_TYPES = ("deposit", "withdrawal")
+
+
+def _check_type(tx_type):
+    if not isinstance(tx_type, str):
+        raise ValueError(f"Transaction type must be one of: {', '.join(TRANSACTION_TYPES)}")
+    tx_type = tx_type.lower()
+    if tx_type not in TRANSACTION_TYPES:
+        raise ValueError(f"Transaction type must be one of: {', '.join(TRANSACTION_TYPES)}")
+    return tx_type
+
+
+def _check_date(date):
+    # None means now; anything else must be an ISO 8601 timestamp.
+    if date is None:
+        return datetime.datetime.now().isoformat()
+    try:
+        return datetime.datetime.fromisoformat(date).isoformat()
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid date '{date}': expected an ISO 8601 timestamp") from None
+
+
+def post_transaction(setup_data, ledger, bank, account, tx_type, amount, description, date=None):
+    if get_balances(setup_data).account(bank, account) is None:
+        raise ValueError(f"Unknown account '{account}' at bank '{bank}'")
+    tx_type = _check_type(tx_type)
+    date = _check_date(date)
+    # Only the single-file backend needs the whole ledger in memory to add a row.
+    if get_storage().rewrites_ledger:
+        ledger.load()
+    transaction = ledger.add({
+        "id": uuid.uuid4().hex,
+        "bank": bank,
+        "account": account,
+        "type": tx_type,
+        "amount": positive_cents(amount) / 100,
+        "description": description,
+        "date": date,
+    })
+    get_balances(setup_data).apply(transaction)
+    return transaction
+
+
+def amend_transaction(setup_data, ledger, tx_id, tx_type=None, amount=None, description=None):
+    tx = ledger.get(tx_id)
+    if tx is None:
+        raise ValueError(f"Unknown transaction '{tx_id}'")
+    changes = {"date": datetime.datetime.now().isoformat()}
+    if tx_type is not None:
+        changes["type"] = _check_type(tx_type)
+    if amount is not None:
+        cents = positive_cents(amount)
+        refunded = ledger.refunded_cents(tx_id)
+        if cents < refunded:
+            raise ValueError(f"Transaction '{tx_id}' already has {format_money(refunded)} refunded")
+        original_id = refund_of(tx)
+        if original_id is not None and ledger.get(original_id) is not None:
+            limit = ledger.refundable_cents(original_id) + amount_cents(tx)
+            if cents > limit:
+                raise ValueError(f"At most {format_money(limit)} of transaction '{original_id}' can be refunded")
+        changes["amount"] = cents / 100
+    if description is not None:
+        changes["description"] = description
+
+    # Reverse the original effect, update, then apply the new effect
+    balances = get_balances(setup_data)
+    balances.apply(tx, -1)
+    ledger.update(tx, **changes)
+    balances.apply(tx)
+    return tx
+
+
+def post_refund(setup_data, ledger, tx_id, amount=None):
+    original_tx = ledger.get(tx_id)
+    if original_tx is None:
+        raise ValueError(f"Unknown transaction '{tx_id}'")
+    # Earlier refunds count against the amount, so refunds never add up to more than it.
+    remaining = ledger.refundable_cents(tx_id)
+    if remaining <= 0:
+        raise ValueError(f"Transaction '{tx_id}' has already been fully refunded")
+    refund_cents = remaining if amount is None else min(positive_cents(amount), remaining)
+
+    # Determine refund type: flip deposit/withdrawal
+    refund_type = "withdrawal" if original_tx["type"] == "deposit" else "deposit"
+    refund_tx = ledger.add({
+        "id": uuid.uuid4().hex,
+        "bank": original_tx["bank"],
+        "account": original_tx["account"],
+        "type": refund_type,
+        "amount": refund_cents / 100,
+        "description": f"Refund for transaction {original_tx['id']}",
+        "date": datetime.datetime.now().isoformat(),
+        "refunded_transaction_id": original_tx["id"],
+    })
+    get_balances(setup_data).apply(refund_tx)
+    return refund_tx
+
+
+@instrumented("storage.commit")
+def commit_changes(setup_data, ledger, changed=None, deleted=None):
+    # Transactions and balances are committed together or not at all.
+    storage = get_storage()
+    try:
+        with storage.atomic():
+            save_transactions(ledger, changed=changed, deleted=deleted)
+            save_setup(setup_data)
+    except BaseException:
+        if isinstance(ledger, Ledger):
+            ledger.uncommitted = True  # rolled back with the setup
+        raise
+    if storage.merged:
+        # Another process committed first: setup_data now holds the merged
+        # balances, and the rows it added are only on disk.
+        as_ledger(ledger).reload()
+        get_balances(setup_data).rebuild()
+    get_balances(setup_data).commit()
+
+
+def discard_changes(setup_data, ledger):
+    # Undoes changes applied in memory but never committed: the setup, the
+    # rows and the balances are read back from storage.
+    setup_data.clear()
+    setup_data.update(load_setup())
+    as_ledger(ledger).reload()
+    get_balances(setup_data).rebuild()
+
+
+def refresh_if_stale(setup_data, transactions):
+    # Picks up commits from other processes before offering stale choices.
+    if not get_storage().is_stale():
+        return False
+    setup_data.clear()
+    setup_data.update(load_setup())
+    as_ledger(transactions).reload()
+    # The accounts are whatever was committed, so the checkpoint still holds.
+    get_balances(setup_data).rebuild()
+    return True
+
+
+# --- Statement Import ---
+
+IMPORT_BATCH_SIZE = 10000
+
+# Header names recognised when no column mapping is given
+CSV_COLUMNS = {
+    "id": ("id", "fitid", "transaction id", "reference"),
+    "date": ("date", "posted", "posted date", "transaction date", "booking date"),
+    "amount": ("amount", "value", "transaction amount"),
+    "debit": ("debit", "withdrawal", "money out"),
+    "credit": ("credit", "deposit", "money in"),
+    "type": ("type", "transaction type"),
+    "description": ("description", "memo", "details", "name", "payee", "narrative"),
+    "bank": ("bank",),
+    "account": ("account",),
+}
+
+
+def _parse_amount(value, currency=None):
+    # Cents of a statement amount, read like any other amount by
+    # parse_money(); statements may also put the minus sign last.
+    value = (value or "").strip()
+    if value.endswith("-"):
+        value = "-" + value[:-1]
+    return parse_money(value, currency) if value else 0
+
+
+def _parse_date(value, date_format=None):
+    value = value.strip()
+    if date_format:
+        return datetime.datetime.strptime(value, date_format).isoformat()
+    return datetime.datetime.fromisoformat(value).isoformat()
+
+
+def iter_csv_statement(f, mapping=None, date_format=None):
+    reader = csv.DictReader(f)
+    headers = {name.strip().lower(): name for name in reader.fieldnames or []}
+    columns = dict(mapping or {})
+    for field, aliases in CSV_COLUMNS.items():
+        if field not in columns:
+            columns[field] = next((headers[alias] for alias in aliases if alias in headers), None)
+    if columns["date"] is None or (columns["amount"] is None and columns["debit"] is None and columns["credit"] is None):
+        raise ValueError("Statement needs a date column and an amount (or debit/credit) column")
+    for row in reader:
+        if columns["amount"] is not None:
+            amount = _parse_amount(row[columns["amount"]])
+        else:
+            amount = _parse_amount(row.get(columns["credit"]) if columns["credit"] else "") - abs(
+                _parse_amount(row.get(columns["debit"]) if columns["debit"] else "")
+            )
+        tx_type = (row.get(columns["type"]) or "").strip().lower() if columns["type"] else ""
+        if tx_type in ("credit", "deposit"):
+            tx_type = "deposit"
+        elif tx_type in ("debit", "withdrawal"):
+            tx_type = "withdrawal"
+        else:
+            tx_type = "deposit" if amount >= 0 else "withdrawal"
+        yield {
+            "id": row.get(columns["id"]) if columns["id"] else None,
+            "bank": row.get(columns["bank"]) if columns["bank"] else None,
+            "account": row.get(columns["account"]) if columns["account"] else None,
+            "type": tx_type,
+            "amount": abs(amount) / 100,
+            "description": (row.get(columns["description"]) or "").strip() if columns["description"] else "",
+            "date": _parse_date(row[columns["date"]], date_format),
+        }
+
+
+_OFX_TAG = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+
+def _parse_ofx_date(value):
+    # YYYYMMDD[HHMMSS[.XXX]][[+-]TZ:NAME], kept as a naive timestamp
+    value = value.strip()
+    return datetime.datetime.strptime(value[:14].ljust(14, "0"), "%Y%m%d%H%M%S").isoformat()
+
+
+def iter_ofx_statement(f, chunk_size=64 * 1024):
+    # Streams <STMTTRN> records from OFX 1.x (SGML) or 2.x (XML) exports.
+    buffer = ""
+    record = None
+    while True:
+        chunk = f.read(chunk_size)
+        buffer += chunk
+        # Only consume up to the last complete tag; the rest waits for more data.
+        end = len(buffer) if not chunk else buffer.rfind("<")
+        for match in _OFX_TAG.finditer(buffer, 0, max(end, 0)):
+            closing, tag, text = match.group(1), match.group(2).upper(), match.group(3).strip()
+            if tag == "STMTTRN":
+                if closing and record is not None:
+                    # OFX amounts always have a decimal point, whatever the currency.
+                    amount = _parse_amount(record.get("TRNAMT"), "USD")
+                    yield {
+                        "id": record.get("FITID"),
+                        "bank": None,
+                        "account": None,
+                        "type": "deposit" if amount >= 0 else "withdrawal",
+                        "amount": abs(amount) / 100,
+                        "description": " ".join(
+                            part for part in (record.get("NAME"), record.get("MEMO")) if part
+                        ),
+                        "date": _parse_ofx_date(record["DTPOSTED"]),
+                    }
+                    record = None
+                elif not closing:
+                    record = {}
+            elif record is not None and not closing and text:
+                record[tag] = text
+        if not chunk:
+            return
+        buffer = buffer[max(end, 0):]
+
+
+def import_hash(tx):
+    key = "\x1f".join(str(tx[field]) for field in ("bank", "account", "date", "type", "amount", "description"))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def import_statement(setup_data, ledger, rows, bank, account, batch_size=IMPORT_BATCH_SIZE):
+    # Imports normalised statement rows, skipping ones already in the ledger
+    # (same source id, or same content hash) and zero amounts, which
+    # post_transaction would refuse. Balances are posted once per account and
+    # the changes persisted once per batch. Returns counters.
+    storage = get_storage()
+    balances = get_balances(setup_data)
+    # Backends that append do not need the rows kept in memory after a commit.
+    keep_rows = ledger.loaded or storage.rewrites_ledger
+    if keep_rows:
+        ledger.load()
+    known = set()
+    for tx in (ledger if keep_rows else storage.iter_transactions()):
+        known.add(tx["id"])
+        if "import_hash" in tx:
+            known.add(tx["import_hash"])
+
+    stats = {"rows": 0, "imported": 0, "duplicates": 0, "zero_amounts": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    occurrences = {}
+    batch = []
+    deltas = {}
+
+    def flush():
+        for (bank_name, account_name), delta in deltas.items():
+            balances.post(bank_name, account_name, delta)
+        commit_changes(setup_data, ledger, changed=batch)
+        stats["imported"] += len(batch)
+        batch.clear()
+        deltas.clear()
+
+    for row in rows:
+        stats["rows"] += 1
+        row["bank"] = row["bank"] or bank
+        row["account"] = row["account"] or account
+        if balances.account(row["bank"], row["account"]) is None:
+            raise ValueError(f"Unknown account '{row['account']}' at bank '{row['bank']}' (row {stats['rows']})")
+        if not to_cents(row["amount"]):
+            stats["zero_amounts"] += 1
+            continue
+        digest = import_hash(row)
+        # Identical rows within one statement are distinct postings.
+        occurrences[digest] = occurrences.get(digest, 0) + 1
+        if occurrences[digest] > 1:
+            digest = f"{digest}-{occurrences[digest]}"
+        source_id = row.pop("id")
+        if digest in known or (source_id and source_id in known):
+            stats["duplicates"] += 1
+            continue
+        known.add(digest)
+        tx = {"id": source_id or uuid.uuid4().hex, **row, "import_hash": digest}
+        if keep_rows:
+            tx = ledger.add(tx)
+        else:
+            tx = as_transaction(tx)
+            ledger.added(tx)
+        known.add(tx["id"])
+        batch.append(tx)
+        key = (tx["bank"], tx["account"])
+        deltas[key] = deltas.get(key, 0) + transaction_cents(tx)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    stats["seconds"] = time.perf_counter() - started
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+def import_statement_file(setup_data, ledger, path, bank, account, fmt=None, mapping=None,
+                          date_format=None, batch_size=IMPORT_BATCH_SIZE):
+    fmt = fmt or ("ofx" if path.lower().endswith((".ofx", ".qfx")) else "csv")
+    with open(path, "r", newline="", encoding="utf-8-sig", errors="replace") as f:
+        if fmt == "ofx":
+            rows = iter_ofx_statement(f)
+        else:
+            rows = iter_csv_statement(f, mapping, date_format)
+        return import_statement(setup_data, ledger, rows, bank, account, batch_size)
+
+
+# --- Transaction Picker ---
+
+PICKER_PAGE_SIZE = 20
+
+_NEXT_PAGE = ("picker", "next")
+_PREVIOUS_PAGE = ("picker", "previous")
+_JUMP_TO_PAGE = ("picker", "jump")
+_SEARCH = ("picker", "search")
+_CLEAR_SEARCH = ("picker", "clear")
+_CANCEL = ("picker", "cancel")
+
+
+def format_transaction_choice(tx):
+    return f"{tx['date'][:19]} | {tx['bank']} - {tx['account']} | {tx['type'].capitalize()} {Money.of(tx['amount'])} | {tx['description']}"
+
+
+_description_completer = None
+
+
+def description_completer(ledger):
+    # Completes the word being typed from the ledger's description index. The
+    # class is defined on first use, as prompt_toolkit is imported lazily.
+    global _description_completer
+    if _description_completer is None:
+        from prompt_toolkit.completion import Completer, Completion
+
+        class DescriptionCompleter(Completer):
+            def __init__(self, ledger):
+                self.ledger = ledger
+
+            def get_completions(self, document, complete_event):
+                prefix = document.get_word_before_cursor()
+                if prefix:
+                    for word in self.ledger.complete(prefix):
+                        yield Completion(word, start_position=-len(prefix))
+
+        _description_completer = DescriptionCompleter
+    return _description_completer(ledger)
+
+
+def pick_transaction(ledger, message, page_size=PICKER_PAGE_SIZE):
+    # Lets the user page through or search the ledger and returns the chosen
+    # row, or None if cancelled. Only the rows on screen are formatted.
+    page = 0
+    query = ""
+    rows = ledger
+    while True:
+        pages = max(1, -(-len(rows) // page_size))
+        page = min(max(page, 0), pages - 1)
+        choices = [
+            questionary.Choice(title=format_transaction_choice(tx), value=tx["id"])
+            for tx in rows[page * page_size:(page + 1) * page_size]
+        ]
+        status = f"Page {page + 1} of {pages}" + (f", matching '{query}'" if query else "")
+        choices.append(questionary.Separator(f"-- {status} --"))
+        if page + 1 < pages:
+            choices.append(questionary.Choice(title="Next page", value=_NEXT_PAGE))
+        if page > 0:
+            choices.append(questionary.Choice(title="Previous page", value=_PREVIOUS_PAGE))
+        if pages > 2:
+            choices.append(questionary.Choice(title="Jump to page", value=_JUMP_TO_PAGE))
+        choices.append(questionary.Choice(title="Search descriptions", value=_SEARCH))
+        if query:
+            choices.append(questionary.Choice(title="Clear search", value=_CLEAR_SEARCH))
+        choices.append(questionary.Choice(title="Cancel", value=_CANCEL))
+
+        choice = questionary.select(message, choices=choices).ask()
+        if choice == _NEXT_PAGE:
+            page += 1
+        elif choice == _PREVIOUS_PAGE:
+            page -= 1
+        elif choice == _JUMP_TO_PAGE:
+            page_str = questionary.text(f"Go to page (1-{pages}):").ask()
+            if page_str and page_str.isdigit():
+                page = int(page_str) - 1
+        elif choice == _SEARCH:
+            query = questionary.autocomplete(
+                "Search descriptions:", choices=[], completer=description_completer(ledger)
+            ).ask() or ""
+            rows = ledger.search(query) if query else ledger
+            page = 0
+        elif choice == _CLEAR_SEARCH:
+            query = ""
+            rows = ledger
+            page = 0
+        elif choice is None or choice == _CANCEL:
+            return None
+        else:
+            return ledger.get(choice)
 
 
-def clear_screen():
-    os.system("cls" if os.name == "nt" else "clear")
+# --- Transaction Views ---
+# Listings are built as a chain of generators (select -> filter -> sort ->
+# slice -> format), so rows are only read from storage and formatted as the
+# output is consumed. Sorting is the one stage that has to see every row; with
+# a limit it keeps only the best offset + limit of them.
 
+VIEW_PAGE_SIZE = 20
+COLUMNAR_GROUP_ROWS = 65536
+COLUMNAR_MAGIC = b"FMCOLUMNS1\n"
 
-def print_header():
-    print("=" * 60)
-    print("      $$$  Money Maestro - Finance Manager CLI  $$$")
-    print("=" * 60)
-    print()
+SORT_KEYS = {
+    "date": lambda tx: (tx["date"], tx["id"]),
+    "amount": lambda tx: (tx["amount"], tx["date"], tx["id"]),
+    "bank": lambda tx: (tx["bank"], tx["account"], tx["date"], tx["id"]),
+    "description": lambda tx: (tx["description"].lower(), tx["date"], tx["id"]),
+}
 
+EXPORT_FORMATS = {"csv": ".csv", "jsonl": ".jsonl", "columnar": ".columns"}
+EXPORT_COLUMNS = ("id", "date", "bank", "account", "type", "amount", "description", "refunded_transaction_id")
 
-# --- Data Persistence Functions ---
+TABLE_HEADER = f"{'Date':<10}  {'Bank':<16}  {'Account':<16}  {'Amount':>12}  {'Description':<30}  ID"
 
-def load_setup():
-    if os.path.exists(SETUP_FILE):
-        with open(SETUP_FILE, "r") as f:
-            return json.load(f)
-    else:
-        return {"banks": []}
 
+def filter_rows(rows, bank=None, account=None, since=None, until=None, tx_type=None,
+                min_amount=None, max_amount=None):
+    # Rows of `bank`/`account`, dated in [since, until), of `tx_type` and with
+    # an amount in [min_amount, max_amount].
+    checks = []
+    if bank is not None:
+        checks.append(lambda tx: tx["bank"] == bank)
+    if account is not None:
+        checks.append(lambda tx: tx["account"] == account)
+    if since is not None:
+        checks.append(lambda tx: tx["date"] >= since)
+    if until is not None:
+        checks.append(lambda tx: tx["date"] < until)
+    if tx_type is not None:
+        checks.append(lambda tx: tx["type"] == tx_type)
+    if min_amount is not None:
+        checks.append(lambda tx: tx["amount"] >= min_amount)
+    if max_amount is not None:
+        checks.append(lambda tx: tx["amount"] <= max_amount)
+    if not checks:
+        return iter(rows)
+    return (tx for tx in rows if all(check(tx) for check in checks))
 
-def save_setup(data):
-    with open(SETUP_FILE, "w") as f:
-        json.dump(data, f, indent=4)
 
+def sort_rows(rows, key="date", reverse=False, limit=None):
+    # With a limit only that many rows are held, in a heap.
+    order = SORT_KEYS[key]
+    if limit is None:
+        return iter(sorted(rows, key=order, reverse=reverse))
+    pick = heapq.nlargest if reverse else heapq.nsmallest
+    return iter(pick(limit, rows, key=order))
 
-def load_transactions():
-    if os.path.exists(TRANSACTION_FILE):
-        with open(TRANSACTION_FILE, "r") as f:
-            return json.load(f)
+
+def slice_rows(rows, offset=0, limit=None):
+    return itertools.islice(rows, offset, None if limit is None else offset + limit)
+
+
+@instrumented("view.rows", lazy=True)
+def transaction_rows(ledger, bank=None, account=None, query=None, fuzzy=False, since=None, until=None,
+                     tx_type=None, min_amount=None, max_amount=None, sort=None, reverse=False,
+                     offset=0, limit=None):
+    # The rows of a listing, read lazily. A loaded ledger sorted by date is
+    # walked through its date index instead of being sorted.
+    if query:
+        rows = ledger.search(query, fuzzy, since, until, min_amount, max_amount)
+        rows = filter_rows(rows, bank=bank, account=account, tx_type=tx_type)
+    elif sort == "date" and ledger.loaded and bank is None:
+        rows = ledger.ordered(since, until, reverse)
+        rows = filter_rows(rows, tx_type=tx_type, min_amount=min_amount, max_amount=max_amount)
+        sort = None
     else:
-        return []
+        rows = filter_rows(ledger.select(bank, account), since=since, until=until, tx_type=tx_type,
+                           min_amount=min_amount, max_amount=max_amount)
+    if sort is not None:
+        rows = sort_rows(rows, sort, reverse, None if limit is None else offset + limit)
+    return slice_rows(rows, offset, limit)
 
 
-def save_transactions(transactions):
-    with open(TRANSACTION_FILE, "w") as f:
-        json.dump(transactions, f, indent=4)
+def _fit(text, width):
+    return f"{text[:width]:<{width}}"
 
 
-# --- Initial Setup Process ---
+def format_table_row(tx):
+    amount = ("+" if tx["type"] == "deposit" else "-") + f"{tx['amount']:.2f}"
+    return (f"{tx['date'][:10]:<10}  {_fit(tx['bank'], 16)}  {_fit(tx['account'], 16)}  {amount:>12}  "
+            f"{_fit(tx['description'], 30)}  {tx['id']}")
 
-def setup_initial():
-    clear_screen()
-    print_header()
-    print("Welcome to Finance Manager CLI Setup!")
-    setup_data = {"banks": []}
+
+def format_transaction_details(tx):
+    lines = [
+        f"ID: {tx['id']}",
+        f"Date: {tx['date']}",
+        f"Bank: {tx['bank']}, Account: {tx['account']}",
+        f"Type: {tx['type'].capitalize()}, Amount: {Money.of(tx['amount'])}",
+        f"Description: {tx['description']}",
+    ]
+    if refund_of(tx) is not None:
+        lines.append(f"Refund of: {refund_of(tx)}")
+    lines.append("-" * 40)
+    return "\n".join(lines)
+
+
+def format_refund_chain(ledger, tx_id):
+    # A transaction's refunds as an indented tree, each original followed by
+    # how much of it has been refunded.
+    lines = []
+    for depth, tx in ledger.refund_chain(tx_id):
+        line = "  " * depth + format_transaction_choice(tx)
+        refunded = ledger.refunded_cents(tx["id"])
+        if refunded:
+            line += f" [refunded {format_money(refunded)}, {format_money(amount_cents(tx) - refunded)} left]"
+        lines.append(line)
+    return lines
+
+
+ROW_FORMATS = {
+    "details": format_transaction_details,
+    "table": format_table_row,
+    "line": format_transaction_choice,
+    "json": lambda tx: json.dumps(dict(tx)),
+}
+
+
+def page_transactions(rows, style="details", page_size=VIEW_PAGE_SIZE, export=None):
+    # Prints `rows` a page at a time, asking before each further page; rows
+    # past the current page are not read. `export`, if given, is offered as
+    # an action and called with no arguments.
+    rows = iter(rows)
+    page = list(itertools.islice(rows, page_size))
+    if not page:
+        print("No matching transactions.")
+        input("Press Enter to return to menu...")
+        return
+    shown = len(page)
+    show = True
     while True:
-        bank_name = questionary.text("Enter bank name (or leave blank to finish):").ask()
-        if not bank_name:
-            break
-        bank = {"name": bank_name, "accounts": []}
+        with measure("view.page"):
+            if show:
+                if style == "table":
+                    print(TABLE_HEADER)
+                for tx in page:
+                    print(ROW_FORMATS[style](tx))
+            upcoming = next(rows, None)
+        if upcoming is not None:
+            rows = itertools.chain([upcoming], rows)
+        actions = ["Enter: next page, q: back to menu" if upcoming is not None else "Enter: back to menu",
+                   "t: table", "d: details"]
+        if export is not None:
+            actions.append("e: export")
+        answer = (input(f"-- {shown} shown. {', '.join(actions)} -- ") or "").strip().lower()
+        show = answer in ("t", "d")
+        if show:
+            style = "table" if answer == "t" else "details"
+            continue
+        if answer == "e" and export is not None:
+            export()
+            continue
+        if answer == "q" or upcoming is None:
+            return
+        page = list(itertools.islice(rows, page_size))
+        shown += len(page)
+        show = True
+
+
+def export_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    for fmt, suffix in EXPORT_FORMATS.items():
+        if extension == suffix:
+            return fmt
+    raise ValueError(f"Cannot tell the export format of '{path}'; use one of {', '.join(EXPORT_FORMATS)}")
+
+
+def write_columnar(rows, path, group_rows=COLUMNAR_GROUP_ROWS):
+    # Writes rows in groups of `group_rows`, so at most one group is held in
+    # memory. Returns the number of rows written.
+    count = 0
+    with open(path, "wb") as f:
+        f.write(COLUMNAR_MAGIC)
+        rows = iter(rows)
         while True:
-            account_name = questionary.text(
-                f"Enter account name for '{bank_name}' (or leave blank to finish):"
-            ).ask()
-            if not account_name:
-                break
-            initial_balance_str = questionary.text(
-                f"Enter initial balance for account '{account_name}' (default 0):"
-            ).ask()
-            try:
-                initial_balance = float(initial_balance_str) if initial_balance_str else 0.0
-            except ValueError:
-                initial_balance = 0.0
-            bank["accounts"].append({"name": account_name, "balance": initial_balance})
-        setup_data["banks"].append(bank)
-    save_setup(setup_data)
-    print("Setup complete! Restarting application...")
-    input("Press Enter to continue...")
+            group = ColumnarTransactions(itertools.islice(rows, group_rows))
+            if not len(group):
+                return count
+            group.write_group(f)
+            count += len(group)
+
+
+def read_columnar(path):
+    # Yields the rows of a file written by write_columnar, a group at a time.
+    with open(path, "rb") as f:
+        if f.readline() != COLUMNAR_MAGIC:
+            raise ValueError(f"'{path}' is not a columnar transaction file")
+        while True:
+            group = ColumnarTransactions.read_group(f)
+            if group is None:
+                return
+            yield from group
+
+
+def export_transactions(rows, path, fmt=None):
+    # Streams `rows` to `path` as CSV (readable by the `import` command), JSON
+    # lines or the columnar format. Returns the number of rows written.
+    fmt = fmt or export_format(path)
+    if fmt == "columnar":
+        return write_columnar(rows, path)
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'")
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for tx in rows:
+                writer.writerow([tx.get(column, "") for column in EXPORT_COLUMNS])
+                count += 1
+        else:
+            for tx in rows:
+                f.write(json.dumps(dict(tx)) + "\n")
+                count += 1
+    return count
 
 
 # --- Transaction & Financial Operations ---
@@ -91,11 +4681,12 @@ def add_transaction(setup_data, transactions):
         return
 
     # Build bank choices with total balance displayed
+    balances = get_balances(setup_data)
     bank_choices = []
     for bank in setup_data["banks"]:
-        total_balance = sum(account["balance"] for account in bank["accounts"])
+        total_balance = format_money(balances.bank_cents(bank["name"]))
         bank_choices.append(questionary.Choice(
-            title=f"{bank['name']} (Total: ${total_balance:.2f})", value=bank
+            title=f"{bank['name']} (Total: {total_balance})", value=bank
         ))
     selected_bank = questionary.select("Select bank for transaction:", choices=bank_choices).ask()
     if not selected_bank["accounts"]:
@@ -107,39 +4698,25 @@ def add_transaction(setup_data, transactions):
     account_choices = []
     for account in selected_bank["accounts"]:
         account_choices.append(questionary.Choice(
-            title=f"{account['name']} (Balance: ${account['balance']:.2f})", value=account
+            title=f"{account['name']} (Balance: {Money.of(account['balance'])})", value=account
         ))
     selected_account = questionary.select("Select account:", choices=account_choices).ask()
 
     transaction_type = questionary.select("Select transaction type:", choices=["Deposit", "Withdrawal"]).ask()
     amount_str = questionary.text("Enter amount:").ask()
     try:
-        amount = float(amount_str)
+        amount = Money(positive_cents(amount_str))
     except ValueError:
         print("Invalid amount.")
         input("Press Enter to return to menu...")
         return
     description = questionary.text("Enter description:").ask()
 
-    transaction = {
-        "id": uuid.uuid4().hex,
-        "bank": selected_bank["name"],
-        "account": selected_account["name"],
-        "type": transaction_type.lower(),
-        "amount": amount,
-        "description": description,
-        "date": datetime.datetime.now().isoformat(),
-    }
-
-    # Update the account balance
-    if transaction_type.lower() == "deposit":
-        selected_account["balance"] += amount
-    else:
-        selected_account["balance"] -= amount
-
-    transactions.append(transaction)
-    save_transactions(transactions)
-    save_setup(setup_data)
+    ledger = as_ledger(transactions)
+    transaction = post_transaction(
+        setup_data, ledger, selected_bank["name"], selected_account["name"], transaction_type, amount, description
+    )
+    commit_changes(setup_data, ledger, changed=[transaction])
     print("Transaction added successfully!")
     input("Press Enter to return to menu...")
 
@@ -147,58 +4724,36 @@ def add_transaction(setup_data, transactions):
 def edit_transaction(setup_data, transactions):
     clear_screen()
     print_header()
-    if not transactions:
+    ledger = as_ledger(transactions)
+    if not ledger:
         print("No transactions to edit.")
         input("Press Enter to return to menu...")
         return
 
-    # List transactions for selection
-    choices = []
-    for tx in transactions:
-        choices.append(
-            f"{tx['date'][:19]} | {tx['bank']} - {tx['account']} | {tx['type'].capitalize()} ${tx['amount']} | {tx['description']}"
-        )
-    tx_choice = questionary.select("Select transaction to edit:", choices=choices).ask()
-    tx_index = choices.index(tx_choice)
-    tx = transactions[tx_index]
-
-    # Reverse original transaction effect
-    bank = next((b for b in setup_data["banks"] if b["name"] == tx["bank"]), None)
-    if bank:
-        account = next((a for a in bank["accounts"] if a["name"] == tx["account"]), None)
-        if account:
-            if tx["type"] == "deposit":
-                account["balance"] -= tx["amount"]
-            else:
-                account["balance"] += tx["amount"]
+    tx = pick_transaction(ledger, "Select transaction to edit:")
+    if tx is None:
+        return
 
     # Get new details from user
     new_type = questionary.select(
         "Select new transaction type:", choices=["Deposit", "Withdrawal"], default=tx["type"].capitalize()
     ).ask()
-    new_amount_str = questionary.text("Enter new amount:", default=str(tx["amount"])).ask()
+    new_amount_str = questionary.text("Enter new amount:", default=str(Money.of(tx["amount"]))).ask()
     try:
-        new_amount = float(new_amount_str)
+        new_amount = Money.parse(new_amount_str)
     except ValueError:
         print("Invalid amount. Aborting edit.")
         input("Press Enter to return to menu...")
         return
     new_description = questionary.text("Enter new description:", default=tx["description"]).ask()
 
-    tx["type"] = new_type.lower()
-    tx["amount"] = new_amount
-    tx["description"] = new_description
-    tx["date"] = datetime.datetime.now().isoformat()
-
-    # Re-apply new transaction effect
-    if bank and account:
-        if tx["type"] == "deposit":
-            account["balance"] += new_amount
-        else:
-            account["balance"] -= new_amount
-
-    save_transactions(transactions)
-    save_setup(setup_data)
+    try:
+        amend_transaction(setup_data, ledger, tx["id"], new_type, new_amount, new_description)
+    except ValueError as e:
+        print(f"{e}. Aborting edit.")
+        input("Press Enter to return to menu...")
+        return
+    commit_changes(setup_data, ledger, changed=[tx])
     print("Transaction edited successfully!")
     input("Press Enter to return to menu...")
 
@@ -206,58 +4761,43 @@ def edit_transaction(setup_data, transactions):
 def refund_transaction(setup_data, transactions):
     clear_screen()
     print_header()
-    if not transactions:
+    ledger = as_ledger(transactions)
+    if not ledger:
         print("No transactions available for refund.")
         input("Press Enter to return to menu...")
         return
 
     # Let user select a transaction to refund
-    choices = []
-    for tx in transactions:
-        choices.append(
-            f"{tx['date'][:19]} | {tx['bank']} - {tx['account']} | {tx['type'].capitalize()} ${tx['amount']} | {tx['description']}"
-        )
-    tx_choice = questionary.select("Select transaction to refund:", choices=choices).ask()
-    tx_index = choices.index(tx_choice)
-    original_tx = transactions[tx_index]
+    original_tx = pick_transaction(ledger, "Select transaction to refund:")
+    if original_tx is None:
+        return
+
+    chain = format_refund_chain(ledger, original_tx["id"])
+    if len(chain) > 1:
+        print("Refund history:")
+        print("\n".join(chain))
+    remaining = ledger.refundable_cents(original_tx["id"])
+    if remaining <= 0:
+        print("This transaction has already been fully refunded.")
+        input("Press Enter to return to menu...")
+        return
 
-    # Ask for refund amount with default as full amount
+    # Ask for refund amount with default as whatever is left to refund
     refund_amount_str = questionary.text(
-        "Enter refund amount (default full amount):", default=str(original_tx["amount"])
+        "Enter refund amount (default full amount):", default=format_money(remaining)
     ).ask()
     try:
-        refund_amount = float(refund_amount_str) if refund_amount_str else original_tx["amount"]
+        refund_amount = Money.parse(refund_amount_str) if refund_amount_str else None
     except ValueError:
-        refund_amount = original_tx["amount"]
-    if refund_amount > original_tx["amount"]:
-        refund_amount = original_tx["amount"]
-
-    # Determine refund type: flip deposit/withdrawal
-    refund_type = "withdrawal" if original_tx["type"] == "deposit" else "deposit"
-    refund_tx = {
-        "id": uuid.uuid4().hex,
-        "bank": original_tx["bank"],
-        "account": original_tx["account"],
-        "type": refund_type,
-        "amount": refund_amount,
-        "description": f"Refund for transaction {original_tx['id']}",
-        "date": datetime.datetime.now().isoformat(),
-        "refunded_transaction_id": original_tx["id"],
-    }
-
-    # Update account balance for the refund
-    bank = next((b for b in setup_data["banks"] if b["name"] == original_tx["bank"]), None)
-    if bank:
-        account = next((a for a in bank["accounts"] if a["name"] == original_tx["account"]), None)
-        if account:
-            if refund_type == "deposit":
-                account["balance"] += refund_amount
-            else:
-                account["balance"] -= refund_amount
+        refund_amount = None
 
-    transactions.append(refund_tx)
-    save_transactions(transactions)
-    save_setup(setup_data)
+    try:
+        refund_tx = post_refund(setup_data, ledger, original_tx["id"], refund_amount)
+    except ValueError as e:
+        print(f"{e}. Aborting refund.")
+        input("Press Enter to return to menu...")
+        return
+    commit_changes(setup_data, ledger, changed=[refund_tx])
     print("Refund transaction added successfully!")
     input("Press Enter to return to menu...")
 
@@ -265,36 +4805,50 @@ def refund_transaction(setup_data, transactions):
 def view_transactions(transactions):
     clear_screen()
     print_header()
-    if not transactions:
+    # Rows are streamed from storage unless the ledger is already in memory.
+    ledger = as_ledger(transactions)
+    if next(ledger.select(), None) is None:
         print("No transactions available.")
         input("Press Enter to return to menu...")
         return
 
     filter_choice = questionary.select(
-        "View transactions:", choices=["All", "Filter by Bank", "Filter by Account"]
+        "View transactions:", choices=["All", "Filter by Bank", "Filter by Account", "Search"]
     ).ask()
 
-    filtered = transactions
+    selection = {}
     if filter_choice == "Filter by Bank":
-        banks = list(set(tx["bank"] for tx in transactions))
-        bank_selected = questionary.select("Select bank:", choices=banks).ask()
-        filtered = [tx for tx in transactions if tx["bank"] == bank_selected]
+        selection["bank"] = questionary.select("Select bank:", choices=ledger.banks()).ask()
     elif filter_choice == "Filter by Account":
-        banks = list(set(tx["bank"] for tx in transactions))
-        bank_selected = questionary.select("Select bank:", choices=banks).ask()
-        accounts = list(set(tx["account"] for tx in transactions if tx["bank"] == bank_selected))
+        bank_selected = questionary.select("Select bank:", choices=ledger.banks()).ask()
+        accounts = ledger.accounts(bank_selected)
         account_selected = questionary.select("Select account:", choices=accounts).ask()
-        filtered = [tx for tx in transactions if tx["bank"] == bank_selected and tx["account"] == account_selected]
+        selection.update(bank=bank_selected, account=account_selected)
+    elif filter_choice == "Search":
+        query = questionary.autocomplete(
+            "Search descriptions, banks and accounts:", choices=[], completer=description_completer(ledger)
+        ).ask() or ""
+        # A blank query shows everything, without searching the whole ledger.
+        # Otherwise falls back to allowing a typo per word when nothing matches exactly.
+        if query.strip():
+            selection.update(query=query, fuzzy=not ledger.search(query))
+
+    def export():
+        fmt = questionary.select("Export format:", choices=list(EXPORT_FORMATS)).ask()
+        if fmt is None:
+            return
+        path = questionary.text("Export to file:", default=f"transactions{EXPORT_FORMATS[fmt]}").ask()
+        if not path:
+            return
+        try:
+            count = export_transactions(transaction_rows(ledger, **selection), path, fmt)
+        except OSError as e:
+            print(f"Could not export: {e}")
+            return
+        print(f"Exported {count} transactions to {path}.")
 
     print("Transactions:")
-    for tx in filtered:
-        print(f"ID: {tx['id']}")
-        print(f"Date: {tx['date']}")
-        print(f"Bank: {tx['bank']}, Account: {tx['account']}")
-        print(f"Type: {tx['type'].capitalize()}, Amount: ${tx['amount']}")
-        print(f"Description: {tx['description']}")
-        print("-" * 40)
-    input("Press Enter to return to menu...")
+    page_transactions(transaction_rows(ledger, **selection), export=export)
 
 
 # --- Bank & Account Management ---
@@ -310,6 +4864,7 @@ def add_bank(setup_data):
     new_bank = {"name": bank_name, "accounts": []}
     setup_data["banks"].append(new_bank)
     save_setup(setup_data)
+    get_balances(setup_data).reset()
     print("Bank added successfully!")
     input("Press Enter to return to menu...")
 
@@ -328,11 +4883,10 @@ def rename_bank(setup_data, transactions):
         if bank["name"] == bank_choice:
             bank["name"] = new_name
             break
-    for tx in transactions:
-        if tx["bank"] == bank_choice:
-            tx["bank"] = new_name
-    save_setup(setup_data)
-    save_transactions(transactions)
+    with get_storage().atomic():
+        as_ledger(transactions).rename_bank(bank_choice, new_name)
+        save_setup(setup_data)
+    get_balances(setup_data).reset()
     print("Bank renamed successfully!")
     input("Press Enter to return to menu...")
 
@@ -352,9 +4906,11 @@ def delete_bank(setup_data, transactions):
     if not confirm:
         return
     setup_data["banks"] = [bank for bank in setup_data["banks"] if bank["name"] != bank_choice]
-    transactions[:] = [tx for tx in transactions if tx["bank"] != bank_choice]
-    save_setup(setup_data)
-    save_transactions(transactions)
+    with get_storage().atomic():
+        deleted = as_ledger(transactions).delete(bank_choice)
+        setup_data.setdefault("deleted_account_ids", []).extend(deleted)
+        save_setup(setup_data)
+    get_balances(setup_data).reset()
     print("Bank deleted successfully!")
     input("Press Enter to return to menu...")
 
@@ -377,12 +4933,15 @@ def add_account(setup_data):
                 return
             initial_balance_str = questionary.text("Enter initial balance (default 0):").ask()
             try:
-                initial_balance = float(initial_balance_str) if initial_balance_str else 0.0
+                initial_balance = parse_money(initial_balance_str) / 100 if initial_balance_str else 0.0
             except ValueError:
                 initial_balance = 0.0
-            bank["accounts"].append({"name": account_name, "balance": initial_balance})
+            bank["accounts"].append(
+                {"name": account_name, "balance": initial_balance, "opening_balance": initial_balance}
+            )
             break
     save_setup(setup_data)
+    get_balances(setup_data).reset()
     print("Account added successfully!")
     input("Press Enter to return to menu...")
 
@@ -405,17 +4964,16 @@ def rename_account(setup_data, transactions):
     account_choices = []
     for acc in selected_bank["accounts"]:
         account_choices.append(questionary.Choice(
-            title=f"{acc['name']} (Balance: ${acc['balance']:.2f})", value=acc
+            title=f"{acc['name']} (Balance: {Money.of(acc['balance'])})", value=acc
         ))
     selected_account = questionary.select("Select account to rename:", choices=account_choices).ask()
     old_name = selected_account["name"]
     new_name = questionary.text("Enter new account name:", default=selected_account["name"]).ask()
     selected_account["name"] = new_name
-    for tx in transactions:
-        if tx["bank"] == selected_bank["name"] and tx["account"] == old_name:
-            tx["account"] = new_name
-    save_setup(setup_data)
-    save_transactions(transactions)
+    with get_storage().atomic():
+        as_ledger(transactions).rename_account(selected_bank["name"], old_name, new_name)
+        save_setup(setup_data)
+    get_balances(setup_data).reset()
     print("Account renamed successfully!")
     input("Press Enter to return to menu...")
 
@@ -438,7 +4996,7 @@ def delete_account(setup_data, transactions):
     account_choices = []
     for acc in selected_bank["accounts"]:
         account_choices.append(questionary.Choice(
-            title=f"{acc['name']} (Balance: ${acc['balance']:.2f})", value=acc
+            title=f"{acc['name']} (Balance: {Money.of(acc['balance'])})", value=acc
         ))
     selected_account = questionary.select("Select account to delete:", choices=account_choices).ask()
     confirm = questionary.confirm(
@@ -447,28 +5005,31 @@ def delete_account(setup_data, transactions):
     if not confirm:
         return
     selected_bank["accounts"] = [acc for acc in selected_bank["accounts"] if acc["name"] != selected_account["name"]]
-    transactions[:] = [
-        tx for tx in transactions if not (tx["bank"] == selected_bank["name"] and tx["account"] == selected_account["name"])
-    ]
-    save_setup(setup_data)
-    save_transactions(transactions)
+    with get_storage().atomic():
+        deleted = as_ledger(transactions).delete(selected_bank["name"], selected_account["name"])
+        setup_data.setdefault("deleted_account_ids", []).extend(deleted)
+        save_setup(setup_data)
+    get_balances(setup_data).reset()
     print("Account deleted successfully!")
     input("Press Enter to return to menu...")
 
 
 def bank_account_management(setup_data, transactions):
     while True:
-        clear_screen()
-        print_header()
-        choice = questionary.select("Bank & Account Management:", choices=[
-            "Add Bank",
-            "Rename Bank",
-            "Delete Bank",
-            "Add Account",
-            "Rename Account",
-            "Delete Account",
-            "Back to Main Menu",
-        ]).ask()
+        with measure("menu.render"):
+            refresh_if_stale(setup_data, transactions)
+            clear_screen()
+            print_header()
+            menu = questionary.select("Bank & Account Management:", choices=[
+                "Add Bank",
+                "Rename Bank",
+                "Delete Bank",
+                "Add Account",
+                "Rename Account",
+                "Delete Account",
+                "Back to Main Menu",
+            ])
+        choice = menu.ask()
         if choice == "Add Bank":
             add_bank(setup_data)
         elif choice == "Rename Bank":
@@ -489,16 +5050,22 @@ def bank_account_management(setup_data, transactions):
 
 def financial_operations(setup_data, transactions):
     while True:
-        clear_screen()
-        print_header()
-        choice = questionary.select("Financial Operations:", choices=[
-            "Add Transaction",
-            "Edit Transaction",
-            "Refund Transaction",
-            "View Transactions",
-            "View Balance",
-            "Back to Main Menu",
-        ]).ask()
+        with measure("menu.render"):
+            refresh_if_stale(setup_data, transactions)
+            clear_screen()
+            print_header()
+            menu = questionary.select("Financial Operations:", choices=[
+                "Add Transaction",
+                "Edit Transaction",
+                "Refund Transaction",
+                "View Transactions",
+                "View Balance",
+                "View Balance On Date",
+                "Import Statement",
+                "Reports",
+                "Back to Main Menu",
+            ])
+        choice = menu.ask()
         if choice == "Add Transaction":
             add_transaction(setup_data, transactions)
         elif choice == "Edit Transaction":
@@ -509,6 +5076,12 @@ def financial_operations(setup_data, transactions):
             view_transactions(transactions)
         elif choice == "View Balance":
             view_balance(setup_data)
+        elif choice == "View Balance On Date":
+            view_balance_on_date(setup_data, transactions)
+        elif choice == "Import Statement":
+            import_statement_menu(setup_data, transactions)
+        elif choice == "Reports":
+            view_reports(transactions)
         elif choice == "Back to Main Menu":
             break
 
@@ -523,23 +5096,179 @@ def view_balance(setup_data):
         input("Press Enter to return to menu...")
         return
     print("Account Balances:")
+    balances = get_balances(setup_data)
     for bank in setup_data["banks"]:
-        total_balance = sum(account["balance"] for account in bank["accounts"])
-        print(f"\nBank: {bank['name']} (Total Balance: ${total_balance:.2f})")
+        total_balance = format_money(balances.bank_cents(bank["name"]))
+        print(f"\nBank: {bank['name']} (Total Balance: {total_balance})")
         if bank["accounts"]:
             for account in bank["accounts"]:
-                print(f"  - {account['name']}: ${account['balance']:.2f}")
+                print(f"  - {account['name']}: {Money.of(account['balance'])}")
         else:
             print("  No accounts available.")
     print("\n" + "=" * 60)
     input("Press Enter to return to menu...")
 
 
+def view_balance_on_date(setup_data, transactions):
+    clear_screen()
+    print_header()
+    if not setup_data["banks"]:
+        print("No banks or accounts available.")
+        input("Press Enter to return to menu...")
+        return
+    bank_choices = []
+    for bank in setup_data["banks"]:
+        bank_choices.append(questionary.Choice(title=bank["name"], value=bank))
+    selected_bank = questionary.select("Select bank:", choices=bank_choices).ask()
+    if not selected_bank["accounts"]:
+        print("No accounts available in this bank.")
+        input("Press Enter to return to menu...")
+        return
+    account_names = [account["name"] for account in selected_bank["accounts"]]
+    account_name = questionary.select("Select account:", choices=account_names).ask()
+    date_str = questionary.text("Enter date (YYYY-MM-DD):", default=datetime.date.today().isoformat()).ask()
+    try:
+        day = datetime.date.fromisoformat(date_str)
+    except ValueError:
+        print("Invalid date.")
+        input("Press Enter to return to menu...")
+        return
+    # Balance at the end of the chosen day
+    balance = balance_at(setup_data, transactions, selected_bank["name"], account_name, day + datetime.timedelta(days=1))
+    print(f"Balance of {selected_bank['name']} - {account_name} on {day.isoformat()}: {Money.of(balance)}")
+    input("Press Enter to return to menu...")
+
+
+def import_statement_menu(setup_data, transactions):
+    clear_screen()
+    print_header()
+    if not setup_data["banks"]:
+        print("No banks or accounts available.")
+        input("Press Enter to return to menu...")
+        return
+    path = questionary.text("Statement file (CSV or OFX):").ask()
+    bank_choices = []
+    for bank in setup_data["banks"]:
+        bank_choices.append(questionary.Choice(title=bank["name"], value=bank))
+    selected_bank = questionary.select("Import into bank:", choices=bank_choices).ask()
+    if not selected_bank["accounts"]:
+        print("No accounts available in this bank.")
+        input("Press Enter to return to menu...")
+        return
+    account_names = [account["name"] for account in selected_bank["accounts"]]
+    account_name = questionary.select("Import into account:", choices=account_names).ask()
+    try:
+        stats = import_statement_file(setup_data, as_ledger(transactions), path, selected_bank["name"], account_name)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Import failed: {e}")
+        input("Press Enter to return to menu...")
+        return
+    print(f"Imported {stats['imported']} of {stats['rows']} rows ({stats['duplicates']} duplicates and "
+          f"{stats['zero_amounts']} zero-amount rows skipped).")
+    input("Press Enter to return to menu...")
+
+
+REPORT_TITLES = {
+    "Income & Expense by Month": "monthly",
+    "Income & Expense by Account": "accounts",
+    "Top Descriptions by Spending": "descriptions",
+    "Rolling 3-Month Averages": "rolling",
+}
+
+
+def view_reports(transactions):
+    clear_screen()
+    print_header()
+    title = questionary.select("Select report:", choices=list(REPORT_TITLES)).ask()
+    since = questionary.text("From date (YYYY-MM-DD, blank for all):").ask()
+    until = questionary.text("Until date, exclusive (YYYY-MM-DD, blank for all):").ask()
+    try:
+        rows = run_report(transactions, REPORT_TITLES[title], since=since or None, until=until or None)
+    except ValueError as e:
+        print(f"Report failed: {e}")
+        input("Press Enter to return to menu...")
+        return
+    print(f"{title}:")
+    for line in format_report(rows):
+        print(line)
+    input("Press Enter to return to menu...")
+
+
+# --- Storage Maintenance ---
+
+def compact_storage():
+    clear_screen()
+    print_header()
+    storage = get_storage()
+    if storage.compact(background=True) is None:
+        print(f"The '{storage.name}' storage backend does not need compaction.")
+    else:
+        print("Compaction started in the background.")
+    input("Press Enter to return to menu...")
+
+
+def check_balances(setup_data):
+    clear_screen()
+    print_header()
+    scope = questionary.select(
+        "Check balances against:", choices=["Full history", "Last checkpoint and journal tail"]
+    ).ask()
+    drift = check_balance_integrity(setup_data, use_checkpoint=scope != "Full history")
+    if not drift:
+        save_setup(setup_data)
+        print("All account balances match their transaction history.")
+        input("Press Enter to return to menu...")
+        return
+    print("Balance drift detected:")
+    for bank, account, stored, expected in drift:
+        print(f"  - {bank} / {account}: stored {Money.of(stored)}, history {Money.of(expected)}")
+    if questionary.confirm("Reset these balances to their history values?").ask():
+        repair_balances(setup_data, drift)
+        save_setup(setup_data)
+        print("Balances repaired.")
+    input("Press Enter to return to menu...")
+
+
+def audit_menu(setup_data):
+    clear_screen()
+    print_header()
+    print("Auditing the ledger...")
+    audit = audit_ledger(setup_data)
+    print("\n".join(format_audit(audit)))
+    if audit["drift"] and questionary.confirm("Reset drifted balances to their history values?").ask():
+        repair_balances(setup_data, audit["drift"])
+        save_setup(setup_data)
+        print("Balances repaired.")
+    input("Press Enter to return to menu...")
+
+
+def storage_maintenance(setup_data, transactions):
+    while True:
+        with measure("menu.render"):
+            clear_screen()
+            print_header()
+            menu = questionary.select("Storage Maintenance:", choices=[
+                "Compact Storage",
+                "Check Balance Integrity",
+                "Audit Ledger",
+                "Back to Main Menu",
+            ])
+        choice = menu.ask()
+        if choice == "Compact Storage":
+            compact_storage()
+        elif choice == "Check Balance Integrity":
+            check_balances(setup_data)
+        elif choice == "Audit Ledger":
+            audit_menu(setup_data)
+        elif choice == "Back to Main Menu":
+            break
+
+
 # --- Main Menu ---
 
 def main_menu():
     setup_data = load_setup()
-    transactions = load_transactions()
+    transactions = Ledger(LazyTransactions())
 
     # Run initial setup if no banks exist.
     if not setup_data["banks"]:
@@ -547,22 +5276,559 @@ def main_menu():
         setup_data = load_setup()
 
     while True:
-        clear_screen()
-        print_header()
-        choice = questionary.select("Main Menu", choices=[
-            "Financial Operations",
-            "Bank & Account Management",
-            "Exit",
-        ]).ask()
+        with measure("menu.render"):
+            refresh_if_stale(setup_data, transactions)
+            clear_screen()
+            print_header()
+            menu = questionary.select("Main Menu", choices=[
+                "Financial Operations",
+                "Bank & Account Management",
+                "Storage Maintenance",
+                "Exit",
+            ])
+        choice = menu.ask()
 
         if choice == "Financial Operations":
             financial_operations(setup_data, transactions)
         elif choice == "Bank & Account Management":
             bank_account_management(setup_data, transactions)
+        elif choice == "Storage Maintenance":
+            storage_maintenance(setup_data, transactions)
         elif choice == "Exit":
+            transactions.save_caches()
+            get_storage().close()
             print("Goodbye!")
             break
 
 
+# --- Local API Server ---
+
+API_HOST = "127.0.0.1"
+API_PORT = 8765
+API_BATCH_SIZE = 512
+API_LIST_LIMIT = 100
+
+_HTTP_REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+def balance_report(setup_data, bank=None):
+    balances = get_balances(setup_data)
+    return [
+        {"bank": b["name"], "total": balances.bank_total(b["name"]),
+         "accounts": {account["name"]: account["balance"] for account in b["accounts"]}}
+        for b in setup_data["banks"]
+        if bank is None or b["name"] == bank
+    ]
+
+
+class ApiServer:
+    # Serves the headless operations as JSON over HTTP/1.1 (keep-alive):
+    #   GET   /balances?bank=
+    #   GET   /transactions?bank=&account=&type=&since=&until=&offset=&limit=
+    #   GET   /transactions/<id>
+    #   POST  /transactions               {"bank", "account", "type", "amount", "description", "date"}
+    #   PATCH /transactions/<id>          {"type", "amount", "description"}
+    #   POST  /transactions/<id>/refund   {"amount"}
+    # Reads are answered from memory. Writes are queued for a single writer
+    # task, which applies everything waiting and commits it as one batch, so
+    # concurrent clients share one commit. A batch is applied and committed
+    # without yielding to the event loop, so reads only see committed data.
+    def __init__(self, setup_data, ledger, batch_size=API_BATCH_SIZE):
+        self.setup_data = setup_data
+        self.ledger = ledger
+        self.batch_size = batch_size
+        self._queue = None
+        self._writer_task = None
+
+    async def start(self, host=API_HOST, port=API_PORT):
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._write_batches())
+        return await asyncio.start_server(self._serve_connection, host, port)
+
+    async def submit(self, op):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        return await future
+
+    async def _write_batches(self):
+        # Must outlive any failure: every write waits on this one task.
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                self.apply_batch(batch)
+            except Exception as e:
+                for _, future in batch:
+                    _resolve(future, error=e)
+                try:
+                    discard_changes(self.setup_data, self.ledger)
+                except Exception:
+                    pass  # retried by the next batch's refresh
+
+    def apply_batch(self, batch):
+        while batch:
+            batch = self._apply_batch(batch)
+
+    def _apply_batch(self, batch):
+        # Returns the operations to apply again, if the batch had to be undone.
+        changed = {}
+        applied = []
+        for index, (op, future) in enumerate(batch):
+            try:
+                tx = apply_operation(self.setup_data, self.ledger, op)
+            except KeyError as e:
+                _resolve(future, error=ValueError(f"Missing field {e}"))
+                continue
+            except (ValueError, TypeError) as e:
+                _resolve(future, error=ValueError(str(e)))
+                continue
+            except Exception as e:
+                # It may have been half applied: undo the batch and apply the
+                # rest again without it.
+                discard_changes(self.setup_data, self.ledger)
+                _resolve(future, error=e)
+                return batch[:index] + batch[index + 1:]
+            changed[tx["id"]] = tx
+            applied.append((future, tx))
+        if not changed:
+            return []
+        try:
+            commit_changes(self.setup_data, self.ledger, changed=list(changed.values()))
+        except Exception as e:
+            # Nothing in the batch was committed: drop it from memory too.
+            discard_changes(self.setup_data, self.ledger)
+            for future, _ in applied:
+                _resolve(future, error=e)
+            return []
+        for future, tx in applied:
+            _resolve(future, result=dict(tx))
+        return []
+
+    def list_transactions(self, query):
+        offset = int(query.get("offset", 0))
+        limit = min(int(query.get("limit", API_LIST_LIMIT)), 10 * API_LIST_LIMIT)
+        rows = self.ledger.select(bank=query.get("bank"), account=query.get("account"))
+        if "type" in query:
+            rows = (tx for tx in rows if tx["type"] == query["type"])
+        if "since" in query:
+            rows = (tx for tx in rows if tx["date"] >= query["since"])
+        if "until" in query:
+            rows = (tx for tx in rows if tx["date"] < query["until"])
+        return [dict(tx) for tx in itertools.islice(rows, offset, offset + limit)]
+
+    async def route(self, method, target, body):
+        url = urllib_parse.urlsplit(target)
+        parts = [part for part in url.path.split("/") if part]
+        query = dict(urllib_parse.parse_qsl(url.query))
+        try:
+            data = json.loads(body) if body else {}
+            if not isinstance(data, dict):
+                raise ValueError("Request body must be a JSON object")
+            if method == "GET":
+                # Pick up commits made by other processes (CLI, cron) first.
+                refresh_if_stale(self.setup_data, self.ledger)
+                if parts == ["balances"]:
+                    return 200, balance_report(self.setup_data, query.get("bank"))
+                if parts == ["transactions"]:
+                    return 200, self.list_transactions(query)
+                if len(parts) == 2 and parts[0] == "transactions":
+                    tx = self.ledger.get(parts[1])
+                    if tx is not None:
+                        return 200, dict(tx)
+            elif method == "POST" and parts == ["transactions"]:
+                return 201, await self.submit({**data, "op": "add"})
+            elif method == "PATCH" and len(parts) == 2 and parts[0] == "transactions":
+                return 200, await self.submit({**data, "op": "edit", "id": parts[1]})
+            elif method == "POST" and len(parts) == 3 and parts[0] == "transactions" and parts[2] == "refund":
+                return 201, await self.submit({**data, "op": "refund", "id": parts[1]})
+        except (ValueError, TypeError) as e:
+            return 400, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": str(e) or type(e).__name__}
+        return 404, {"error": "Not found"}
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                request = lines[0].split(" ")
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if len(request) != 3:
+                    status, payload, keep_alive = 400, {"error": "Malformed request"}, False
+                else:
+                    method, target, version = request
+                    body = await reader.readexactly(int(headers.get("content-length") or 0))
+                    status, payload = await self.route(method, target, body)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n%s" % (
+                        status, _HTTP_REASONS[status].encode(), len(data),
+                        b"" if keep_alive else b"Connection: close\r\n", data,
+                    )
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _resolve(future, result=None, error=None):
+    # The client may have disconnected and cancelled its future.
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def serve_api(setup_data, ledger, host=API_HOST, port=API_PORT, batch_size=API_BATCH_SIZE):
+    async def run():
+        server = await ApiServer(setup_data, ledger, batch_size).start(host, port)
+        print(f"Finance Manager API listening on http://{host}:{port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+# --- Command Line Interface ---
+
+def _amount_argument(text):
+    try:
+        return Money(positive_cents(text))
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def _date_argument(text):
+    try:
+        return _check_date(text)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def _add_view_arguments(parser):
+    parser.add_argument("--bank")
+    parser.add_argument("--account")
+    parser.add_argument("--since", help="first date included (ISO 8601)")
+    parser.add_argument("--until", help="first date excluded (ISO 8601)")
+    parser.add_argument("--type", dest="tx_type", choices=["deposit", "withdrawal"])
+    parser.add_argument("--min-amount", type=float)
+    parser.add_argument("--max-amount", type=float)
+    parser.add_argument("--sort", choices=list(SORT_KEYS), help="default: storage order")
+    parser.add_argument("--reverse", action="store_true", help="sort in descending order")
+    parser.add_argument("--offset", type=int, default=0, help="skip this many rows")
+    parser.add_argument("--limit", type=int, help="stop after this many rows")
+
+
+def _view_selection(args):
+    return {
+        "bank": args.bank, "account": args.account, "query": getattr(args, "query", None),
+        "since": args.since, "until": args.until, "tx_type": args.tx_type,
+        "min_amount": args.min_amount, "max_amount": args.max_amount,
+        "sort": args.sort, "reverse": args.reverse, "offset": args.offset, "limit": args.limit,
+    }
+
+
+def instrumentation_parser():
+    # Options accepted before or after any command, and with the interactive menu.
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--metrics", action="store_true", help=f"record operation timings in {METRICS_FILE}")
+    parser.add_argument("--profile", action="append", choices=PROFILERS,
+                        help=f"also write a profile of each operation to {PROFILE_DIR}/ (repeatable)")
+    return parser
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="finance_manager.py",
+        description="Finance Manager CLI. Run without arguments for the interactive menu.",
+        parents=[instrumentation_parser()],
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tx_parser = commands.add_parser("tx", help="add, edit, refund or list transactions")
+    tx_commands = tx_parser.add_subparsers(dest="tx_command", required=True)
+    add = tx_commands.add_parser("add", help="add a transaction")
+    add.add_argument("--bank", required=True)
+    add.add_argument("--account", required=True)
+    add.add_argument("--type", required=True, choices=TRANSACTION_TYPES)
+    add.add_argument("--amount", required=True, type=_amount_argument)
+    add.add_argument("--description", default="")
+    add.add_argument("--date", type=_date_argument, help="ISO timestamp (default: now)")
+    edit = tx_commands.add_parser("edit", help="edit a transaction")
+    edit.add_argument("id")
+    edit.add_argument("--type", choices=TRANSACTION_TYPES)
+    edit.add_argument("--amount", type=_amount_argument)
+    edit.add_argument("--description")
+    refund = tx_commands.add_parser("refund", help="refund a transaction")
+    refund.add_argument("id")
+    refund.add_argument("--amount", type=_amount_argument, help="default: full amount")
+    refunds = tx_commands.add_parser("refunds", help="show a transaction's refunds and what is left to refund")
+    refunds.add_argument("id")
+    refunds.add_argument("--json", action="store_true", help="print one JSON object per line")
+    listing = tx_commands.add_parser("list", help="list transactions")
+    _add_view_arguments(listing)
+    listing.add_argument("--json", action="store_true", help="print one JSON object per line")
+    listing.add_argument("--table", action="store_true", help="print an aligned table")
+    export = tx_commands.add_parser("export", help="write transactions to a CSV, JSON lines or columnar file")
+    export.add_argument("file")
+    export.add_argument("--format", choices=list(EXPORT_FORMATS),
+                        help="default: from the file extension (.csv, .jsonl, .columns)")
+    export.add_argument("--search", dest="query", help="only rows matching these words")
+    _add_view_arguments(export)
+    search = tx_commands.add_parser("search", help="find transactions by description, bank or account words")
+    search.add_argument("query", help="words to match as prefixes")
+    search.add_argument("--fuzzy", action="store_true", help="also match words one typo away")
+    search.add_argument("--since", help="first date included (ISO 8601)")
+    search.add_argument("--until", help="first date excluded (ISO 8601)")
+    search.add_argument("--min-amount", type=float)
+    search.add_argument("--max-amount", type=float)
+    search.add_argument("--json", action="store_true", help="print one JSON object per line")
+
+    balance = commands.add_parser("balance", help="show account balances")
+    balance.add_argument("--bank")
+    balance.add_argument("--json", action="store_true")
+
+    audit = commands.add_parser("audit", help="recompute every account in parallel and check it against the setup")
+    audit.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    audit.add_argument("--repair", action="store_true", help="reset drifted balances to their history values")
+    audit.add_argument("--json", action="store_true", help="print one JSON object per account, drift or anomaly")
+
+    batch = commands.add_parser("batch", help="apply many operations in one commit")
+    batch.add_argument("file", nargs="?", default="-", help="JSON-lines file of operations (default: stdin)")
+    batch.add_argument("--skip-errors", action="store_true", help="skip invalid operations instead of aborting")
+
+    statement = commands.add_parser("import", help="import a CSV or OFX bank statement")
+    statement.add_argument("file")
+    statement.add_argument("--bank", required=True, help="bank for rows without a bank column")
+    statement.add_argument("--account", required=True, help="account for rows without an account column")
+    statement.add_argument("--format", choices=("csv", "ofx"), help="default: from the file extension")
+    statement.add_argument("--map", action="append", default=[], metavar="FIELD=COLUMN",
+                           help=f"CSV column for a field ({', '.join(CSV_COLUMNS)})")
+    statement.add_argument("--date-format", help="strptime format of CSV dates (default: ISO 8601)")
+    statement.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="rows per commit")
+
+    report = commands.add_parser("report", help="income/expense summaries")
+    report.add_argument("name", choices=list(REPORTS))
+    report.add_argument("--bank")
+    report.add_argument("--account")
+    report.add_argument("--since", help="first date included (ISO 8601)")
+    report.add_argument("--until", help="first date excluded (ISO 8601)")
+    report.add_argument("--limit", type=int, default=10, help="rows in the descriptions report")
+    report.add_argument("--window", type=int, default=3, help="months in the rolling averages")
+    report.add_argument("--json", action="store_true", help="print one JSON object per line")
+
+    metrics = commands.add_parser("metrics", help=f"show the operation timings in {METRICS_FILE}")
+    metrics.add_argument("--json", action="store_true", help="print one JSON object per line")
+
+    serve = commands.add_parser("serve", help="run the local HTTP/JSON API")
+    serve.add_argument("--host", default=API_HOST)
+    serve.add_argument("--port", type=int, default=API_PORT)
+    serve.add_argument("--batch-size", type=int, default=API_BATCH_SIZE, help="most writes per commit")
+    return parser
+
+
+# JSON types of the operation fields, checked before anything is applied
+OPERATION_FIELDS = {
+    "op": str, "id": str, "bank": str, "account": str, "type": str, "description": str, "date": str,
+    "amount": (int, float),
+}
+
+
+def check_operation(op):
+    if not isinstance(op, dict):
+        raise ValueError("Operation must be a JSON object")
+    for field, types in OPERATION_FIELDS.items():
+        value = op.get(field)
+        if value is not None and (not isinstance(value, types) or isinstance(value, bool)):
+            raise ValueError(f"'{field}' must be {'a number' if field == 'amount' else 'a string'}")
+    return op
+
+
+def apply_operation(setup_data, ledger, op):
+    # One batch operation, e.g. {"op": "add", "bank": ..., "account": ..., "type": ...,
+    # "amount": ..., "description": ...}, {"op": "edit", "id": ..., "amount": ...}
+    # or {"op": "refund", "id": ..., "amount": ...}. Returns the row written.
+    kind = check_operation(op).get("op")
+    if kind == "add":
+        return post_transaction(
+            setup_data, ledger, op["bank"], op["account"], op["type"], op["amount"],
+            op.get("description", ""), op.get("date"),
+        )
+    if kind == "edit":
+        return amend_transaction(
+            setup_data, ledger, op["id"], op.get("type"), op.get("amount"), op.get("description")
+        )
+    if kind == "refund":
+        return post_refund(setup_data, ledger, op["id"], op.get("amount"))
+    raise ValueError(f"Unknown operation '{kind}'")
+
+
+def run_batch(setup_data, ledger, lines, skip_errors=False):
+    # Applies every operation in memory, then commits them with one write.
+    # Without `skip_errors` the first bad operation discards the ones before it.
+    changed = {}
+    errors = []
+    for line_no, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            tx = apply_operation(setup_data, ledger, json.loads(line))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            errors.append((line_no, e))
+            if not skip_errors:
+                discard_changes(setup_data, ledger)
+                return 0, errors
+            continue
+        changed[tx["id"]] = tx
+    if changed:
+        commit_changes(setup_data, ledger, changed=list(changed.values()))
+    return len(changed), errors
+
+
+def run_cli(argv):
+    args = build_parser().parse_args(argv)
+    setup_data = load_setup()
+    ledger = Ledger(LazyTransactions())
+    try:
+        if args.command == "tx" and args.tx_command == "list":
+            style = "json" if args.json else "table" if args.table else "line"
+            if style == "table":
+                print(TABLE_HEADER)
+            for tx in transaction_rows(ledger, **_view_selection(args)):
+                print(ROW_FORMATS[style](tx))
+        elif args.command == "tx" and args.tx_command == "export":
+            count = export_transactions(transaction_rows(ledger, **_view_selection(args)), args.file, args.format)
+            print(f"Exported {count} transactions to {args.file}.")
+        elif args.command == "tx" and args.tx_command == "refunds":
+            if args.json:
+                for depth, tx in ledger.refund_chain(args.id):
+                    print(json.dumps({**tx, "depth": depth, "refunded": ledger.refunded_cents(tx["id"]) / 100}))
+            else:
+                print("\n".join(format_refund_chain(ledger, args.id)))
+        elif args.command == "tx" and args.tx_command == "search":
+            rows = ledger.search(args.query, args.fuzzy, args.since, args.until, args.min_amount, args.max_amount)
+            for tx in rows:
+                print(json.dumps(dict(tx)) if args.json else format_transaction_choice(tx))
+        elif args.command == "tx":
+            if args.tx_command == "add":
+                tx = post_transaction(
+                    setup_data, ledger, args.bank, args.account, args.type, args.amount, args.description, args.date
+                )
+            elif args.tx_command == "edit":
+                tx = amend_transaction(setup_data, ledger, args.id, args.type, args.amount, args.description)
+            else:
+                tx = post_refund(setup_data, ledger, args.id, args.amount)
+            commit_changes(setup_data, ledger, changed=[tx])
+            print(tx["id"])
+        elif args.command == "audit":
+            audit = audit_ledger(setup_data, args.workers)
+            if args.json:
+                for result in audit["accounts"].values():
+                    print(json.dumps({key: value for key, value in result.items()
+                                      if key not in ("anomalies", "external_refunds")}))
+                for bank, account, stored, expected in audit["drift"]:
+                    print(json.dumps({"drift": {"bank": bank, "account": account,
+                                                "stored": stored, "expected": expected}}))
+                for tx_id, problem in audit["anomalies"]:
+                    print(json.dumps({"anomaly": {"id": tx_id, "problem": problem}}))
+                for bank, account, opening in audit["inferred"]:
+                    print(json.dumps({"inferred_opening": {"bank": bank, "account": account, "opening": opening}}))
+            else:
+                print("\n".join(format_audit(audit)))
+            if args.repair and audit["drift"]:
+                repair_balances(setup_data, audit["drift"])
+                save_setup(setup_data)
+                print(f"{len(audit['drift'])} balances repaired.", file=sys.stderr if args.json else sys.stdout)
+            if audit["anomalies"] or (audit["drift"] and not args.repair):
+                return 1
+        elif args.command == "balance":
+            for report in balance_report(setup_data, args.bank):
+                if args.json:
+                    print(json.dumps(report))
+                    continue
+                print(f"{report['bank']}: {Money.of(report['total'])}")
+                for account, balance in report["accounts"].items():
+                    print(f"  - {account}: {Money.of(balance)}")
+        elif args.command == "batch":
+            if args.file == "-":
+                count, errors = run_batch(setup_data, ledger, sys.stdin, args.skip_errors)
+            else:
+                with open(args.file, "r") as f:
+                    count, errors = run_batch(setup_data, ledger, f, args.skip_errors)
+            for line_no, error in errors:
+                print(f"line {line_no}: {error}", file=sys.stderr)
+            print(f"{count} operations committed.")
+            if errors and not args.skip_errors:
+                return 1
+        elif args.command == "report":
+            options = {"descriptions": {"limit": args.limit}, "rolling": {"window": args.window}}.get(args.name, {})
+            rows = run_report(ledger, args.name, args.bank, args.account, args.since, args.until, **options)
+            if args.json:
+                for row in rows:
+                    print(json.dumps(row))
+            else:
+                print("\n".join(format_report(rows)))
+        elif args.command == "metrics":
+            operations = load_metrics()
+            if args.json:
+                for name, summary in operations.items():
+                    print(json.dumps({"operation": name, **summary}))
+            else:
+                print("\n".join(format_metrics(operations)))
+        elif args.command == "serve":
+            serve_api(setup_data, ledger, args.host, args.port, args.batch_size)
+        elif args.command == "import":
+            mapping = {}
+            for item in args.map:
+                field, _, column = item.partition("=")
+                if field not in CSV_COLUMNS or not column:
+                    raise ValueError(f"Invalid column mapping '{item}'")
+                mapping[field] = column
+            stats = import_statement_file(
+                setup_data, ledger, args.file, args.bank, args.account, args.format, mapping,
+                args.date_format, args.batch_size,
+            )
+            print(f"{stats['imported']} imported, {stats['duplicates']} duplicates and "
+                  f"{stats['zero_amounts']} zero-amount rows skipped, "
+                  f"{stats['rows']} rows in {stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/s).")
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        ledger.save_caches()
+        get_storage().close()
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        options, argv = instrumentation_parser().parse_known_args(argv)
+        if options.metrics or options.profile:
+            enable_instrumentation(options.profile or ())
+    if not argv:
+        main_menu()
+        return 0
+    return run_cli(argv)
+
+
 if __name__ == "__main__":
-    main_menu()
+    sys.exit(main())
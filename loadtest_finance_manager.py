@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "finance_manager.py")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def _request(reader, writer, method, path, body=None):
+    data = json.dumps(body).encode("utf-8") if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+    return status
+
+
+async def _client(host, port, count, write_ratio, seed, results):
+    # One keep-alive connection issuing `count` requests back to back.
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(count):
+            if rng.random() < write_ratio:
+                kind, method, path = "write", "POST", "/transactions"
+                body = {"bank": "Load Bank", "account": "Checking", "type": rng.choice(("deposit", "withdrawal")),
+                        "amount": rng.randrange(1, 10000) / 100, "description": f"Load {rng.randrange(1000)}"}
+            else:
+                kind, method, path, body = "read", "GET", "/balances", None
+            started = time.perf_counter()
+            status = await _request(reader, writer, method, path, body)
+            results[kind].append(time.perf_counter() - started)
+            if status >= 400:
+                results["errors"] += 1
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, clients, requests, write_ratio):
+    results = {"read": [], "write": [], "errors": 0}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _client(host, port, requests // clients, write_ratio, seed, results) for seed in range(clients)
+    ))
+    elapsed = time.perf_counter() - started
+    report = {"clients": clients, "requests": 0, "errors": results["errors"], "seconds": round(elapsed, 3)}
+    for kind in ("read", "write"):
+        latencies = results[kind]
+        report["requests"] += len(latencies)
+        report[kind] = {
+            "requests": len(latencies),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        }
+    report["requests_per_second"] = round(report["requests"] / elapsed)
+    return report
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(data_dir, backend, port):
+    # Runs `finance_manager.py serve` against a fresh data directory.
+    with open(os.path.join(data_dir, "setup.json"), "w") as f:
+        json.dump({"banks": [{"name": "Load Bank", "accounts": [
+            {"name": "Checking", "balance": 0.0, "opening_balance": 0.0},
+        ]}]}, f)
+    env = dict(os.environ, FINANCE_MANAGER_STORAGE=backend)
+    server = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "serve", "--port", str(port)],
+        cwd=data_dir, env=env, stdout=subprocess.PIPE, text=True,
+    )
+    server.stdout.readline()  # "... listening on ..."
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the Finance Manager API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="test a running server instead of starting one")
+    parser.add_argument("--backend", default="journal", choices=("json", "journal", "sqlite"))
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    if args.port is not None:
+        report = asyncio.run(run_load(args.host, args.port, args.clients, args.requests, args.write_ratio))
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            port = _free_port()
+            server = start_server(data_dir, args.backend, port)
+            try:
+                report = asyncio.run(run_load(args.host, port, args.clients, args.requests, args.write_ratio))
+            finally:
+                server.terminate()
+                server.wait()
+        report["backend"] = args.backend
+    json.dump(report, sys.stdout, indent=4)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
+import asyncio
 import datetime
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
 import questionary
 import pytest
 
+import finance_manager
+
 # Import the functions to test from your CLI code.
 # (Make sure the finance_manager.py file is in the same directory or in your PYTHONPATH)
 from finance_manager import (
@@ -37,9 +47,27 @@ def set_monkeypatch_responses(monkeypatch, responses):
         "confirm",
         lambda prompt, **kwargs: DummyPrompter(next(it)),
     )
+    monkeypatch.setattr(
+        questionary,
+        "autocomplete",
+        lambda prompt, choices=None, **kwargs: DummyPrompter(next(it)),
+    )
     # Bypass the built-in input (used for "Press Enter to return to menu...")
     monkeypatch.setattr("builtins.input", lambda prompt="": None)
 
+
+# Keep data files out of the working tree and start every test with a fresh storage backend.
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(finance_manager, "_storage", None)
+    return tmp_path
+
+
+def use_storage(monkeypatch, backend):
+    monkeypatch.setattr(finance_manager, "STORAGE_BACKEND", backend)
+    monkeypatch.setattr(finance_manager, "_storage", None)
+
     
 def test_add_transaction(monkeypatch):
     # Set up a test bank with one account.
@@ -102,13 +130,10 @@ def test_refund_transaction(monkeypatch):
     test_bank = setup_data["banks"][0]
     test_account = test_bank["accounts"][0]
 
-    # Simulate refund selection with formatted transaction string
-    transaction_string = f"{transactions[0]['date'][:19]} | {transactions[0]['bank']} - {transactions[0]['account']} | {transactions[0]['type'].capitalize()} ${transactions[0]['amount']} | {transactions[0]['description']}"
-
     # Responses for refund_transaction:
-    # 1. Transaction selection: formatted transaction string.
+    # 1. Transaction selection: the picker returns the transaction id.
     # 2. Refund amount: "20" (default is full amount if blank)
-    responses = [transaction_string, "20"]
+    responses = ["tx1", "20"]
     set_monkeypatch_responses(monkeypatch, responses)
 
     refund_transaction(setup_data, transactions)
@@ -146,20 +171,12 @@ def test_edit_transaction(monkeypatch):
     test_bank = setup_data["banks"][0]
     test_account = test_bank["accounts"][0]
 
-    # Correctly formatted f-string (split across lines for readability)
-    transaction_string = (
-        f"{transactions[0]['date'][:19]} | "
-        f"{transactions[0]['bank']} - {transactions[0]['account']} | "
-        f"{transactions[0]['type'].capitalize()} ${transactions[0]['amount']} | "
-        f"{transactions[0]['description']}"
-    )
-
     # Simulate editing the transaction:
-    # 1. Transaction selection: formatted transaction string.
+    # 1. Transaction selection: the picker returns the transaction id.
     # 2. New transaction type: "Withdrawal"
     # 3. New amount: "30"
     # 4. New description: "Edited transaction"
-    responses = [transaction_string, "Withdrawal", "30", "Edited transaction"]
+    responses = ["tx1", "Withdrawal", "30", "Edited transaction"]
     set_monkeypatch_responses(monkeypatch, responses)
 
     edit_transaction(setup_data, transactions)
@@ -196,3 +213,1208 @@ def test_view_balance(capsys, monkeypatch):
     assert "  - A2: $200.00" in captured
     assert "Bank: Bank B (Total Balance: $300.00)" in captured
     assert "  - B1: $300.00" in captured
+
+
+def sample_transaction(tx_id, amount=10.0, bank="Test Bank", account="Checking"):
+    return {
+        "id": tx_id,
+        "bank": bank,
+        "account": account,
+        "type": "deposit",
+        "amount": amount,
+        "description": f"Deposit {tx_id}",
+        "date": datetime.datetime(2024, 1, 1).isoformat(),
+    }
+
+
+def test_journal_storage_appends_changes(data_dir, monkeypatch):
+    use_storage(monkeypatch, "journal")
+    transactions = [sample_transaction("tx1"), sample_transaction("tx2")]
+    finance_manager.save_transactions(transactions)
+
+    # Editing one row and deleting another only appends a patch and a tombstone.
+    transactions[0]["amount"] = 25.0
+    deleted = transactions.pop(1)
+    finance_manager.save_transactions(transactions, changed=[transactions[0]], deleted=[deleted["id"]])
+    finance_manager.get_storage().checkpoint()
+
+    records = [json.loads(line) for line in (data_dir / "transactions.jsonl").read_text().splitlines()]
+    assert [r["op"] for r in records] == ["put", "put", "patch", "del"]
+    assert records[2]["set"] == {"amount": 25.0}
+
+    # A fresh backend replays the journal to the same state.
+    monkeypatch.setattr(finance_manager, "_storage", None)
+    assert finance_manager.load_transactions() == transactions
+
+
+def test_journal_storage_compaction(data_dir, monkeypatch):
+    use_storage(monkeypatch, "journal")
+    transactions = [sample_transaction("tx1")]
+    finance_manager.save_transactions(transactions)
+    for amount in (1.0, 2.0, 3.0):
+        transactions[0]["amount"] = amount
+        finance_manager.save_transactions(transactions)
+
+    finance_manager.get_storage().compact()
+
+    lines = (data_dir / "transactions.jsonl").read_text().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["tx"]["amount"] == 3.0
+
+
+def test_journal_storage_imports_json_ledger(data_dir):
+    (data_dir / "transactions.json").write_text(json.dumps([sample_transaction("tx1")]))
+    storage = finance_manager.JournalStorage()
+    assert storage.load_transactions() == [sample_transaction("tx1")]
+    assert (data_dir / "transactions.jsonl").exists()
+
+
+def test_sqlite_storage_round_trip(data_dir, monkeypatch):
+    use_storage(monkeypatch, "sqlite")
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [{"name": "Checking", "balance": 100.0}]}]}
+    transactions = [sample_transaction("tx1"), sample_transaction("tx2", account="Savings")]
+    transactions[1]["refunded_transaction_id"] = "tx1"
+    finance_manager.save_setup(setup_data)
+    finance_manager.save_transactions(transactions)
+
+    assert finance_manager.load_setup() == setup_data
+    assert finance_manager.load_transactions() == transactions
+
+    storage = finance_manager.get_storage()
+    assert list(storage.iter_transactions(bank="Test Bank", account="Savings")) == [transactions[1]]
+
+    # Renames and deletes are applied in the database and mirrored in memory.
+    ledger = finance_manager.Ledger(transactions)
+    ledger.rename_bank("Test Bank", "New Bank")
+    ledger.delete("New Bank", "Checking")
+    assert [tx["id"] for tx in transactions] == ["tx2"]
+    assert finance_manager.load_transactions() == transactions
+
+    # Without a loaded ledger the database is updated on its own.
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    ledger.rename_account("New Bank", "Savings", "Joint")
+    assert not ledger.loaded
+    assert storage.transaction_accounts("New Bank") == ["Joint"]
+
+    # Amounts and balances are stored as integer cents.
+    conn = storage._connect()
+    assert conn.execute("SELECT cents FROM transactions WHERE id = 'tx2'").fetchall() == [(1000,)]
+    assert conn.execute("SELECT balance_cents FROM accounts").fetchall() == [(10000,)]
+
+
+def test_sqlite_storage_uses_indexes(data_dir, monkeypatch):
+    use_storage(monkeypatch, "sqlite")
+    conn = finance_manager.get_storage()._connect()
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM transactions WHERE bank = ? AND account = ?", ("a", "b")
+    ).fetchall()
+    assert "transactions_bank_account" in str(plan)
+
+
+def test_sqlite_storage_migrates_json_files(data_dir, monkeypatch):
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [{"name": "Checking", "balance": 10.0}]}]}
+    (data_dir / "setup.json").write_text(json.dumps(setup_data))
+    (data_dir / "transactions.json").write_text(json.dumps([sample_transaction("tx1")]))
+    use_storage(monkeypatch, "sqlite")
+
+    # Loading also gives the accounts ids and re-keys their rows by them.
+    finance_manager.assign_account_ids(setup_data)
+    assert finance_manager.load_setup() == setup_data
+    assert finance_manager.load_transactions() == [sample_transaction("tx1")]
+    assert finance_manager.get_storage()._rows()[0]["account_id"] == setup_data["banks"][0]["accounts"][0]["id"]
+    # The JSON storage read from is closed, lock file descriptor included.
+    if os.path.isdir("/proc/self/fd"):
+        lock_file = os.path.realpath(finance_manager.LOCK_FILE)
+        assert lock_file not in [os.path.realpath(f"/proc/self/fd/{fd}") for fd in os.listdir("/proc/self/fd")]
+
+
+def test_iter_json_array_streams_across_chunks(data_dir):
+    transactions = [sample_transaction(f"tx{i}", amount=float(i)) for i in range(50)]
+    (data_dir / "transactions.json").write_text(json.dumps(transactions, indent=4))
+    assert list(finance_manager._iter_json_array("transactions.json", chunk_size=7)) == transactions
+
+
+def test_journal_iter_transactions_matches_load(data_dir, monkeypatch):
+    use_storage(monkeypatch, "journal")
+    transactions = [sample_transaction(f"tx{i}") for i in range(5)]
+    finance_manager.save_transactions(transactions)
+    transactions[1]["amount"] = 99.0
+    transactions[3]["refunded_transaction_id"] = "tx0"
+    del transactions[2]
+    finance_manager.save_transactions(transactions)
+
+    assert list(finance_manager.iter_transactions()) == transactions
+    assert list(finance_manager.iter_transactions(bank="Test Bank", account="Checking")) == transactions
+
+
+def test_view_transactions_streams_without_loading(data_dir, monkeypatch, capsys):
+    finance_manager.save_transactions([sample_transaction("tx1"), sample_transaction("tx2", bank="Other")])
+    transactions = finance_manager.LazyTransactions()
+    set_monkeypatch_responses(monkeypatch, ["Filter by Bank", "Other"])
+
+    finance_manager.view_transactions(transactions)
+
+    captured = capsys.readouterr().out
+    assert "ID: tx2" in captured and "ID: tx1" not in captured
+    assert not transactions.loaded
+
+
+def test_ledger_indexes_follow_changes():
+    transactions = [
+        sample_transaction("tx1"),
+        sample_transaction("tx2", account="Savings"),
+        sample_transaction("tx3", bank="Other"),
+    ]
+    transactions[2]["date"] = datetime.datetime(2023, 6, 1).isoformat()
+    ledger = finance_manager.Ledger(transactions)
+
+    assert ledger.get("tx2") is transactions[1]
+    assert ledger.banks() == ["Other", "Test Bank"]
+    assert ledger.accounts("Test Bank") == ["Checking", "Savings"]
+    assert [tx["id"] for tx in ledger.between("2023-01-01", "2023-12-31")] == ["tx3"]
+
+    ledger.update(transactions[0], account="Savings", date=datetime.datetime(2025, 1, 1).isoformat())
+    assert [tx["id"] for tx in ledger.select("Test Bank", "Savings")] == ["tx2", "tx1"]
+    assert list(ledger.select("Test Bank", "Checking")) == []
+
+    ledger.rename_bank("Test Bank", "Renamed")
+    assert [tx["id"] for tx in ledger.select("Renamed")] == ["tx2", "tx1"]
+    assert transactions[0]["bank"] == "Renamed"
+
+    ledger.delete("Renamed", "Savings")
+    assert [tx["id"] for tx in transactions] == ["tx3"]
+    assert ledger.get("tx1") is None
+    assert ledger.banks() == ["Other"]
+
+
+def test_transaction_record_is_dict_compatible():
+    data = sample_transaction("0123456789abcdef0123456789abcdef", amount=12.34)
+    data["refunded_transaction_id"] = "tx0"
+    tx = finance_manager.Transaction.from_dict(data)
+
+    assert tx == data and tx.to_dict() == data
+    assert isinstance(tx._id, bytes) and isinstance(tx._date, int) and tx.cents == 1234
+    assert tx["amount"] == 12.34 and tx.get("missing") is None
+    assert "refunded_transaction_id" in tx
+
+    tx.update(amount=5.0, note="memo")
+    assert tx["amount"] == 5.0 and tx["note"] == "memo"
+    assert json.loads(json.dumps([tx], default=finance_manager._to_json))[0] == dict(tx)
+
+
+def test_columnar_transactions_round_trip():
+    rows = [sample_transaction("tx1"), sample_transaction("tx2", amount=2.5, account="Savings")]
+    rows[1]["type"] = "withdrawal"
+    rows[1]["date"] = "yesterday"
+    store = finance_manager.ColumnarTransactions(rows)
+
+    assert len(store) == 2
+    assert list(store.amounts) == [1000, 250] and list(store.signs) == [1, -1]
+    assert list(store) == rows
+
+
+def test_balance_engine_tracks_bank_totals(monkeypatch):
+    setup_data = {
+        "banks": [{"name": "Test Bank", "accounts": [
+            {"name": "Checking", "balance": 100.0},
+            {"name": "Savings", "balance": 50.0},
+        ]}]
+    }
+    balances = finance_manager.get_balances(setup_data)
+    assert balances.bank_total("Test Bank") == 150.0
+
+    test_bank = setup_data["banks"][0]
+    set_monkeypatch_responses(monkeypatch, [test_bank, test_bank["accounts"][1], "Withdrawal", "20", "Rent"])
+    add_transaction(setup_data, [])
+
+    assert test_bank["accounts"][1]["balance"] == 30.0
+    assert balances.bank_total("Test Bank") == 130.0
+
+
+def test_money_parses_formats_and_adds_exactly():
+    parse_money = finance_manager.parse_money
+    assert parse_money("12.5") == 1250
+    assert parse_money("$1,234.56") == 123456
+    assert parse_money("(20)") == -2000
+    assert parse_money("-€5", "EUR") == -500
+    assert parse_money("1.234,56 EUR", "EUR") == 123456
+    assert parse_money("1.234", "EUR") == 123400
+    assert parse_money("¥1,235", "JPY") == 123500
+    bad = [("", None), ("12.345", None), ("1.5", "JPY"), ("ten", None), ("1.2.3", None), ("12.34.56", None),
+           ("1,2.5", None), ("١٢", None)]
+    for text, currency in bad:
+        with pytest.raises(ValueError):
+            parse_money(text, currency)
+
+    assert finance_manager.format_money(-123456) == "-$1,234.56"
+    assert finance_manager.format_money(123456, "EUR") == "€1.234,56"
+    assert finance_manager.format_money(123450, "JPY") == "¥1,235"
+
+    Money = finance_manager.Money
+    assert Money.of(0.1) + Money.of(0.2) == Money.parse("0.30")
+    assert sum([Money.of(0.1)] * 10) == Money.of(1)
+    assert float(Money.parse("19.99") - Money.of(20)) == -0.01
+    assert finance_manager.sum_cents([10, 20, 30, -5], [1, 0, 1, 1], 3) == [20, 35, 0]
+
+
+def test_balance_engine_stays_exact_over_many_postings():
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [{"name": "Checking", "balance": 0.0}]}]}
+    balances = finance_manager.get_balances(setup_data)
+    rows = [sample_transaction(f"tx{i}", amount=0.1) for i in range(10_000)]
+    for tx in rows:
+        balances.apply(tx)
+
+    assert balances.account_cents("Test Bank", "Checking") == 100_000
+    assert setup_data["banks"][0]["accounts"][0]["balance"] == 1000.0
+    assert finance_manager.account_sums(rows) == {("Test Bank", "Checking"): 100_000}
+
+    # A stored balance off by a single cent is drift.
+    finance_manager.save_transactions(rows)
+    setup_data["banks"][0]["accounts"][0].update(balance=1000.01, opening_balance=0.0)
+    assert finance_manager.check_balance_integrity(setup_data) == [("Test Bank", "Checking", 1000.01, 1000.0)]
+
+
+def test_check_balance_integrity_detects_drift():
+    setup_data = {
+        "banks": [{"name": "Test Bank", "accounts": [
+            {"name": "Checking", "balance": 140.0, "opening_balance": 100.0},
+            {"name": "Savings", "balance": 5.0},
+        ]}]
+    }
+    finance_manager.save_transactions([sample_transaction("tx1", amount=50.0), sample_transaction("tx2", account="Savings")])
+
+    drift = finance_manager.check_balance_integrity(setup_data)
+
+    assert drift == [("Test Bank", "Checking", 140.0, 150.0)]
+    # Savings had no opening balance yet, so one is recorded from its history.
+    assert setup_data["banks"][0]["accounts"][1]["opening_balance"] == -5.0
+
+    finance_manager.repair_balances(setup_data, drift)
+    assert setup_data["banks"][0]["accounts"][0]["balance"] == 150.0
+    assert finance_manager.check_balance_integrity(setup_data) == []
+
+
+def test_history_balances_replays_journal_tail(monkeypatch):
+    use_storage(monkeypatch, "journal")
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [
+        {"name": "Checking", "balance": 0.0, "opening_balance": 0.0},
+    ]}]}
+    ledger = finance_manager.Ledger([])
+    balances = finance_manager.get_balances(setup_data)
+    first = ledger.add(sample_transaction("tx1", amount=10.0))
+    balances.apply(first)
+    finance_manager.save_transactions(ledger, changed=[first])
+    assert balances.checkpoint()
+
+    # Later changes reach the journal but the process dies before the setup is saved.
+    ledger.update(first, amount=4.0)
+    second = ledger.add(sample_transaction("tx2", amount=1.0))
+    finance_manager.save_transactions(ledger, changed=[first, second])
+
+    def no_full_scan(*args, **kwargs):
+        raise AssertionError("full history scan")
+    monkeypatch.setattr(finance_manager.get_storage(), "iter_transactions", no_full_scan)
+    assert finance_manager.history_balances(setup_data) == {("Test Bank", "Checking"): 5.0}
+
+
+def test_refresh_if_stale_keeps_the_balance_checkpoint(data_dir, monkeypatch):
+    use_storage(monkeypatch, "journal")
+    write_setup(data_dir, 0.0)
+    setup_data = finance_manager.load_setup()
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    tx = finance_manager.post_transaction(setup_data, ledger, "Test Bank", "Checking", "deposit", 10, "")
+    finance_manager.commit_changes(setup_data, ledger, changed=[tx])
+    assert finance_manager.get_balances(setup_data).checkpoint()
+
+    # Another process commits; refreshing picks it up without dropping the checkpoint.
+    other = finance_manager.JournalStorage()
+    other_setup = other.load_setup()
+    other_setup["banks"][0]["accounts"][0]["balance"] += 5.0
+    other.save_setup(other_setup)
+    assert finance_manager.refresh_if_stale(setup_data, ledger)
+    assert finance_manager.get_balances(setup_data).account_cents("Test Bank", "Checking") == 1500
+    assert os.path.exists(finance_manager.BALANCE_CHECKPOINT_FILE)
+
+
+def test_balance_history_answers_point_in_time_queries():
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [
+        {"name": "Checking", "balance": 135.0, "opening_balance": 100.0},
+    ]}]}
+    transactions = []
+    for day, amount in ((1, 10.0), (5, 20.0), (9, 5.0)):
+        tx = sample_transaction(f"tx{day}", amount=amount)
+        tx["date"] = datetime.datetime(2024, 1, day, 12).isoformat()
+        transactions.append(tx)
+    ledger = finance_manager.Ledger(transactions)
+
+    def on(day):
+        return finance_manager.balance_at(setup_data, ledger, "Test Bank", "Checking", datetime.date(2024, 1, day))
+
+    assert [on(1), on(2), on(6), on(10)] == [100.0, 110.0, 130.0, 135.0]
+
+    # Editing an old row updates the existing tree in place.
+    history = ledger.balance_history("Test Bank", "Checking")
+    ledger.update(ledger.get("tx1"), type="withdrawal")
+    assert ledger.balance_history("Test Bank", "Checking") is history
+    assert on(6) == 110.0
+
+    # Moving a row to a later date and appending new rows keep the tree too.
+    ledger.update(ledger.get("tx5"), date=datetime.datetime(2024, 1, 20).isoformat())
+    ledger.add(dict(sample_transaction("tx21", amount=1.0), date=datetime.datetime(2024, 1, 21).isoformat()))
+    assert ledger.balance_history("Test Bank", "Checking") is history
+    assert [on(6), on(21), on(22)] == [90.0, 115.0, 116.0]
+
+
+def test_balance_history_matches_running_sum():
+    import random
+    rng = random.Random(7)
+    rows = []
+    for i in range(200):
+        tx = sample_transaction(f"tx{i}", amount=float(rng.randrange(1, 100)))
+        tx["type"] = rng.choice(["deposit", "withdrawal"])
+        tx["date"] = datetime.datetime(2024, 1, 1, 0, rng.randrange(60), rng.randrange(60)).isoformat()
+        rows.append(tx)
+    history = finance_manager.BalanceHistory(rows)
+    for moment in sorted(tx["date"] for tx in rows)[::17]:
+        expected = sum(finance_manager.transaction_effect(tx) for tx in rows if tx["date"] < moment)
+        assert history.total_before(moment) == pytest.approx(expected)
+
+
+def test_pick_transaction_pages_and_searches(monkeypatch):
+    transactions = [sample_transaction(f"tx{i}") for i in range(45)]
+    transactions[30]["description"] = "Coffee beans"
+    ledger = finance_manager.Ledger(transactions)
+    pages = []
+    responses = iter([
+        finance_manager._NEXT_PAGE,
+        finance_manager._JUMP_TO_PAGE, "3",
+        finance_manager._SEARCH, "cof",
+        "tx30",
+    ])
+
+    def select(prompt, choices=None, **kwargs):
+        pages.append([c.value for c in choices if not isinstance(c, questionary.Separator)])
+        return DummyPrompter(next(responses))
+    monkeypatch.setattr(questionary, "select", select)
+    monkeypatch.setattr(questionary, "text", lambda prompt, **kwargs: DummyPrompter(next(responses)))
+    monkeypatch.setattr(questionary, "autocomplete", lambda prompt, choices=None, **kwargs: DummyPrompter(next(responses)))
+
+    assert finance_manager.pick_transaction(ledger, "Pick:") is transactions[30]
+
+    # Only one page of rows is offered at a time.
+    assert [v for v in pages[0] if isinstance(v, str)] == [f"tx{i}" for i in range(20)]
+    assert [v for v in pages[1] if isinstance(v, str)] == [f"tx{i}" for i in range(20, 40)]
+    assert [v for v in pages[2] if isinstance(v, str)] == [f"tx{i}" for i in range(40, 45)]
+    assert [v for v in pages[3] if isinstance(v, str)] == ["tx30"]
+    assert ledger.complete("co") == ["coffee"]
+
+
+def write_setup(data_dir, balance=0.0):
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [
+        {"name": "Checking", "balance": balance, "opening_balance": balance},
+    ]}]}
+    (data_dir / "setup.json").write_text(json.dumps(setup_data))
+
+
+def test_cli_add_refund_and_list(data_dir, capsys, monkeypatch):
+    write_setup(data_dir, 100.0)
+    # Headless commands must never prompt.
+    monkeypatch.setattr(questionary, "select", None)
+
+    assert finance_manager.main(["tx", "add", "--bank", "Test Bank", "--account", "Checking",
+                                 "--type", "withdrawal", "--amount", "40", "--description", "Groceries"]) == 0
+    tx_id = capsys.readouterr().out.strip()
+    assert finance_manager.main(["tx", "refund", tx_id, "--amount", "15"]) == 0
+    capsys.readouterr()
+
+    finance_manager.main(["tx", "list", "--json"])
+    rows = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [row["type"] for row in rows] == ["withdrawal", "deposit"]
+    assert rows[1]["refunded_transaction_id"] == tx_id
+    finance_manager.main(["balance"])
+    assert "  - Checking: $75.00" in capsys.readouterr().out
+
+    # The type carries the sign: a negative or zero amount is refused.
+    for amount in ("-30", "0"):
+        with pytest.raises(SystemExit):
+            finance_manager.main(["tx", "add", "--bank", "Test Bank", "--account", "Checking",
+                                  "--type", "deposit", "--amount=" + amount])
+    assert "more than zero" in capsys.readouterr().err
+    setup_data = finance_manager.load_setup()
+    with pytest.raises(ValueError, match="more than zero"):
+        finance_manager.post_transaction(setup_data, finance_manager.Ledger([]), "Test Bank", "Checking",
+                                         "deposit", -30, "")
+
+    # So is a date that is not an ISO 8601 timestamp.
+    with pytest.raises(SystemExit):
+        finance_manager.main(["tx", "add", "--bank", "Test Bank", "--account", "Checking",
+                              "--type", "deposit", "--amount", "5", "--date", "yesterday"])
+    assert "Invalid date 'yesterday'" in capsys.readouterr().err
+    with pytest.raises(ValueError, match="Invalid date"):
+        finance_manager.post_transaction(setup_data, finance_manager.Ledger([]), "Test Bank", "Checking",
+                                         "deposit", 5, "", "2024-13-01")
+    finance_manager.main(["balance"])
+    assert "  - Checking: $75.00" in capsys.readouterr().out
+
+
+def test_refund_index_limits_partial_refunds(data_dir, capsys, monkeypatch):
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [{"name": "Checking", "balance": 50.0}]}]}
+    ledger = finance_manager.Ledger([])
+    ledger.add(sample_transaction("tx1", amount=50.0))
+    first = finance_manager.post_refund(setup_data, ledger, "tx1", 20)
+    second = finance_manager.post_refund(setup_data, ledger, "tx1", 20)
+    # Only what is left of the original can still be refunded.
+    third = finance_manager.post_refund(setup_data, ledger, "tx1", 20)
+    assert third["amount"] == 10.0
+    assert ledger.refundable_cents("tx1") == 0
+    with pytest.raises(ValueError, match="fully refunded"):
+        finance_manager.post_refund(setup_data, ledger, "tx1")
+    assert setup_data["banks"][0]["accounts"][0]["balance"] == 0.0
+
+    with pytest.raises(ValueError):
+        finance_manager.amend_transaction(setup_data, ledger, first["id"], amount=25)
+    with pytest.raises(ValueError):
+        finance_manager.amend_transaction(setup_data, ledger, "tx1", amount=40)
+    finance_manager.amend_transaction(setup_data, ledger, first["id"], amount=5)
+    assert ledger.refunded_cents("tx1") == 3500
+    # A zero or negative refund would raise what is left to refund.
+    for amount in (-20, 0):
+        with pytest.raises(ValueError, match="more than zero"):
+            finance_manager.post_refund(setup_data, ledger, "tx1", amount)
+        with pytest.raises(ValueError, match="more than zero"):
+            finance_manager.amend_transaction(setup_data, ledger, first["id"], amount=amount)
+    assert ledger.refunded_cents("tx1") == 3500 and len(ledger.refunds("tx1")) == 3
+
+    # A refund of a refund shows up under it in the chain.
+    nested = finance_manager.post_refund(setup_data, ledger, second["id"], 5)
+    chain = ledger.refund_chain(nested["id"])
+    assert [(depth, tx["id"]) for depth, tx in chain] == [
+        (0, "tx1"), (1, second["id"]), (2, nested["id"]), (1, third["id"]), (1, first["id"]),
+    ]
+    assert ledger.refunds("tx1") == [second, third, first]
+    # A ledger indexed from the same rows agrees with the one kept up to date.
+    reloaded = finance_manager.Ledger(list(ledger))
+    assert reloaded.refunded_cents("tx1") == 3500 and reloaded.refunded_cents(second["id"]) == 500
+
+    ledger.delete("Test Bank", "Checking")
+    assert ledger.refunds("tx1") == [] and ledger.refunded_cents("tx1") == 0
+
+    # The CLI prints the chain with what is left of each original.
+    write_setup(data_dir, 100.0)
+    finance_manager.main(["tx", "add", "--bank", "Test Bank", "--account", "Checking",
+                          "--type", "withdrawal", "--amount", "40"])
+    tx_id = capsys.readouterr().out.strip()
+    finance_manager.main(["tx", "refund", tx_id, "--amount", "15"])
+    capsys.readouterr()
+    assert finance_manager.main(["tx", "refunds", tx_id]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2 and lines[0].endswith("[refunded $15.00, $25.00 left]")
+    assert lines[1].startswith("  ")
+
+
+def test_audit_recomputes_accounts_in_parallel(data_dir, capsys):
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [
+        {"name": "Checking", "balance": 130.0, "opening_balance": 100.0},
+        {"name": "Savings", "balance": 20.0, "opening_balance": 0.0},
+    ]}]}
+    (data_dir / "setup.json").write_text(json.dumps(setup_data))
+    refund = dict(sample_transaction("tx3", amount=15.0), type="withdrawal", refunded_transaction_id="tx1")
+    over = dict(sample_transaction("tx5", amount=10.0, account="Savings"), type="withdrawal",
+                refunded_transaction_id="tx4")
+    finance_manager.save_transactions([
+        sample_transaction("tx1", amount=25.0),
+        sample_transaction("tx2", amount=20.0),
+        refund,
+        sample_transaction("tx4", amount=5.0, account="Savings"),
+        over,
+        dict(sample_transaction("tx6", account="Savings"), refunded_transaction_id="gone"),
+    ])
+
+    serial = finance_manager.audit_ledger(finance_manager.load_setup(), workers=1)
+    parallel = finance_manager.audit_ledger(finance_manager.load_setup(), workers=2)
+    assert parallel["workers"] == 2 and parallel["shards"] == 2
+    assert serial == dict(parallel, workers=1)
+    checking = serial["accounts"][("Test Bank", "Checking")]
+    assert (checking["rows"], checking["net"], checking["refunded"]) == (3, 3000, 1500)
+    # Savings: 0 + 5 - 10 + 10 = 5, but the setup says 20.
+    assert serial["drift"] == [("Test Bank", "Savings", 20.0, 5.0)]
+    assert sorted(serial["anomalies"]) == [
+        ("gone", "refunded $10.00 but does not exist"),
+        ("tx4", "refunded $10.00, more than its amount"),
+    ]
+
+    assert finance_manager.main(["audit", "--workers", "2", "--repair"]) == 1
+    assert "Balance drift: Test Bank / Savings: stored $20.00, history $5.00" in capsys.readouterr().out
+    assert finance_manager.load_setup()["banks"][0]["accounts"][1]["balance"] == 5.0
+    assert finance_manager.audit_ledger(finance_manager.load_setup())["drift"] == []
+
+    # An account without an opening balance is reported as unverified, not as a failure.
+    setup_data = finance_manager.load_setup()
+    del setup_data["banks"][0]["accounts"][1]["opening_balance"]
+    finance_manager.save_setup(setup_data)
+    audit = finance_manager.audit_ledger(finance_manager.load_setup(), workers=1)
+    assert audit["inferred"] == [("Test Bank", "Savings", 0.0)]
+    assert audit["drift"] == [] and sorted(audit["anomalies"]) == sorted(serial["anomalies"])
+    assert "Unverified: Test Bank / Savings: no opening balance recorded, inferred $0.00 from the stored balance" in (
+        finance_manager.format_audit(audit)
+    )
+
+
+def test_generated_ledgers_are_deterministic_and_consistent():
+    import bench_finance_manager
+
+    rows = bench_finance_manager.sample_rows(3000, banks=2, accounts=3, refunds=0.2, seed=7)
+    assert rows == bench_finance_manager.sample_rows(3000, banks=2, accounts=3, refunds=0.2, seed=7)
+    assert rows != bench_finance_manager.sample_rows(3000, banks=2, accounts=3, refunds=0.2, seed=8)
+    assert {(tx["bank"], tx["account"]) for tx in rows} == {
+        (f"Bank {b}", f"Account {a}") for b in range(2) for a in range(3)
+    }
+    assert 400 < sum("refunded_transaction_id" in tx for tx in rows) < 800
+
+    # Refunds stay within their originals and the setup matches the rows.
+    setup_data = bench_finance_manager.sample_setup(rows, banks=2, accounts=3)
+    audit = finance_manager.audit_ledger(setup_data, workers=1, rows=rows)
+    assert audit["drift"] == [] and audit["anomalies"] == []
+
+
+def test_cli_batch_commits_once(data_dir, capsys, monkeypatch):
+    write_setup(data_dir)
+    ops = [{"op": "add", "bank": "Test Bank", "account": "Checking", "type": "deposit", "amount": 1.5}] * 50
+    (data_dir / "ops.jsonl").write_text("\n".join(json.dumps(op) for op in ops))
+    saves = []
+    original_save = finance_manager.save_transactions
+    monkeypatch.setattr(finance_manager, "save_transactions", lambda *a, **kw: saves.append(1) or original_save(*a, **kw))
+
+    assert finance_manager.main(["batch", "ops.jsonl"]) == 0
+    assert len(saves) == 1
+    assert len(finance_manager.load_transactions()) == 50
+    assert finance_manager.load_setup()["banks"][0]["accounts"][0]["balance"] == 75.0
+
+
+def test_cli_batch_aborts_without_writing(data_dir, capsys):
+    write_setup(data_dir)
+    (data_dir / "ops.jsonl").write_text(
+        json.dumps({"op": "add", "bank": "Test Bank", "account": "Checking", "type": "deposit", "amount": 1}) + "\n"
+        + json.dumps({"op": "add", "bank": "Nope", "account": "Checking", "type": "deposit", "amount": 1}) + "\n"
+    )
+    assert finance_manager.main(["batch", "ops.jsonl"]) == 1
+    assert "line 2" in capsys.readouterr().err
+    assert finance_manager.load_transactions() == []
+    # Nor through the ledger snapshot a fresh session would read instead.
+    assert list(finance_manager.LazyTransactions().load()) == []
+
+    # The operations applied before the bad one are undone in memory too.
+    setup_data = finance_manager.load_setup()
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    with open(data_dir / "ops.jsonl") as f:
+        assert finance_manager.run_batch(setup_data, ledger, f)[0] == 0
+    assert len(ledger) == 0 and not ledger.uncommitted
+    assert setup_data["banks"][0]["accounts"][0]["balance"] == 0.0
+    assert finance_manager.get_balances(setup_data).account_cents("Test Bank", "Checking") == 0
+
+    # Bad dates and mistyped fields are reported per line instead of crashing.
+    lines = [
+        json.dumps({"op": "add", "bank": "Test Bank", "account": "Checking", "type": "deposit", "amount": 1,
+                    "date": "yesterday"}),
+        json.dumps({"op": "add", "bank": "Test Bank", "account": "Checking", "type": 5, "amount": 1}),
+        json.dumps({"op": "add", "bank": "Test Bank", "account": "Checking", "type": "deposit", "amount": 2,
+                    "date": "2024-01-02"}),
+    ]
+    written, errors = finance_manager.run_batch(setup_data, ledger, lines, skip_errors=True)
+    assert written == 1 and [line_no for line_no, _ in errors] == [1, 2]
+    assert [tx["date"] for tx in ledger] == ["2024-01-02T00:00:00"]
+
+
+@pytest.mark.parametrize("backend", ["json", "journal", "sqlite"])
+def test_import_csv_skips_rows_already_imported(data_dir, capsys, monkeypatch, backend):
+    use_storage(monkeypatch, backend)
+    write_setup(data_dir, 100.0)
+    (data_dir / "statement.csv").write_text(
+        "Posted Date,Details,Amount\n"
+        "01/02/2024,Coffee,-3.50\n"
+        "01/02/2024,Coffee,-3.50\n"
+        "01/05/2024,Salary,\"1,000.00\"\n"
+        "01/06/2024,Card check,0.00\n"
+    )
+    args = ["import", "statement.csv", "--bank", "Test Bank", "--account", "Checking", "--date-format", "%m/%d/%Y"]
+
+    assert finance_manager.main(args + ["--batch-size", "2"]) == 0
+    assert "3 imported, 0 duplicates and 1 zero-amount rows skipped" in capsys.readouterr().out
+    assert finance_manager.main(args) == 0
+    assert "0 imported, 3 duplicates and 1 zero-amount rows skipped" in capsys.readouterr().out
+
+    rows = sorted(finance_manager.iter_transactions(), key=lambda tx: tx["date"])
+    assert [(tx["type"], tx["amount"], tx["description"]) for tx in rows] == [
+        ("withdrawal", 3.5, "Coffee"), ("withdrawal", 3.5, "Coffee"), ("deposit", 1000.0, "Salary"),
+    ]
+    assert rows[2]["date"] == "2024-01-05T00:00:00"
+    assert finance_manager.load_setup()["banks"][0]["accounts"][0]["balance"] == 1093.0
+
+
+def test_csv_statement_amounts_are_parsed_as_money():
+    statement = io.StringIO(
+        "Date,Amount\n"
+        "2024-01-01,(12.50)\n"
+        "2024-01-02,3.10-\n"
+        "2024-01-03,\"$1,000.07\"\n"
+        "2024-01-04,0.29\n"
+    )
+    rows = list(finance_manager.iter_csv_statement(statement))
+    assert [(tx["type"], tx["amount"]) for tx in rows] == [
+        ("withdrawal", 12.5), ("withdrawal", 3.1), ("deposit", 1000.07), ("deposit", 0.29),
+    ]
+    assert [finance_manager.to_cents(tx["amount"]) for tx in rows] == [1250, 310, 100007, 29]
+    with pytest.raises(ValueError):
+        list(finance_manager.iter_csv_statement(io.StringIO("Date,Amount\n2024-01-01,12.345\n")))
+    with pytest.raises(ValueError):
+        list(finance_manager.iter_csv_statement(io.StringIO("Date,Amount\n2024-01-01,1.2.3\n")))
+
+
+def test_import_ofx_uses_fitid(data_dir):
+    write_setup(data_dir)
+    (data_dir / "statement.ofx").write_text(
+        "OFXHEADER:100\nDATA:OFXSGML\n\n<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>\n"
+        "<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240103120000[-5:EST]<TRNAMT>-12.25<FITID>A1<NAME>Books\n</STMTTRN>\n"
+        "<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240104<TRNAMT>50.00<FITID>A2<NAME>Refund<MEMO>Order 7\n</STMTTRN>\n"
+        "</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n"
+    )
+    setup_data = finance_manager.load_setup()
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    stats = finance_manager.import_statement_file(setup_data, ledger, "statement.ofx", "Test Bank", "Checking")
+
+    assert (stats["imported"], stats["duplicates"]) == (2, 0)
+    assert [(tx["id"], tx["amount"], tx["description"], tx["date"]) for tx in ledger] == [
+        ("A1", 12.25, "Books", "2024-01-03T12:00:00"),
+        ("A2", 50.0, "Refund Order 7", "2024-01-04T00:00:00"),
+    ]
+    assert setup_data["banks"][0]["accounts"][0]["balance"] == 37.75
+
+
+@pytest.mark.parametrize("backend", ["json", "journal"])
+def test_commit_log_recovers_complete_commits_only(data_dir, monkeypatch, backend):
+    use_storage(monkeypatch, backend)
+    write_setup(data_dir, 100.0)
+    setup_data = finance_manager.load_setup()
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    for amount in (10.0, 5.0):
+        tx = finance_manager.post_transaction(setup_data, ledger, "Test Bank", "Checking", "withdrawal", amount, "")
+        finance_manager.commit_changes(setup_data, ledger, changed=[tx])
+    # Commits are only in the log so far; then the process dies mid-write.
+    assert json.loads((data_dir / "setup.json").read_text())["banks"][0]["accounts"][0]["balance"] == 100.0
+    with open(data_dir / "commit.wal", "ab") as f:
+        f.write(b'0badc0de {"setup":{"banks":[]}')
+    monkeypatch.setattr(finance_manager, "_storage", None)
+
+    assert finance_manager.load_setup()["banks"][0]["accounts"][0]["balance"] == 85.0
+    assert sorted(tx["amount"] for tx in finance_manager.load_transactions()) == [5.0, 10.0]
+    assert not (data_dir / "commit.wal").exists() or (data_dir / "commit.wal").stat().st_size == 0
+
+
+def test_full_saves_log_a_side_file_not_the_rows(data_dir, monkeypatch):
+    use_storage(monkeypatch, "json")
+    rows = [sample_transaction(f"tx{i}", amount=float(i)) for i in range(1, 201)]
+    finance_manager.save_transactions(rows)
+    # The log names the file holding the rows instead of carrying them.
+    wal = (data_dir / "commit.wal").read_bytes()
+    assert len(wal) < 200 and b"tx1" not in wal
+    finance_manager.save_transactions([], changed=[sample_transaction("tx201")])
+
+    # Crash before the checkpoint: the next session replays both commits.
+    monkeypatch.setattr(finance_manager, "_storage", None)
+    assert [tx["id"] for tx in finance_manager.load_transactions()] == [f"tx{i}" for i in range(1, 202)]
+    assert list(data_dir.glob("*.full")) == []
+
+    # With nothing committed after it, the side file is renamed into place.
+    finance_manager.save_transactions(rows)
+    written = next(data_dir.glob("*.full")).read_bytes()
+    finance_manager.get_storage().checkpoint()
+    assert (data_dir / "transactions.json").read_bytes() == written
+    assert list(data_dir.glob("*.full")) == []
+
+
+def test_commit_log_redoes_interrupted_checkpoint(data_dir, monkeypatch):
+    use_storage(monkeypatch, "journal")
+    write_setup(data_dir)
+    setup_data = finance_manager.load_setup()
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    tx = finance_manager.post_transaction(setup_data, ledger, "Test Bank", "Checking", "deposit", 7.0, "")
+    finance_manager.commit_changes(setup_data, ledger, changed=[tx])
+
+    # Crash after the journal was appended to but before setup.json was replaced.
+    def crash(path, write):
+        raise OSError("disk unplugged")
+    write_atomic = finance_manager._write_atomic
+    monkeypatch.setattr(finance_manager, "_write_atomic", crash)
+    with pytest.raises(OSError):
+        finance_manager.get_storage().checkpoint()
+    monkeypatch.setattr(finance_manager, "_write_atomic", write_atomic)
+    monkeypatch.setattr(finance_manager, "_storage", None)
+
+    assert finance_manager.load_setup()["banks"][0]["accounts"][0]["balance"] == 7.0
+    assert len((data_dir / "transactions.jsonl").read_text().splitlines()) == 1
+
+
+def test_sqlite_atomic_rolls_back_both(data_dir, monkeypatch):
+    use_storage(monkeypatch, "sqlite")
+    write_setup(data_dir, 100.0)
+    setup_data = finance_manager.load_setup()
+    storage = finance_manager.get_storage()
+    with pytest.raises(RuntimeError):
+        with storage.atomic():
+            finance_manager.save_transactions([sample_transaction("tx1")], changed=[sample_transaction("tx1")])
+            setup_data["banks"][0]["accounts"][0]["balance"] = 110.0
+            finance_manager.save_setup(setup_data)
+            raise RuntimeError
+    assert finance_manager.load_transactions() == []
+    assert finance_manager.load_setup()["banks"][0]["accounts"][0]["balance"] == 100.0
+
+
+def _post_deposits(data_dir, backend, count):
+    os.chdir(data_dir)
+    finance_manager.STORAGE_BACKEND = backend
+    finance_manager._storage = None
+    setup_data = finance_manager.load_setup()
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    for _ in range(count):
+        tx = finance_manager.post_transaction(setup_data, ledger, "Test Bank", "Checking", "deposit", 1.0, "")
+        finance_manager.commit_changes(setup_data, ledger, changed=[tx])
+    finance_manager.get_storage().close()
+
+
+@pytest.mark.parametrize("backend", ["json", "journal", "sqlite"])
+def test_parallel_writers_do_not_lose_updates(data_dir, monkeypatch, backend):
+    use_storage(monkeypatch, backend)
+    write_setup(data_dir)
+    finance_manager.load_setup()
+    finance_manager.get_storage().close()
+
+    # Every writer starts from the same, soon stale, setup.
+    context = multiprocessing.get_context("fork")
+    writers = [context.Process(target=_post_deposits, args=(str(data_dir), backend, 25)) for _ in range(8)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    assert [writer.exitcode for writer in writers] == [0] * 8
+
+    monkeypatch.setattr(finance_manager, "_storage", None)
+    setup_data = finance_manager.load_setup()
+    assert setup_data["banks"][0]["accounts"][0]["balance"] == 200.0
+    assert len(finance_manager.load_transactions()) == 200
+    assert finance_manager.check_balance_integrity(setup_data) == []
+
+
+def test_stale_setup_is_merged_not_overwritten(data_dir):
+    write_setup(data_dir, 100.0)
+    first = finance_manager.JsonStorage()
+    second = finance_manager.JsonStorage()
+    first_setup = first.load_setup()
+    second_setup = second.load_setup()
+
+    first_setup["banks"][0]["accounts"][0]["balance"] += 10.0
+    first.save_setup(first_setup)
+    assert second.is_stale()
+    second_setup["banks"][0]["accounts"].append({"name": "Savings", "balance": 5.0, "opening_balance": 5.0})
+    second_setup["banks"][0]["accounts"][0]["balance"] -= 30.0
+    second.save_setup(second_setup)
+
+    assert second.merged
+    assert [(a["name"], a["balance"]) for a in second_setup["banks"][0]["accounts"]] == [
+        ("Checking", 80.0), ("Savings", 5.0),
+    ]
+    assert first.is_stale()
+    assert first.load_setup() == second_setup
+
+
+@pytest.mark.parametrize("backend", ["json", "journal", "sqlite"])
+def test_account_ids_keep_renames_and_deletes_in_the_setup(data_dir, monkeypatch, backend):
+    use_storage(monkeypatch, backend)
+    setup_data = {"banks": [{"name": "Test Bank", "accounts": [
+        {"name": "Checking", "balance": 0.0}, {"name": "Savings", "balance": 0.0},
+    ]}]}
+    (data_dir / "setup.json").write_text(json.dumps(setup_data))
+    finance_manager.save_transactions([sample_transaction("tx1"), sample_transaction("tx2", account="Savings")])
+
+    # Loading assigns ids and re-keys the existing rows by them.
+    setup_data = finance_manager.load_setup()
+    storage = finance_manager.get_storage()
+    assert all("account_id" in row and "bank" not in row for row in storage._rows())
+
+    # A rename only writes the setup.
+    writes = []
+    save_transactions = storage.save_transactions
+    monkeypatch.setattr(storage, "save_transactions", lambda *a, **kw: writes.append(a) or save_transactions(*a, **kw))
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    setup_data["banks"][0]["name"] = "Renamed"
+    with storage.atomic():
+        ledger.rename_bank("Test Bank", "Renamed")
+        finance_manager.save_setup(setup_data)
+    assert writes == [] and not ledger.loaded
+    assert {tx["bank"] for tx in finance_manager.load_transactions()} == {"Renamed"}
+
+    # A delete hides the rows at once; the purge removes them in the background.
+    bank = setup_data["banks"][0]
+    savings = bank["accounts"].pop()
+    with storage.atomic():
+        deleted = ledger.delete("Renamed", "Savings")
+        setup_data.setdefault("deleted_account_ids", []).extend(deleted)
+        finance_manager.save_setup(setup_data)
+    assert deleted == [savings["id"]]
+    assert [tx["id"] for tx in finance_manager.load_transactions()] == ["tx1"]
+    storage.close()
+    monkeypatch.setattr(finance_manager, "_storage", None)
+    assert [row["id"] for row in finance_manager.get_storage()._rows()] == ["tx1"]
+
+    # An account re-created under the old name gets a new id and none of the old rows.
+    bank["accounts"].append({"name": "Savings", "balance": 0.0})
+    finance_manager.save_setup(setup_data)
+    assert bank["accounts"][1]["id"] != savings["id"]
+    assert list(finance_manager.iter_transactions("Renamed", "Savings")) == []
+
+
+async def _http(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(payload)
+
+
+def test_api_server_batches_concurrent_writes(data_dir, monkeypatch):
+    write_setup(data_dir, 100.0)
+    setup_data = finance_manager.load_setup()
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    commits = []
+    failing = []
+    original_commit = finance_manager.commit_changes
+
+    def commit_changes(*args, **kwargs):
+        commits.append(1)
+        if failing:
+            raise sqlite3.OperationalError(failing.pop())
+        return original_commit(*args, **kwargs)
+    monkeypatch.setattr(finance_manager, "commit_changes", commit_changes)
+
+    async def scenario():
+        server = await finance_manager.ApiServer(setup_data, ledger).start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        add = {"bank": "Test Bank", "account": "Checking", "type": "withdrawal", "amount": 2, "description": "Tea"}
+        results = await asyncio.gather(*(_http(port, "POST", "/transactions", add) for _ in range(20)))
+        tx_id = results[0][1]["id"]
+        results.append(await _http(port, "PATCH", f"/transactions/{tx_id}", {"amount": 4}))
+        results.append(await _http(port, "POST", f"/transactions/{tx_id}/refund", {"amount": 1}))
+        results.append(await _http(port, "POST", "/transactions", {**add, "account": "Nope"}))
+        results.append(await _http(port, "GET", "/transactions?type=deposit"))
+        results.append(await _http(port, "GET", "/balances"))
+        results.append(await _http(port, "GET", "/nowhere"))
+        # Neither a bad field nor a failed commit stops the writer.
+        results.append(await _http(port, "POST", "/transactions", {**add, "type": 5}))
+        failing.append("database is locked")
+        results.append(await _http(port, "POST", "/transactions", add))
+        results.append(await asyncio.wait_for(_http(port, "POST", "/transactions", add), 10))
+        server.close()
+        return results
+
+    results = asyncio.run(scenario())
+    assert [status for status, _ in results[:20]] == [201] * 20
+    assert len(commits) < 20
+    assert results[20] == (200, {**results[0][1], "amount": 4.0, "date": results[20][1]["date"]})
+    assert results[21][0] == 201
+    assert results[22] == (400, {"error": "Unknown account 'Nope' at bank 'Test Bank'"})
+    assert [tx["refunded_transaction_id"] for tx in results[23][1]] == [results[0][1]["id"]]
+    assert results[24] == (200, [{"bank": "Test Bank", "total": 59.0, "accounts": {"Checking": 59.0}}])
+    assert results[25][0] == 404
+    assert results[26] == (400, {"error": "'type' must be a string"})
+    assert results[27] == (500, {"error": "database is locked"})
+    assert results[28][0] == 201
+    assert finance_manager.load_setup()["banks"][0]["accounts"][0]["balance"] == 57.0
+
+
+def test_reports_group_by_month_account_and_description(data_dir, capsys):
+    rows = []
+    for i, (month, account, tx_type, amount, description) in enumerate([
+        (1, "Checking", "deposit", 1000.0, "Salary"),
+        (1, "Checking", "withdrawal", 40.25, "Groceries"),
+        (1, "Savings", "withdrawal", 10.0, "Coffee"),
+        (3, "Checking", "withdrawal", 59.75, "Groceries"),
+    ]):
+        tx = sample_transaction(f"tx{i}", amount=amount, account=account)
+        tx.update(type=tx_type, description=description, date=datetime.datetime(2024, month, 5).isoformat())
+        rows.append(tx)
+    refund = dict(sample_transaction("tx9", amount=5.0, account="Savings"), description="Refund", refunded_transaction_id="tx2")
+    refund["date"] = datetime.datetime(2024, 3, 1).isoformat()
+    rows.append(refund)
+    ledger = finance_manager.Ledger(rows)
+
+    # Refunds reduce expense instead of counting as income.
+    assert finance_manager.run_report(ledger, "monthly") == [
+        {"month": "2024-01", "income": 1000.0, "expense": 50.25, "net": 949.75, "count": 3},
+        {"month": "2024-03", "income": 0.0, "expense": 54.75, "net": -54.75, "count": 2},
+    ]
+    assert [(r["account"], r["expense"]) for r in finance_manager.run_report(ledger, "accounts")] == [
+        ("Checking", 100.0), ("Savings", 5.0),
+    ]
+    assert finance_manager.run_report(ledger, "descriptions", limit=1) == [
+        {"description": "Groceries", "expense": 100.0, "count": 2},
+    ]
+    rolling = finance_manager.run_report(ledger, "rolling", window=2)
+    assert [(r["month"], r["expense_avg"]) for r in rolling] == [("2024-01", 50.25), ("2024-02", 25.12), ("2024-03", 27.38)]
+    assert finance_manager.run_report(ledger, "monthly", since="2024-02-01")[0]["month"] == "2024-03"
+
+    finance_manager.save_transactions(rows)
+    assert finance_manager.main(["report", "accounts", "--bank", "Test Bank"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["bank", "account", "income", "expense", "net", "count"]
+    assert lines[1].split() == ["Test", "Bank", "Checking", "1000.00", "100.00", "900.00", "3"]
+
+
+@pytest.mark.parametrize("backend", ["json", "journal", "sqlite"])
+def test_aggregate_cache_follows_changes_and_survives_restart(data_dir, monkeypatch, backend):
+    use_storage(monkeypatch, backend)
+    write_setup(data_dir, 100.0)
+    setup_data = finance_manager.load_setup()
+    setup_data["banks"][0]["accounts"].append({"name": "Savings", "balance": 0.0, "opening_balance": 0.0})
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    posted = []
+    for day, account, amount in ((3, "Checking", 10.0), (20, "Checking", 5.0), (40, "Savings", 7.0)):
+        tx = finance_manager.post_transaction(setup_data, ledger, "Test Bank", account, "withdrawal", amount, "",
+                                              (datetime.datetime(2024, 1, 1) + datetime.timedelta(days=day)).isoformat())
+        posted.append(tx)
+    finance_manager.commit_changes(setup_data, ledger, changed=posted)
+
+    def reports(**bounds):
+        cached = [finance_manager.run_report(ledger, name, **bounds) for name in ("monthly", "accounts", "rolling")]
+        frame = finance_manager.report_frame(ledger, **bounds)
+        assert cached == [finance_manager.REPORTS[name](frame) for name in ("monthly", "accounts", "rolling")]
+        return cached[0]
+
+    assert [(r["month"], r["expense"]) for r in reports()] == [("2024-01", 15.0), ("2024-02", 7.0)]
+    assert [(r["month"], r["expense"]) for r in reports(since="2024-01-10", until="2024-02-01")] == [("2024-01", 5.0)]
+    cache = ledger.aggregates()
+
+    # An edit marks only its own buckets; a new row is added to its bucket in place.
+    edited = finance_manager.amend_transaction(setup_data, ledger, posted[2]["id"], amount=8.0)
+    assert cache.dirty == {("Test Bank", "Savings", "2024-02"), ("Test Bank", "Savings", edited["date"][:7])}
+    tx = finance_manager.post_transaction(setup_data, ledger, "Test Bank", "Checking", "deposit", 2.0, "", "2024-01-05T00:00:00")
+    finance_manager.commit_changes(setup_data, ledger, changed=[edited, tx])
+    assert cache.months[("Test Bank", "Checking", "2024-01")][:2] == [200, 1500]
+    reports()
+    reports(since="2024-01-04", until="2024-01-21")
+
+    with finance_manager.get_storage().atomic():
+        ledger.rename_account("Test Bank", "Checking", "Current")
+    assert ("Test Bank", "Current", "2024-01") in cache.months
+    reports()
+
+    # A restart reuses the saved buckets without reading the ledger.
+    finance_manager.get_storage().close()
+    monkeypatch.setattr(finance_manager, "_storage", None)
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    monkeypatch.setattr(ledger, "select", lambda *a, **kw: pytest.fail("ledger scanned"))
+    assert finance_manager.run_report(ledger, "accounts")[0]["account"] == "Current"
+
+    # A commit by another session invalidates it.
+    other = finance_manager.Ledger([])
+    finance_manager.save_transactions(other, changed=[other.add(sample_transaction("tx9", account="Savings"))])
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    assert ledger.aggregates().months == {}
+    reports()
+
+
+def test_search_index_prefix_fuzzy_and_ranges(data_dir, monkeypatch, capsys):
+    rows = [sample_transaction(f"tx{i}", amount=float(i)) for i in range(1, 6)]
+    rows[0]["description"] = "Coffee beans"
+    rows[1]["description"] = "Coffee machine"
+    rows[2].update(description="Groceries", bank="Other")
+    rows[3]["date"] = datetime.datetime(2024, 3, 1).isoformat()
+    finance_manager.save_transactions(rows)
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+
+    assert [tx["id"] for tx in ledger.search("cof")] == ["tx1", "tx2"]
+    assert [tx["id"] for tx in ledger.search("coffee mach")] == ["tx2"]
+    assert ledger.search("cofee") == []
+    assert [tx["id"] for tx in ledger.search("cofee", fuzzy=True)] == ["tx1", "tx2"]
+    assert [tx["id"] for tx in ledger.search("other")] == ["tx3"]
+    assert [tx["id"] for tx in ledger.search("test", since="2024-02-01")] == ["tx4"]
+    assert [tx["id"] for tx in ledger.search("", min_amount=2, max_amount=3)] == ["tx2", "tx3"]
+
+    # Edits are indexed as they happen and the index is saved for the next session.
+    ledger.update(ledger.get("tx5"), description="Coffee filters")
+    finance_manager.save_transactions(ledger, changed=[ledger.get("tx5")])
+    assert [tx["id"] for tx in ledger.search("coffee")] == ["tx1", "tx2", "tx5"]
+    ledger.save_caches()
+
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    monkeypatch.setattr(ledger, "select", lambda *a, **kw: pytest.fail("index rebuilt"))
+    assert ledger.complete("fil") == ["filters"]
+
+    assert finance_manager.main(["tx", "search", "cofee", "--fuzzy", "--max-amount", "1", "--json"]) == 0
+    assert [json.loads(line)["id"] for line in capsys.readouterr().out.splitlines()] == ["tx1"]
+
+    # A blank search in the menu lists everything without searching.
+    set_monkeypatch_responses(monkeypatch, ["Search", "  "])
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    monkeypatch.setattr(ledger, "search", lambda *a, **kw: pytest.fail("blank query searched"))
+    monkeypatch.setattr("builtins.input", lambda prompt="": "q")
+    finance_manager.view_transactions(ledger)
+    assert capsys.readouterr().out.count("ID: ") == 5
+
+
+def test_transaction_views_page_lazily_and_export(data_dir, monkeypatch, capsys):
+    rows = [sample_transaction(f"tx{i}", amount=float(i)) for i in range(1, 51)]
+    for i, tx in enumerate(rows):
+        tx["date"] = datetime.datetime(2024, 1, 1 + i % 28, i % 24).isoformat()
+    rows[7].update(type="withdrawal", refunded_transaction_id="tx3")
+    finance_manager.save_transactions(rows)
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+
+    top = finance_manager.transaction_rows(ledger, sort="amount", reverse=True, limit=3)
+    assert [tx["id"] for tx in top] == ["tx50", "tx49", "tx48"]
+    read = []
+    monkeypatch.setattr(ledger, "select", lambda *a, **kw: (read.append(tx) or tx for tx in rows))
+    page = finance_manager.transaction_rows(ledger, min_amount=10, offset=5, limit=5)
+    assert [tx["id"] for tx in page] == ["tx15", "tx16", "tx17", "tx18", "tx19"]
+    assert len(read) == 19
+    assert not ledger.loaded
+
+    # Details, then the same page as a table, then the next page; rows past it are never printed.
+    answers = iter(["t", "", "q"])
+    monkeypatch.setattr("builtins.input", lambda prompt="": next(answers))
+    finance_manager.page_transactions(iter(rows), page_size=20)
+    out = capsys.readouterr().out
+    assert out.count("ID: ") == 20 and out.count(finance_manager.TABLE_HEADER) == 2
+    assert "tx40\n" in out and "tx41" not in out
+
+    finance_manager.write_columnar(rows, "small.columns", group_rows=16)
+    assert list(finance_manager.read_columnar("small.columns")) == rows
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    for fmt in finance_manager.EXPORT_FORMATS:
+        path = f"all{finance_manager.EXPORT_FORMATS[fmt]}"
+        assert finance_manager.main(["tx", "export", path, "--sort", "date"]) == 0
+    expected = sorted(rows, key=lambda tx: (tx["date"], tx["id"]))
+    assert list(finance_manager.read_columnar("all.columns")) == expected
+    with open("all.jsonl") as f:
+        assert [json.loads(line) for line in f] == expected
+    with open("all.csv", newline="") as f:
+        imported = list(finance_manager.iter_csv_statement(f))
+    assert [(tx["id"], tx["amount"], tx["type"]) for tx in imported] == [
+        (tx["id"], tx["amount"], tx["type"]) for tx in expected
+    ]
+
+
+def test_headless_commands_do_not_import_the_prompt_stack(data_dir):
+    code = (
+        "import sys, finance_manager; finance_manager.main(['tx', 'list']); "
+        "print(sorted(m for m in ('questionary', 'prompt_toolkit', 'numpy', 'asyncio', 'cProfile') if m in sys.modules))"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(finance_manager.__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=data_dir, env=env, capture_output=True, text=True)
+    assert result.stdout.strip() == "[]", result.stderr
+
+
+def test_import_leaves_unused_subsystems_unloaded(data_dir):
+    # What the interactive menu starts with: none of these are needed yet.
+    unused = ("sqlite3", "csv", "decimal", "mmap", "argparse", "urllib.parse", "hashlib")
+    code = f"import sys, finance_manager; print(sorted(m for m in {unused!r} if m in sys.modules))"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(finance_manager.__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=data_dir, env=env, capture_output=True, text=True)
+    assert result.stdout.strip() == "[]", result.stderr
+
+
+@pytest.mark.parametrize("backend", ["json", "journal", "sqlite"])
+def test_ledger_snapshot_is_reused_until_storage_changes(data_dir, monkeypatch, backend):
+    use_storage(monkeypatch, backend)
+    rows = [sample_transaction(f"tx{i}", amount=float(i)) for i in range(1, 4)]
+    finance_manager.save_transactions(rows)
+
+    def restart():
+        finance_manager.get_storage().close()
+        monkeypatch.setattr(finance_manager, "_storage", None)
+        return finance_manager.Ledger(finance_manager.LazyTransactions())
+
+    ledger = finance_manager.Ledger(finance_manager.LazyTransactions())
+    ledger.load()
+    ledger.save_caches()
+    ledger = restart()
+    with monkeypatch.context() as m:
+        m.setattr(finance_manager, "load_transactions", lambda: pytest.fail("snapshot not used"))
+        assert list(ledger) == rows
+        # Commits made by this process are written back on exit.
+        ledger.update(ledger.get("tx1"), amount=5.0)
+        finance_manager.save_transactions(ledger, changed=[ledger.get("tx1")])
+        ledger.save_caches()
+        assert restart().get("tx1")["amount"] == 5.0
+
+    # A commit from another process makes the snapshot stale.
+    finance_manager.save_transactions([], changed=[sample_transaction("tx4")])
+    ledger = restart()
+    assert finance_manager.snapshot_generation() is None
+    assert len(ledger) == 4
+    ledger.save_caches()
+
+    # So does a damaged file.
+    with open(finance_manager.SNAPSHOT_FILE, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"\x00")
+    assert finance_manager.snapshot_generation() is not None
+    assert finance_manager.load_snapshot() is None
+
+
+def test_instrumentation_records_percentiles_and_profiles(data_dir, monkeypatch, capsys):
+    write_setup(data_dir, 100.0)
+    # Disabled, nothing is wrapped or recorded.
+    assert finance_manager.measure("menu.render") is finance_manager._NOT_MEASURED
+    monkeypatch.setattr(finance_manager, "METRICS_WINDOW", 2)
+    set_monkeypatch_responses(monkeypatch, ["Exit"])
+    try:
+        assert finance_manager.main(["--metrics"]) == 0
+        for amount in ("10", "20", "30"):
+            assert finance_manager.main(["tx", "add", "--bank", "Test Bank", "--account", "Checking",
+                                         "--type", "deposit", "--amount", amount]) == 0
+        assert finance_manager.main(["tx", "list", "--profile", "cprofile", "--profile", "tracemalloc"]) == 0
+    finally:
+        finance_manager.disable_instrumentation()
+    assert finance_manager._instrumentation is None
+
+    with open(finance_manager.METRICS_FILE) as f:
+        operations = json.load(f)["operations"]
+    for name in ("menu.render", "storage.load_setup", "storage.commit", "index.add", "view.rows"):
+        summary = operations[name]
+        assert 0 <= summary["p50_ms"] <= summary["p99_ms"] <= summary["max_ms"], name
+    # Only the latest METRICS_WINDOW samples of an operation are kept.
+    assert operations["menu.render"]["count"] == 1
+    assert operations["storage.commit"]["count"] == 2
+    assert len(operations["storage.commit"]["samples"]) == 2
+    profiles = os.listdir(finance_manager.PROFILE_DIR)
+    assert any(name.startswith("storage.load_setup-") and name.endswith(".prof") for name in profiles)
+    assert any(name.startswith("storage.load_setup-") and name.endswith(".alloc.txt") for name in profiles)
+
+    capsys.readouterr()
+    assert finance_manager.main(["metrics"]) == 0
+    assert "storage.commit" in capsys.readouterr().out
+
+
+def test_clear_screen_writes_escape_sequences(monkeypatch):
+    class Terminal:
+        def __init__(self):
+            self.written = []
+
+        def isatty(self):
+            return True
+
+        def write(self, text):
+            self.written.append(text)
+
+        def flush(self):
+            pass
+
+    terminal = Terminal()
+    monkeypatch.setattr(sys, "stdout", terminal)
+    monkeypatch.setattr(finance_manager, "_ansi_enabled", True)
+    monkeypatch.setattr(os, "system", lambda command: pytest.fail("spawned a shell"))
+    finance_manager.clear_screen()
+    finance_manager.print_header()
+    assert terminal.written[0] == "\033[H\033[2J\033[3J"
+    assert "Money Maestro" in terminal.written[1]